@@ -19,6 +19,7 @@ cdef extern from "PSISender.h":
     cdef cppclass Sender:
         uint64_t statSecParam;
         uint64_t setSize;
+        uint64_t recvSetSize;
 
         string hostName;
         uint32_t port;
@@ -50,6 +51,7 @@ cdef extern from "PSIReceiver.h":
     cdef cppclass Receiver:
         uint64_t statSecParam;
         uint64_t setSize;
+        uint64_t sendSetSize;
 
         string hostName;
         uint32_t port;
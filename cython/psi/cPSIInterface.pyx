@@ -46,6 +46,14 @@ cdef class PyPSIReceiver:
     def setSize(self, setSize):
         self.c_recv.setSize = setSize
 
+    @property
+    def sendSetSize(self):
+        return self.c_recv.sendSetSize
+
+    @sendSetSize.setter
+    def sendSetSize(self, sendSetSize):
+        self.c_recv.sendSetSize = sendSetSize
+
     @property
     def hostName(self):
         if(type(self.c_recv.hostName) is str):
@@ -185,6 +193,14 @@ cdef class PyPSISender:
     def setSize(self, setSize):
         self.c_send.setSize = setSize
 
+    @property
+    def recvSetSize(self):
+        return self.c_send.recvSetSize
+
+    @recvSetSize.setter
+    def recvSetSize(self, recvSetSize):
+        self.c_send.recvSetSize = recvSetSize
+
     @property
     def hostName(self):
         if(type(self.c_send.hostName) is str):
@@ -59,6 +59,9 @@ std::vector<oc::u64> Receiver::execute(PSIScheme psiScheme, std::vector<oc::bloc
     if(setSize == 0){
         std::cout << "No valid set size was provided" << "\n";
     }
+    if(sendSetSize != 0 && sendSetSize != setSize && psiScheme != Kkrt16){
+        throw std::logic_error("Different set sizes are only supported by KKRT16.");
+    }
 
     if (psiScheme == Drrt18){
         // Special channels necessary
@@ -180,7 +183,8 @@ std::vector<oc::u64> Receiver::executeKkrt16(std::vector<oc::block> set, std::ve
 
     oc::KkrtPsiReceiver recv;
     
-    recv.init(setSize, setSize, statSecParam, chls, otRecv,
+    oc::u64 sendSize = sendSetSize == 0 ? setSize : sendSetSize;
+    recv.init(sendSize, setSize, statSecParam, chls, otRecv,
               prng.get<oc::block>());
     recv.sendInput(set, chls);
     return recv.mIntersection;
@@ -20,6 +20,9 @@ class Receiver {
     public:
     oc::u64 statSecParam = 40;
     oc::u64 setSize = 0;
+    // Size of the sender's set, 0: equal to setSize.
+    // Only KKRT16 supports different set sizes.
+    oc::u64 sendSetSize = 0;
     
     // Connection Settings -----------------------------------------------------
     std::string hostName = "127.0.0.1";
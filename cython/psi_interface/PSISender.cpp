@@ -60,6 +60,9 @@ void Sender::execute(PSIScheme psiScheme, std::vector<oc::block> inputSet){
     if(setSize == 0){
         std::cout << "No valid set size was provided" << "\n";
     } 
+    if(recvSetSize != 0 && recvSetSize != setSize && psiScheme != Kkrt16){
+        throw std::logic_error("Different set sizes are only supported by KKRT16.");
+    }
 
     if (psiScheme == Drrt18){
         // Special channels necessary
@@ -181,7 +184,8 @@ void Sender::executeKkrt16(std::vector<oc::block> set, std::vector<oc::Channel>
 
     oc::KkrtPsiSender send;
     
-    send.init(setSize, setSize, statSecParam, chls, otSend, prng.get<oc::block>()); //TODO:investigate double setSize
+    oc::u64 recvSize = recvSetSize == 0 ? setSize : recvSetSize;
+    send.init(setSize, recvSize, statSecParam, chls, otSend, prng.get<oc::block>());
     send.sendInput(set, chls);
 }
 
@@ -9,32 +9,46 @@ E-mail: buchholz@comsys.rwth-aachen.de
 import argparse
 import atexit
 import copy
+import hashlib
 import json
 import logging
-import multiprocessing
+import os
 import pickle
 import pprint
 import shutil
 import sys
 import time
-from itertools import tee
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Iterable, Iterator
 
+import numpy as np
 # noinspection PyUnresolvedReferences
 from memory_profiler import profile, memory_usage
 from pybloomfilter import BloomFilter
 
-from lib import config, helpers
+from lib import config, helpers, planner
 from lib.base_client import BaseClient, UserType, ServerType
-from lib.helpers import parse_list, to_base64, print_time, from_base64
+from lib.bloom import (apply_delta, get_decompressor, WORD_DTYPE,
+                       LEGACY_KEY_ENCODING, open_bloom_filter)
+from lib.hash_cache import HashCache
+from lib.helpers import (parse_list, to_base64, print_time, from_base64,
+                         load_records)
 from lib.logging import configure_root_loger
-from lib.record import Record, hash_to_index
+from lib.matching_pool import get_matching_pool, match_batch
+from lib.psi_set import client_set_size, psi_bucket
+from lib.record import (Record, RecordBatch, hash_to_index,
+                        batch_from_ciphertext, WIDE_INDEX_DTYPE,
+                        wide_indices_to_ints, ints_to_wide_indices)
 from lib.similarity_metrics import map_metric, RecordIterator, \
-    SimilarityMetricIterator
+    SimilarityMetricIterator, OffsetIterator, GridRegionIterator, \
+    OffsetDeltaIterator
 
 configure_root_loger(logging.INFO, config.LOG_DIR + "client.log")
 log = logging.getLogger()
 
+# Candidate iterators with random access by rank
+RANKED_ITERATORS = (OffsetIterator, GridRegionIterator, OffsetDeltaIterator)
+
 
 class Client(BaseClient):
     """Client Application for end users."""
@@ -42,6 +56,11 @@ class Client(BaseClient):
     type = UserType.CLIENT
     metric = "offset-1"
     _psi_mode = config.PSI_MODE
+    _incremental = config.INCREMENTAL_QUERIES
+    _hash_cache: HashCache = None
+    _bloom_version: str = None
+    _bloom_encoding: str = LEGACY_KEY_ENCODING
+    _psi_buckets: int = 1  # Buckets of the server set seen in the last PSI
 
     def get_record(self, h: str) -> List[Record]:
         """Retrieve record with given hash."""
@@ -61,7 +80,8 @@ class Client(BaseClient):
         """
         Retrieve record with given hash.
         :param hash_list: List of **base64**-encoded hashes
-        :return: List of encrypted records as json.dumps(dict)
+        :return: List of (Base64(hash), ciphertext) tuples, ciphertexts in
+                 binary (Base64) or legacy JSON format
         """
         j = {'hashes': hash_list}
         resp = self.post(f"{self.STORAGESERVER}/batch_retrieve_records",
@@ -106,18 +126,16 @@ class Client(BaseClient):
             self.eval['record_retrieve_time'] = time.monotonic()
             self.eval['decryption_time'] = time.monotonic()
             return []
-        res_list = []
         self.eval['record_retrieve_time'] = time.monotonic()
         log.info(
             f"4.2 - Retrieve records: {print_time(time.monotonic() - start)}")
         log.info("4.3 Decrypting.")
         start = time.monotonic()
-        for h, c in records:
-            c = json.loads(c)
-            key = enc_keys[hash_to_index(from_base64(h), config.OT_INDEX_LEN)]
-            log.debug(
-                f"Using key {key} for record {h}.")
-            res_list.append(Record.from_ciphertext(c, key))
+        keys = [
+            enc_keys[hash_to_index(from_base64(h), config.OT_INDEX_LEN)]
+            for h, _ in records
+        ]
+        res_list = batch_from_ciphertext(records, keys)
         self.eval['decryption_time'] = time.monotonic()
         log.info(
             f"4.3 - Decryption took: {print_time(time.monotonic() - start)}")
@@ -125,30 +143,160 @@ class Client(BaseClient):
 
     def _get_bloom_filter(self) -> BloomFilter or None:
         """
-        Retrieve the bloom filter from storage server
+        Retrieve the bloom filter from storage server. If the client keeps
+        a local copy, only the changes since its version are retrieved.
         :return: Bloom filter
         """
-        resp = self.get(f"{self.STORAGESERVER}/bloom")
-        suc = resp.json()['success']
-        if suc:
-            log.debug("Successfully retrieved bloom filter.")
-            tmp = helpers.get_temp_file() + '.bloom'
-            b = BloomFilter.from_base64(tmp,
-                                        resp.json()['bloom'].encode())
-            atexit.register(shutil.rmtree, tmp, True)  # Remove and ignore
-            # errors
-            return b
+        cache = config.BLOOM_CACHE and not config.EVAL
+        if cache:
+            b = self._update_cached_bloom_filter()
+            if b is not None:
+                return b
+            path = self._bloom_cache_file()
         else:
+            path = helpers.get_temp_file() + '.bloom'
+            atexit.register(shutil.rmtree, path, True)  # Remove and ignore
+            # errors
+        version = self._download_bloom_filter(path)
+        log.debug("Successfully retrieved bloom filter.")
+        if cache:
+            with open(path + '.version', 'w') as fd:
+                json.dump({'version': int(version),
+                           'encoding': self._bloom_encoding}, fd)
+        self._bloom_version = version
+        return open_bloom_filter(path)
+
+    def _download_bloom_filter(self, path: str) -> str:
+        """
+        Stream the binary bloom filter file to disk, decompressing it on
+        the fly. The file is replaced atomically. The key encoding of the
+        filter is stored in self._bloom_encoding.
+        :param path: Destination path
+        :return: Version of the retrieved filter
+        """
+        compression = config.BLOOM_COMPRESSION
+        resp = self.get(f"{self.STORAGESERVER}/bloom_file?"
+                        f"compression={compression}", stream=True)
+        if resp.headers.get('Content-Type', '').startswith(
+                'application/json'):
             msg = resp.json()['msg']
             raise RuntimeError(f"Failed to retrieve bloom filter: {msg}")
+        decompressor = get_decompressor(compression)
+        with open(path + '.tmp', 'wb') as fd:
+            for chunk in resp.iter_content(config.BLOOM_CHUNK_SIZE):
+                if decompressor is not None:
+                    chunk = decompressor.decompress(chunk)
+                fd.write(chunk)
+            if decompressor is not None:
+                fd.write(decompressor.flush())
+        os.replace(path + '.tmp', path)
+        self._bloom_encoding = resp.headers.get('X-Bloom-Encoding',
+                                                LEGACY_KEY_ENCODING)
+        return resp.headers['X-Bloom-Version']
+
+    @staticmethod
+    def _bloom_cache_file() -> str:
+        """Return the path of the local copy of the bloom filter."""
+        return config.DATA_DIR + config.BLOOM_CACHE_FILE
+
+    def _has_bloom_cache(self) -> bool:
+        """Return True if a local copy of the bloom filter is updated."""
+        path = self._bloom_cache_file()
+        return config.BLOOM_CACHE and not config.EVAL and \
+            os.path.exists(path) and os.path.exists(path + '.version')
+
+    def _update_cached_bloom_filter(self) -> BloomFilter or None:
+        """
+        Bring the local copy of the bloom filter up to date by retrieving
+        the words that changed since its version.
+        :return: Bloom filter or None if the whole filter has to be retrieved
+        """
+        path = self._bloom_cache_file()
+        if not os.path.exists(path) or not os.path.exists(path + '.version'):
+            return None
+        with open(path + '.version', 'r') as fd:
+            meta = json.load(fd)
+        version = meta['version']
+        resp = self.get(f"{self.STORAGESERVER}/bloom_delta?since={version}")
+        d = resp.json()
+        if not d['success']:
+            raise RuntimeError(f"Failed to retrieve bloom filter delta: "
+                               f"{d['msg']}")
+        if d['full']:
+            log.debug("Local bloom filter outdated.")
+            return None
+        words = np.frombuffer(from_base64(d['words']), dtype=WORD_DTYPE)
+        values = np.frombuffer(from_base64(d['values']), dtype=WORD_DTYPE)
+        apply_delta(path, words, values)
+        encoding = d.get('encoding',
+                         meta.get('encoding', LEGACY_KEY_ENCODING))
+        with open(path + '.version', 'w') as fd:
+            json.dump({'version': d['version'], 'encoding': encoding}, fd)
+        log.debug(f"Updated local bloom filter from version {version} to "
+                  f"{d['version']} ({len(words)} words).")
+        self._bloom_version = str(d['version'])
+        self._bloom_encoding = encoding
+        return open_bloom_filter(path)
 
-    # noinspection PyUnboundLocalVariable
     def _perform_psi(self, client_set: List[int]) -> List[int]:
         log.debug("Perform PSI.")
         if len(client_set) == 0:
             return []
-        r = self.get(f"{self.STORAGESERVER}/psi")
-        d = r.json()
+        # Padding - KKRT16 does not allow for duplicates
+        client_set = list(set(client_set))  # Remove duplicates
+        # Only the size class of the client set is revealed to the server
+        d = self._request_psi(client_set_size(len(client_set)))
+        if not d['success'] and d.get('buckets', 1) > 1:
+            return self._perform_bucket_psi(client_set, d['buckets'])
+        return self._run_psi(d, [client_set])
+
+    def _request_psi(self, set_size: int, **kwargs) -> dict:
+        """
+        Request a PSI session from the storage server.
+        :param set_size: Padded size of the client set
+        :param kwargs: Further GET parameters, i.e., buckets and bucket
+        :return: PSI connection information
+        """
+        r = self.get(f"{self.STORAGESERVER}/psi",
+                     params=dict(setSize=set_size, **kwargs))
+        return r.json()
+
+    def _perform_bucket_psi(self, client_set: List[int],
+                            buckets: int) -> List[int]:
+        """
+        Perform one PSI per bucket of the server set. Each bucket of the
+        client set is padded to the same size, so that only the size of
+        the largest bucket is revealed.
+        :param client_set: PSI indices without duplicates
+        :param buckets: Number of buckets of the server set
+        :return: Matching PSI indices
+        """
+        log.info(f"PSI set of the server is split into {buckets} buckets.")
+        self._psi_buckets = buckets
+        client_sets = [[] for _ in range(buckets)]
+        for i in client_set:
+            client_sets[psi_bucket(i, buckets)].append(i)
+        size = client_set_size(max(len(s) for s in client_sets))
+        if config.PSI_BUCKET_SESSIONS <= 1:
+            d = self._request_psi(size, buckets=buckets)
+            return self._run_psi(d, client_sets)
+
+        def run(bucket: int) -> List[int]:
+            d = self._request_psi(size, buckets=buckets, bucket=bucket)
+            return self._run_psi(d, [client_sets[bucket]])
+
+        with ThreadPoolExecutor(config.PSI_BUCKET_SESSIONS) as pool:
+            return [m for matches in pool.map(run, range(buckets))
+                    for m in matches]
+
+    def _run_psi(self, d: dict, client_sets: List[List[int]]) -> List[int]:
+        """
+        Perform the PSIs of one session offered by the storage server, one
+        after another for each of the given client sets.
+        :param d: PSI connection information returned by the server
+        :param client_sets: PSI indices without duplicates, one list per PSI
+        :return: Matching PSI indices
+        """
         if not d['success']:
             raise RuntimeError(f"PSI failed: {d['msg']}")
         log.debug("Retrieved PSI connection information.")
@@ -159,21 +307,16 @@ class Client(BaseClient):
         host = d['host']
         port = d['port']
         set_size = d['setSize']
-        if set_size < len(client_set):
+        # Older servers expect the client set to be as large as theirs
+        padded_size = d.get('clientSetSize', set_size)
+        if any(padded_size < len(s) for s in client_sets):
             raise RuntimeError("Client Set larger than PSI Setsize.")
-        # Padding - KKRT16 does not allow for duplicates
-        client_set = list(set(client_set))  # Remove duplicates
-        # log.debug(f"Client set without dummies: {str(client_set)}")
-        dummy = config.PSI_DUMMY_START_CLIENT
-        while len(client_set) < set_size:
-            client_set.append(dummy)
-            dummy += 1
         if d['tls']:
             tls = "with"
         else:
             tls = "without"
         log.info(f"Connecting for PSI to host {host} on port {port} {tls} "
-                 f"TLS. Setsize: {set_size}")
+                 f"TLS. Setsize: {padded_size}/{set_size}")
 
         if config.EVAL:  # pragma no cover
             to_svr, tsvr_file = helpers.start_trans_measurement(
@@ -184,7 +327,15 @@ class Client(BaseClient):
             self.eval['psi_tcpdump_recv'].append(fsvr_file)
             time.sleep(1)  # Wait for startup of tcpdump
 
-        matches = self._receive_psi(client_set, host, port, d['tls'])
+        matches = []
+        for client_set in client_sets:
+            # log.debug(f"Client set without dummies: {str(client_set)}")
+            dummy = config.PSI_DUMMY_START_CLIENT
+            client_set = client_set + list(
+                range(dummy, dummy + padded_size - len(client_set)))
+            matches.extend(self._receive_psi(client_set, host, port,
+                                             d['tls'],
+                                             server_set_size=set_size))
 
         log.debug(f"Completed PSI.")
         log.debug(f"Matches: {str(matches)}")
@@ -192,12 +343,163 @@ class Client(BaseClient):
         matches = [m for m in matches if m < config.PSI_DUMMY_START_CLIENT]
         return matches
 
+    def _get_hash_cache(self) -> HashCache or None:
+        """
+        Return the candidate hash cache for the current hash key if enabled.
+        Hit statistics are reset so that they refer to one query.
+        :return: HashCache or None
+        """
+        if not config.HASH_CACHE:
+            return None
+        if self._hash_cache is None:
+            self._hash_cache = HashCache(self.get_hash_key())
+        self._hash_cache.hits = 0
+        self._hash_cache.misses = 0
+        return self._hash_cache
+
+    def _eval_hash_cache(self, hits: int, misses: int) -> None:
+        """Store hit rate of the candidate hash cache in eval dict."""
+        self.eval['hash_cache_hits'] = hits
+        self.eval['hash_cache_misses'] = misses
+        if hits + misses > 0:
+            self.eval['hash_cache_hit_rate'] = hits / (hits + misses)
+        else:
+            self.eval['hash_cache_hit_rate'] = 0
+
+    def _query_state_file(self) -> str:
+        """Return the path of the file storing the last query."""
+        return config.DATA_DIR + config.QUERY_STATE_FILE.format(self.user)
+
+    def _delta_candidates(self, candidate_iterator: SimilarityMetricIterator
+                          ) -> (SimilarityMetricIterator, List[Record]):
+        """
+        Reduce the candidates to those not covered by the previous query if
+        the previous query used the same Bloom filter and hash key.
+        :param candidate_iterator: Candidates of the current query
+        :return: (Candidates to check, matches of the previous query that
+                 are candidates of the current query)
+        """
+        path = self._query_state_file()
+        if not isinstance(candidate_iterator, OffsetIterator) or \
+                not os.path.exists(path):
+            return candidate_iterator, []
+        with open(path, 'rb') as fd:
+            state = pickle.load(fd)
+        key = hashlib.sha3_256(self.get_hash_key()).hexdigest()
+        if state['bloom_version'] != self._bloom_version or \
+                state['hash_key'] != key or \
+                not isinstance(state['candidates'], OffsetIterator):
+            log.info("Bloom filter changed, no incremental matching.")
+            return candidate_iterator, []
+        try:
+            delta = OffsetDeltaIterator(candidate_iterator,
+                                        state['candidates'])
+        except ValueError:
+            log.info("Previous query not comparable, no incremental "
+                     "matching.")
+            return candidate_iterator, []
+        kept = [r for r in state['matches']
+                if candidate_iterator.contains(r.record)]
+        log.info(f"Incremental matching: {delta.size} new candidates, "
+                 f"{len(kept)} matches of previous query kept.")
+        return delta, kept
+
+    def _store_query_state(self, candidate_iterator: SimilarityMetricIterator,
+                           matches: List[Record]) -> None:
+        """
+        Store the candidates and matches of a complete query for
+        incremental matching of the next query.
+        :param candidate_iterator: Candidates of the query
+        :param matches: All matches of the query
+        """
+        state = {
+            'bloom_version': self._bloom_version,
+            'hash_key': hashlib.sha3_256(self.get_hash_key()).hexdigest(),
+            'candidates': candidate_iterator,
+            'matches': matches
+        }
+        with open(self._query_state_file(), 'wb') as fd:
+            pickle.dump(state, fd)
+
+    @staticmethod
+    def _match_bloom(client_set: RecordIterator, b: BloomFilter,
+                     encoding: str = LEGACY_KEY_ENCODING) -> List[Record]:
+        """
+        Hash the candidates batch-wise and return those contained in the
+        bloom filter.
+        :param client_set: Candidates to check
+        :param b: Bloom filter of the storage server
+        :param encoding: [optional] Key encoding of the filter
+        :return: List of matching Records
+        """
+        matches = []
+        for batch in client_set.iter_batches():
+            matches.extend(Client._match_bloom_batch(batch, b, encoding))
+        return matches
+
+    @staticmethod
+    def _match_bloom_batch(batch: RecordBatch, b: BloomFilter,
+                           encoding: str = LEGACY_KEY_ENCODING
+                           ) -> List[Record]:
+        """Return the records of the batch contained in the bloom filter."""
+        return [batch.get_record(i) for i in match_batch(batch, b, encoding)]
+
+    def _iter_budget_batches(self, client_set: RecordIterator,
+                             total: int,
+                             max_candidates: int = None,
+                             deadline: float = None) -> Iterator:
+        """
+        Yield the candidates ordered by increasing distance from the target
+        (in iteration order if the metric does not support this)
+        until max_candidates candidates have been examined or the deadline
+        has passed. The examined fraction of the hypercube is stored in
+        eval['coverage'].
+        :param client_set: Candidates to check
+        :param total: Total number of candidates
+        :param max_candidates: [optional] Maximal number of candidates
+        :param deadline: [optional] time.monotonic() value to stop at
+        :return: Iterator over RecordBatch objects
+        """
+        examined = 0
+        self.eval['candidates_examined'] = 0
+        self.eval['coverage'] = 0
+        best_first = client_set.supports_best_first
+        if not best_first:
+            log.warning("Candidates cannot be ordered by distance, checking "
+                        "them in iteration order.")
+        for batch in client_set.iter_batches(best_first=best_first):
+            if deadline is not None and time.monotonic() >= deadline:
+                log.info("Deadline reached, stopping matching.")
+                return
+            if max_candidates is not None:
+                if examined >= max_candidates:
+                    log.info("Candidate budget exhausted, stopping "
+                             "matching.")
+                    return
+                if examined + len(batch) > max_candidates:
+                    batch = RecordBatch(
+                        batch.vectors[:max_candidates - examined],
+                        self.get_hash_key(), cache=client_set.cache)
+            examined += len(batch)
+            self.eval['candidates_examined'] = examined
+            self.eval['coverage'] = examined / total if total > 0 else 1
+            yield batch
+
     def compute_matches_bloom(self,
-                              candidate_iterator: SimilarityMetricIterator) \
-            -> List[Record]:
+                              candidate_iterator: SimilarityMetricIterator,
+                              max_matches: int = None,
+                              max_candidates: int = None,
+                              deadline: float = None) -> List[Record]:
         """
         Compute list of records stored on server side using a bloom filter.
+        If a budget is given, the candidates are checked by increasing
+        distance from the target and matching stops once it is exhausted.
+        In incremental mode without budget, only candidates not covered by
+        the previous query are checked if the Bloom filter is unchanged.
         :param candidate_iterator: Iterator over candidates
+        :param max_matches: [optional] Stop after this many matches
+        :param max_candidates: [optional] Stop after this many candidates
+        :param deadline: [optional] time.monotonic() value to stop at
         :return: List of Records found on server side.
         """
         if self._psi_mode:
@@ -208,80 +510,141 @@ class Client(BaseClient):
 
         self.eval['bloom_filter_retrieve_time'] = time.monotonic()
         log.info(f"3.2 Compute matches with Bloom Filter.")
-        if config.PARALLEL:
-            # parallel
-            num_procs = multiprocessing.cpu_count()
-            its = candidate_iterator.split(num_procs)
-            num_procs = len(its)
+        incremental = self._incremental and \
+            (max_matches, max_candidates, deadline) == (None, None, None)
+        full_iterator = candidate_iterator
+        kept = []
+        if incremental:
+            candidate_iterator, kept = self._delta_candidates(
+                candidate_iterator)
+            self.eval['delta_candidates'] = candidate_iterator_size(
+                candidate_iterator)
+        if (max_matches, max_candidates, deadline) != (None, None, None):
+            # Best-first with budget, sequential to keep the order
+            cache = self._get_hash_cache()
+            client_set = RecordIterator(candidate_iterator,
+                                        self.get_hash_key(), cache)
+            matches = []
+            for batch in self._iter_budget_batches(
+                    client_set, candidate_iterator_size(candidate_iterator),
+                    max_candidates, deadline):
+                matches.extend(self._match_bloom_batch(
+                    batch, b, self._bloom_encoding))
+                if max_matches is not None and len(matches) >= max_matches:
+                    log.info("Match budget reached, stopping matching.")
+                    matches = matches[:max_matches]
+                    break
+            if cache is not None:
+                self._eval_hash_cache(cache.hits, cache.misses)
+        elif config.PARALLEL and isinstance(candidate_iterator,
+                                            RANKED_ITERATORS):
+            # Parallel, workers receive rank ranges of the candidates
+            cache = self._get_hash_cache()
+            pool = get_matching_pool()
             log.debug(
-                f"Using {num_procs} parallel processes for bloom matching.")
-            processes = []
-            m = multiprocessing.Manager()
-            output = m.list()
-
-            def matching(client_set: RecordIterator,
-                         i: int):  # pragma no cover
-                """Compute matching with given part of client set."""
-                log.debug(
-                    f"Proc {i} iterating over {len(client_set)} elements.")
-                m = [i for i in client_set if to_base64(
-                    i.get_long_hash()) in b]
-                output.extend(m)
-
-            for i in range(num_procs):
-                client_set = RecordIterator(its[i], self._hash_key)
-                p = multiprocessing.Process(target=matching,
-                                            args=(client_set, i))
-                processes.append(p)
-                p.start()
-                atexit.register(p.terminate)
-            for i, p in enumerate(processes):
-                p.join()
-                atexit.unregister(p.terminate)
-            matches = list(output)
-            log.debug("All processes terminated.")
+                f"Using {len(pool)} parallel processes for bloom matching.")
+            b.sync()
+            vectors, hashes, hits, misses = pool.match(
+                candidate_iterator, b.filename, self._bloom_version,
+                self.get_hash_key(), cache, self._bloom_encoding)
+            matches = []
+            for vec, h in zip(vectors, hashes):
+                r = Record(vec.tolist())
+                r.set_hash_key(self.get_hash_key(), long_hash=h.tobytes())
+                matches.append(r)
+            if cache is not None:
+                self._eval_hash_cache(hits, misses)
         else:
             client_set = RecordIterator(candidate_iterator,
-                                        self.get_hash_key())
-            matches = [i for i in client_set if to_base64(
-                i.get_long_hash()) in b]
-
+                                        self.get_hash_key(),
+                                        self._get_hash_cache())
+            matches = self._match_bloom(client_set, b, self._bloom_encoding)
+            if client_set.cache is not None:
+                self._eval_hash_cache(client_set.cache.hits,
+                                      client_set.cache.misses)
+
+        if incremental:
+            matches = kept + matches
+            self._store_query_state(full_iterator, matches)
         self.eval['bloom_matching_time'] = time.monotonic()
         return matches
 
     def compute_matches_psi(self,
-                            candidate_iterator: SimilarityMetricIterator) -> \
-            List[Record]:
+                            candidate_iterator: SimilarityMetricIterator,
+                            max_matches: int = None,
+                            max_candidates: int = None,
+                            deadline: float = None) -> List[Record]:
         """
         Compute list of records stored on server side using a bloom filter.
+        If a budget is given, the client set consists of the candidates
+        closest to the target that fit into the budget and the PSI set size.
         :param candidate_iterator: Iterator over candidates
+        :param max_matches: [optional] Return at most this many matches
+        :param max_candidates: [optional] Maximal size of the client set
+        :param deadline: [optional] time.monotonic() value to stop adding
+                         candidates at
         :return: List of Records found on server side.
         """
         if not self._psi_mode:
             raise RuntimeError("Matches cannot be computed with PSI "
                                "because PSI-Mode is not enabled.")
-        if len(candidate_iterator) > config.PSI_SETSIZE:
+        budget = (max_matches, max_candidates, deadline) != (None, None, None)
+        total = candidate_iterator_size(candidate_iterator)
+        if not budget and total > config.PSI_SETSIZE:
             raise RuntimeError("Candidate Set is too large for PSI! "
-                               f"Candidates: {len(candidate_iterator)} "
+                               f"Candidates: {total} "
                                f"PSI Setsize: {config.PSI_SETSIZE}")
         log.info(f"3.1 Compute matches via PSI.")
-        client_set = RecordIterator(candidate_iterator, self.get_hash_key())
-
-        it1, it2 = tee(client_set)
-        psi_indizes = list(set([r.get_psi_index() for r in it1]))
-        # for r in it1:
-        #     if r.get_psi_index() not in psi_indizes:
-        #         psi_indizes.append(r.get_psi_index())
+        cache = self._get_hash_cache()
+        client_set = RecordIterator(candidate_iterator, self.get_hash_key(),
+                                    cache)
+
+        if budget:
+            if max_candidates is None or max_candidates > config.PSI_SETSIZE:
+                max_candidates = config.PSI_SETSIZE
+            batches = self._iter_budget_batches(
+                client_set, total, max_candidates, deadline)
+        else:
+            batches = client_set.iter_batches()
+        # Candidates are regenerated by rank if the iterator allows random
+        # access in enumeration order, otherwise their vectors are kept.
+        ranked = not budget and isinstance(candidate_iterator,
+                                           RANKED_ITERATORS)
+        # Single pass: the PSI index of the candidate with rank i is
+        # indices[i]
+        indices = [np.empty(0, dtype=WIDE_INDEX_DTYPE)]
+        vectors = [np.empty((0, config.RECORD_LENGTH), dtype=np.float64)]
+        for batch in batches:
+            indices.append(batch.get_wide_psi_indices())
+            if not ranked:
+                vectors.append(batch.vectors)
+        indices = np.concatenate(indices)
+        psi_indizes = wide_indices_to_ints(np.unique(indices))
+        if cache is not None:
+            self._eval_hash_cache(cache.hits, cache.misses)
 
         log.debug("Created PSI client set.")
         self.eval['psi_preparation_time'] = time.monotonic()
 
-        matching_indizes = self._perform_psi(psi_indizes)
+        matching_indizes = set(self._perform_psi(psi_indizes))
 
         self.eval['psi_execution_time'] = time.monotonic()
 
-        matches = [r for r in it2
-                   if r.get_psi_index() in matching_indizes]
+        found = np.sort(ints_to_wide_indices(matching_indizes))
+        if len(found) > 0:
+            pos = np.searchsorted(found, indices)
+            pos[pos == len(found)] = 0
+            ranks = np.flatnonzero(found[pos] == indices)
+        else:
+            ranks = np.empty(0, dtype=np.int64)
+        if max_matches is not None:
+            ranks = ranks[:max_matches]
+        if ranked:
+            rows = (candidate_iterator[i] for i in ranks.tolist())
+        else:
+            rows = np.concatenate(vectors)[ranks].tolist()
+        matches = [Record(list(v), hash_key=self.get_hash_key())
+                   for v in rows]
 
         self.eval['psi_set_construction_time'] = time.monotonic()
 
@@ -303,21 +666,76 @@ class Client(BaseClient):
         log.debug(f"Compute candidates using {metric_name}.")
         return metric(target, *args)
 
+    def plan(self, target: List[float], metric_name: str = None,
+             expected_matches: int = None) -> dict:
+        """
+        Estimate the costs of a retrieval without enumerating the candidates
+        or contacting the servers.
+        :param target: The target vector to retrieve similar values for
+        :param metric_name: Name of the similarity metric to use.
+        :param expected_matches: [optional] Expected number of real matches
+        :return: Dict with estimates, see planner.plan_query
+        """
+        if metric_name is None:
+            metric_name = self.metric
+        candidates = candidate_iterator_size(
+            self.compute_candidates(target, metric_name))
+        result = planner.plan_query(candidates,
+                                    expected_matches=expected_matches,
+                                    psi_buckets=self._psi_buckets,
+                                    bloom_cached=self._has_bloom_cache())
+        result['metric'] = metric_name
+        return result
+
     # @profile(stream=f)
-    def full_retrieve(self, target: List[float]) -> List[Record]:
+    def full_retrieve(self, target: List[float], max_matches: int = None,
+                      max_candidates: int = None,
+                      deadline: float = None) -> List[Record]:
         """
-        Perform a full retrieval
+        Perform a full retrieval. If any budget is given, the candidates
+        closest to the target are matched first and a partial result is
+        returned once the budget is exhausted, see eval['coverage'].
         :param target: The target vector to retrieve similar values for
+        :param max_matches: [optional] Maximal number of matches
+        :param max_candidates: [optional] Maximal number of candidates
+        :param deadline: [optional] Seconds after which matching stops
         :return: The list of retrieved candidates.
         """
         self.eval['start_time'] = time.monotonic()
+        if deadline is not None:
+            deadline = self.eval['start_time'] + deadline
+        budget = dict(max_matches=max_matches,
+                      max_candidates=max_candidates,
+                      deadline=deadline)
         try:
             log.debug(f"Retrieve matches for: {target}")
             log.info(f"1. Compute candidates.")
 
             candidate_iterator = self.compute_candidates(target)
             self.eval['compute_candidates_time'] = time.monotonic()
-            log.info(f"1 - Computed {len(candidate_iterator)} candidates.")
+            log.info(f"1 - Computed "
+                     f"{candidate_iterator_size(candidate_iterator)} "
+                     f"candidates.")
+            if config.PLANNER_AUTO_MODE:
+                plan = planner.plan_query(
+                    candidate_iterator_size(candidate_iterator),
+                    psi_buckets=self._psi_buckets,
+                    bloom_cached=self._has_bloom_cache())
+                self.eval['planned_mode'] = plan['mode']
+                if config.EVAL:
+                    # The evaluation measures the configured modes, the
+                    # plan is only recorded for comparison.
+                    log.info(f"1 - Planner would choose {plan['mode']} "
+                             f"mode.")
+                elif plan['mode'] is None:
+                    raise RuntimeError(
+                        f"Query exceeds cost budget of {plan['budget']}s. "
+                        f"Estimated costs: Bloom {plan['bloom_cost']:.0f}s, "
+                        f"PSI {plan['psi_cost']:.0f}s.")
+                else:
+                    log.info(f"1 - Planner chose {plan['mode']} mode.")
+                    self._psi_mode = plan['mode'] == 'psi'
+
             log.info(f"2. Retrieve hash secret.")
             start = time.monotonic()
 
@@ -330,16 +748,20 @@ class Client(BaseClient):
             log.info(f"3. Compute Matches.")
             start = time.monotonic()
 
+            self.eval['coverage'] = 1
             if not config.EVAL:
                 if self._psi_mode:
-                    matches = self.compute_matches_psi(candidate_iterator)
+                    matches = self.compute_matches_psi(candidate_iterator,
+                                                       **budget)
                 else:
-                    matches = self.compute_matches_bloom(candidate_iterator)
+                    matches = self.compute_matches_bloom(candidate_iterator,
+                                                         **budget)
             else:  # pragma no cover
                 # Do BOTH PSI and BLOOM if PSI Mode enabled.
                 candidate_iterator2 = copy.deepcopy(candidate_iterator)
                 if self._psi_mode:
-                    psi_matches = self.compute_matches_psi(candidate_iterator)
+                    psi_matches = self.compute_matches_psi(candidate_iterator,
+                                                           **budget)
                     self.eval['psi_matches'] = len(psi_matches)
                 else:
                     self.eval['psi_matches'] = 0
@@ -353,12 +775,14 @@ class Client(BaseClient):
                     # for r in RecordIterator(candidate_iterator, self.get_hash_key()):
                     #     print(to_base64(r.get_long_hash()))
                 self._psi_mode = False
-                bloom_matches = self.compute_matches_bloom(candidate_iterator2)
+                bloom_matches = self.compute_matches_bloom(
+                    candidate_iterator2, **budget)
                 self.eval['bloom_matches'] = len(bloom_matches)
                 matches = bloom_matches
                 self.eval['num_matches'] = len(matches)
 
-            log.info(f"3 - Computed {len(matches)} matches.")
+            log.info(f"3 - Computed {len(matches)} matches "
+                     f"(coverage: {self.eval['coverage']:.2%}).")
             # log.debug(str([r.record for r in matches]))
             log.info(
                 f"3 - Matching took: {print_time(time.monotonic() - start)}")
@@ -376,6 +800,35 @@ class Client(BaseClient):
         """Enables PSI Mode."""
         self._psi_mode = True
 
+    def activate_incremental_mode(self):
+        """Enables incremental matching of consecutive queries."""
+        self._incremental = True
+
+
+def candidate_iterator_size(candidate_iterator: Iterable) -> int:
+    """
+    Return the number of candidates, also if too large for len().
+    :param candidate_iterator: Candidate iterator
+    :return: Number of candidates
+    """
+    if isinstance(candidate_iterator, (OffsetIterator, GridRegionIterator,
+                                       OffsetDeltaIterator)):
+        return candidate_iterator.size
+    return len(candidate_iterator)
+
+
+def parse_target(target: str) -> List[float]:
+    """
+    Return the target given on the command line either as string list or
+    as path of a (text or binary) record file containing the target as
+    first record.
+    :param target: String list or file path
+    :return: Target vector
+    """
+    if os.path.isfile(target):
+        return load_records(target)[0].tolist()
+    return parse_list(target)
+
 
 def get_client_parser() -> argparse.ArgumentParser:
     """Return an argparser for the client application."""
@@ -391,8 +844,21 @@ def get_client_parser() -> argparse.ArgumentParser:
                           type=str, action="store", required=config.EVAL)
     c_parser.add_argument('-p', "--psi", help="Use PSI Mode.",
                           action="store_true")
+    c_parser.add_argument('-i', "--incremental", action="store_true",
+                          help="Only match candidates not covered by the "
+                               "previous query (Bloom mode).")
     c_parser.add_argument('-v', '--verbose', action='count', default=0,
                           help="Increase verbosity. (-v INFO, -vv DEBUG)")
+    c_parser.add_argument("--plan", action="store_true",
+                          help="Only print the estimated costs of the "
+                               "retrieval (-r).")
+    c_parser.add_argument("--max_matches", type=int, action="store",
+                          help="Stop retrieval after this many matches.")
+    c_parser.add_argument("--max_candidates", type=int, action="store",
+                          help="Check at most this many candidates, "
+                               "closest first.")
+    c_parser.add_argument("--deadline", type=float, action="store",
+                          help="Stop matching after this many seconds.")
     action_group.add_argument("-t", "--get_token", action='store_true',
                               help="Retrieve get_token for user with given "
                                    "ID.")
@@ -405,7 +871,8 @@ def get_client_parser() -> argparse.ArgumentParser:
                               help="Compute a list of suitable candidates.")
     action_group.add_argument('-r', '--retrieve_matches', action='store',
                               type=str, dest="target",
-                              help="Retrieve all possibly helpful values.")
+                              help="Retrieve all possibly helpful values. "
+                                   "TARGET may also be a record file.")
     return c_parser
 
 
@@ -444,6 +911,9 @@ if __name__ == '__main__':  # pragma no cover
     if args.psi:
         c.activate_psi_mode()
 
+    if args.incremental:
+        c.activate_incremental_mode()
+
     com_file = None
     if config.EVAL:
         com_file = args.eval
@@ -459,13 +929,17 @@ if __name__ == '__main__':  # pragma no cover
             r_list = c.get_record(h)
             print(f"> Retrieved: {[str(r) for r in r_list]}")
         elif args.similar is not None:
-            target = parse_list(args.similar)
+            target = parse_target(args.similar)
             logging.debug(f"Got: {str(target)}")
             print("> Number of Candidates: ",
-                  len(list(c.compute_candidates(target, c.metric))))
+                  candidate_iterator_size(
+                      c.compute_candidates(target, c.metric)))
         elif args.target is not None:
-            target = parse_list(args.target)
-            if config.EVAL:
+            target = parse_target(args.target)
+            if args.plan:
+                print("> Estimated costs:")
+                pprint.pprint(c.plan(target))
+            elif config.EVAL:
 
                 def execClient():
                     """Execute full retrieve and catch errors
@@ -473,7 +947,9 @@ if __name__ == '__main__':  # pragma no cover
                     :return: result, error
                     """
                     try:
-                        return c.full_retrieve(target), None
+                        return c.full_retrieve(
+                            target, args.max_matches, args.max_candidates,
+                            args.deadline), None
                     except Exception as e:
                         error = str(e)
                         log.exception(error)
@@ -491,9 +967,13 @@ if __name__ == '__main__':  # pragma no cover
                 with open(com_file, "wb") as fd:
                     pickle.dump(c.eval, fd)
             else:
-                res = c.full_retrieve(target)
+                res = c.full_retrieve(target, args.max_matches,
+                                      args.max_candidates, args.deadline)
                 print("> Result:\n> ", end='')
                 pprint.pprint([str(r) for r in res])
+                if c.eval['coverage'] < 1:
+                    print(f"> Partial result, examined "
+                          f"{c.eval['coverage']:.2%} of the candidates.")
     except Exception as e:
         log.error(str(e), exc_info=True)
         sys.exit()
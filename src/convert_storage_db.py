@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+"""This module converts the records of an existing storage DB into the binary
+ciphertext format.
+
+Copyright (c) 2020.
+Author: Erik Buchholz
+Maintainer: Erik Buchholz
+E-mail: buchholz@comsys.rwth-aachen.de
+"""
+import logging
+import sys
+
+from flask import Flask
+
+from lib import config
+from lib.database import db
+from lib.logging import configure_root_loger
+from lib.storage_server_backend import StorageServer
+
+
+def main(data_dir: str = config.DATA_DIR) -> int:
+    """
+    Convert all JSON ciphertexts of the storage DB in data_dir.
+    :param data_dir: Directory where SQLite files are located.
+    :return: Number of converted records
+    """
+    app = Flask(__name__)
+    app.config.from_mapping(
+        SQLALCHEMY_DATABASE_URI=f"sqlite:///{data_dir}/{config.STORAGE_DB}",
+        SQLALCHEMY_TRACK_MODIFICATIONS=False
+    )
+    db.init_app(app)
+    with app.app_context():
+        return StorageServer.convert_ciphertexts()
+
+
+if __name__ == '__main__':  # pragma no cover
+    configure_root_loger(logging.INFO, config.LOG_DIR + "convert_db.log")
+    if len(sys.argv) > 1:
+        num = main(sys.argv[1])
+    else:
+        num = main()
+    print(f"Converted {num} records.")
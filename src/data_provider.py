@@ -7,21 +7,23 @@ Maintainer: Erik Buchholz
 E-mail: buchholz@comsys.rwth-aachen.de
 """
 import argparse
-import json
 import logging
+import multiprocessing as mp
 import os
 import pickle
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.pool import Pool
 from typing import List, Tuple, Iterable
 
 from memory_profiler import memory_usage
 
 import lib.config as config
 from lib.base_client import BaseClient, UserType, ServerType
-from lib.helpers import parse_list, to_base64, print_time
+from lib.helpers import to_base64, print_time, json_length
 from lib.logging import configure_root_loger
-from lib.record import Record
+from lib.record import Record, RecordTable
 
 configure_root_loger(logging.INFO, config.LOG_DIR + "data_provider.log")
 log = logging.getLogger()
@@ -60,18 +62,20 @@ class DataProvider(BaseClient):
             self,
             records: Iterable[Tuple[str, str, str]]) -> None:
         """
-        Store all records in the list on the storage server.
+        Store all records in the list on the storage server. The ciphertext
+        sizes are appended to eval['cx_sizes'].
         :param records: List of records in following form:
         [
-            ('Base64-1', json.dumps(ciphertext1), 'owner1'),
-            ('Base64-2', json.dumps(ciphertext2), 'owner2')
+            ('Base64-1', Base64(ciphertext1), 'owner1'),
+            ('Base64-2', Base64(ciphertext2), 'owner2')
         ]
         :return: Task ID
         """
         r = self.post(f"{self.STORAGESERVER}/batch_store_records",
                       json=records)
-        self.eval['cx_sizes'] = [len(rec[1]) for rec in records]
-        self.eval['json_length'] = len(json.dumps(records))
+        self.eval.setdefault('cx_sizes', []).extend(
+            len(rec[1]) for rec in records)
+        self.eval['json_length'] = json_length(records)
         suc = r.json()['success']
         if suc:
             log.info("Successfully stored requests.")
@@ -79,11 +83,16 @@ class DataProvider(BaseClient):
             msg = r.json()['msg']
             raise RuntimeError(f"Failed to store records: {msg}")
 
-    def store_records(self, records: List[Record]) -> None:
+    def store_records(self, records: List[Record] or RecordTable) -> None:
         """Prepare all records in the list with hashing and encryption and
         store them on the storage server."""
         start = time.monotonic()
         log.debug("Store Records called.")
+        if isinstance(records, RecordTable):
+            table = records
+            records = None
+        else:
+            table = RecordTable([r.record for r in records])
         # 1: Retrieve Hash Key
         log.info("1: Retrieve Hash Key")
 
@@ -96,8 +105,8 @@ class DataProvider(BaseClient):
         # 2: Update hash_keys of record
         log.info("2: Compute Hashes")
 
-        for r in records:
-            r.set_hash_key(hash_key)
+        table.set_hash_key(hash_key)
+        table.get_long_hashes()
 
         self.eval['hash_set_time'] = time.monotonic()
         log.info(f"2: Set Hash Key took: {print_time(time.monotonic()-start)}")
@@ -105,7 +114,7 @@ class DataProvider(BaseClient):
         # 3: Get OT hashes
         log.info("3: Get OT Indizes")
 
-        ot_indices = [r.get_ot_index() for r in records]
+        ot_indices = table.get_ot_indices().tolist()
 
         self.eval['ot_index_time'] = time.monotonic()
         log.info(
@@ -123,17 +132,20 @@ class DataProvider(BaseClient):
         # 5: Encrypt records
         log.info("5: Set encryption keys")
 
-        for i, r in enumerate(records):
-            r.set_encryption_key(enc_keys[i])
-            r.owner = self.user
+        table.set_encryption_keys(enc_keys)
+        table.owner = self.user
+        if records is not None:
+            # Keep given Record objects consistent with the upload
+            for i, r in enumerate(records):
+                r.set_hash_key(hash_key, long_hash=table.get_long_hash(i))
+                r.set_encryption_key(enc_keys[i])
+                r.owner = self.user
 
         self.eval['set_key_time'] = time.monotonic()
         # 6: Create record list
         log.info("6: Create record list [Includes Encryption].")
 
-        record_list = [
-            r.get_upload_format() for r in records
-        ]
+        record_list = table.get_upload_format()
 
         self.eval['encryption_time'] = time.monotonic()
         log.info(
@@ -141,24 +153,123 @@ class DataProvider(BaseClient):
         start = time.monotonic()
         log.info("7: Send encrypted records to server")
 
+        self.eval['cx_sizes'] = []
         self._batch_store_records_on_server(record_list)
 
         self.eval['send_time'] = time.monotonic()
         log.info(f"7: Send encrypted records to server took:"
                  f"{print_time(time.monotonic()-start)}")
 
-    def store_from_file(self, file: str) -> None:
+    def _prepare_upload(self, table: RecordTable, hash_key: bytes,
+                        pool: Pool = None, durations: dict = None
+                        ) -> List[Tuple[str, str, str]]:
+        """
+        Hash, retrieve keys for and encrypt all records of the table.
+        :param table: Records to prepare
+        :param hash_key: Hash key of key server
+        :param pool: [optional] Process pool for the encryption
+        :param durations: [optional] Dict the durations of the steps are
+                          added to, keys are the eval keys of the steps
+        :return: Record list in upload format
+        """
+        if durations is None:
+            durations = {}
+        start = time.monotonic()
+        steps = []
+        table.set_hash_key(hash_key)
+        table.get_long_hashes()
+        steps.append(('hash_set_time', time.monotonic()))
+        ot_indices = table.get_ot_indices().tolist()
+        steps.append(('ot_index_time', time.monotonic()))
+        enc_keys = self._get_enc_keys(ot_indices)
+        steps.append(('key_retrieve_time', time.monotonic()))
+        table.set_encryption_keys(enc_keys)
+        table.owner = self.user
+        steps.append(('set_key_time', time.monotonic()))
+        record_list = table.get_upload_format(pool)
+        steps.append(('encryption_time', time.monotonic()))
+        for key, end in steps:
+            durations[key] = durations.get(key, 0) + end - start
+            start = end
+        return record_list
+
+    def store_stream(self, tables: Iterable[RecordTable]) -> None:
+        """
+        Store records chunk-wise on the storage server. The upload of one
+        chunk is performed in the background while the next chunk is
+        prepared, so at most two chunks are held in memory.
+        The eval times of the steps are those of store_records with the
+        durations summed over all chunks.
+        :param tables: Iterator over chunks of records
+        """
+        start = time.monotonic()
+        start_time = self.eval.get('start_time', start)
+        hash_key = self.get_hash_key()
+        durations = {'hash_key_time': time.monotonic() - start,
+                     'parsed_list_time': 0}
+        num_chunks = 0
+        num_records = 0
+        total_json_length = 0
+        self.eval['cx_sizes'] = []  # Extended by the upload of each chunk
+        # The encryption processes are forked before the upload thread
+        # starts, so that they cannot inherit locks held by it.
+        crypto_pool = mp.Pool(config.MAX_PROCS) if config.PARALLEL else None
+        try:
+            with ThreadPoolExecutor(max_workers=1) as pool:
+                pending = None
+                tables = iter(tables)
+                while True:
+                    parse_start = time.monotonic()
+                    table = next(tables, None)
+                    durations['parsed_list_time'] += \
+                        time.monotonic() - parse_start
+                    if table is None:
+                        break
+                    record_list = self._prepare_upload(
+                        table, hash_key, crypto_pool, durations)
+                    total_json_length += json_length(record_list)
+                    if pending is not None:
+                        pending.result()  # Raise errors and bound memory
+                    pending = pool.submit(
+                        self._batch_store_records_on_server, record_list)
+                    num_chunks += 1
+                    num_records += len(table)
+                    log.info(f"Prepared chunk {num_chunks} "
+                             f"({num_records} records so far).")
+                if pending is not None:
+                    pending.result()
+        finally:
+            if crypto_pool is not None:
+                crypto_pool.close()
+                crypto_pool.join()
+        t = start_time
+        for key in ['parsed_list_time', 'hash_key_time', 'hash_set_time',
+                    'ot_index_time', 'key_retrieve_time', 'set_key_time',
+                    'encryption_time']:
+            t += durations.get(key, 0)
+            self.eval[key] = t
+        self.eval['json_length'] = total_json_length
+        self.eval['stream_chunks'] = num_chunks
+        self.eval['send_time'] = time.monotonic()
+        log.info(f"Streamed {num_records} records in {num_chunks} chunks "
+                 f"took: {print_time(time.monotonic() - start)}")
+
+    def store_from_file(self, file: str, chunk_size: int = None) -> None:
         """
         Return all records from file and store at storage server
         :param file: path to the file containing the records
+        :param chunk_size: [optional] Stream the file in chunks of this many
+                           records, 0 reads the whole file at once
         :return: Task ID of storage command
         """
         self.eval['start_time'] = time.monotonic()
+        if chunk_size is None:
+            chunk_size = config.STREAM_CHUNK_SIZE
+        if chunk_size > 0:
+            self.store_stream(RecordTable.iter_file(file, chunk_size))
+            return
 
-        records = []
-        with open(file, "r") as fd:
-            for line in fd:
-                records.append(Record(parse_list(line)))
+        records = RecordTable.from_file(file)
         self.eval['parsed_list_time'] = time.monotonic()
         log.info(f"Parsed {len(records)} records.")
         self.store_records(records)
@@ -183,6 +294,10 @@ def get_provider_parser() -> argparse.ArgumentParser:
     action_group.add_argument("-a", "--add",
                               help="String representation of record to add.",
                               )
+    dp_parser.add_argument('-c', "--chunk_size", type=int, action="store",
+                           default=config.STREAM_CHUNK_SIZE,
+                           help="Stream file in chunks of this many records "
+                                "(0: load whole file).")
     dp_parser.add_argument('-e', "--eval", help="Eval communication file",
                            type=str, action="store", required=config.EVAL)
     return dp_parser
@@ -232,7 +347,8 @@ if __name__ == '__main__':  # pragma no cover
                         :return: result, error
                         """
                         try:
-                            return dp.store_from_file(args.file), None
+                            return dp.store_from_file(
+                                args.file, args.chunk_size), None
                         except Exception as err:
                             err = str(err)
                             log.exception(err)
@@ -250,7 +366,7 @@ if __name__ == '__main__':  # pragma no cover
                     with open(com_file, "wb") as fd:
                         pickle.dump(dp.eval, fd)
                 else:
-                    dp.store_from_file(args.file)
+                    dp.store_from_file(args.file, args.chunk_size)
                 print("> Successfully stored records on server.")
         elif args.add:
             string = args.add
@@ -19,6 +19,8 @@ from pybloomfilter import BloomFilter
 
 from eval.shared import get_last_line
 from lib import config
+from lib.bloom import (create_bloom_filter, contains_many, encode_key,
+                       IMPLEMENTATIONS)
 from lib.logging import configure_root_loger
 from .shared import lb
 
@@ -34,6 +36,7 @@ QUERY = 0  # range(10 ** 8, 10 ** 9 + 1, 10 ** 8)  # 10 ** 8  # 100.000.000
 QUERY_ALL = False
 RESUME = False
 FILL = False
+COMPARE_QUERY = 10 ** 6  # Queries per filter in compare mode
 # -----------------------------------------------------------------------------
 log = configure_root_loger(logging.INFO, None)
 
@@ -144,10 +147,69 @@ def bloom_full(basename: str):
                                     f"{query_time};{false_positives}\n")
 
 
+def random_digests(n: int) -> numpy.ndarray:
+    """Return n random 64 Byte digests as (n, 64) uint8 array."""
+    return numpy.frombuffer(os.urandom(64 * n),
+                            dtype=numpy.uint8).reshape(n, 64)
+
+
+def bloom_compare(basename: str):
+    """Compare the Bloom filter implementations for record digests."""
+    if basename is None:
+        raise ValueError("No basename given.")
+    file_path = get_file_path("bloom_compare", basename)
+    encoding = config.BLOOM_KEY_ENCODING
+    row_fmt = f"ROUND;IMPLEMENTATION;CAPACITY;ERROR_RATE;" \
+              f"INSERTED ELEMENTS;QUERIED ELEMENTS;SIZE;INSERT TIME;" \
+              f"QUERY TIME;QUERIES PER S;# False Positives"
+    write_header(f"Bloom Compare ({encoding} keys)", file_path, row_fmt)
+    for r in lb(range(ROUNDS_START, ROUNDS_END), "Rounds"):
+        for capacity in lb(CAPACITY, "Capacities", leave=False):
+            for error_rate in lb(ERROR_RATE, "Error Rates", leave=False):
+                insert = capacity if FILL else INSERT
+                real_set = random_digests(insert)
+                # Digests not inserted, every hit is a false positive
+                query_set = random_digests(COMPARE_QUERY)
+                for impl in lb(IMPLEMENTATIONS, "Implementations",
+                               leave=False):
+                    with NamedTemporaryFile() as tmp:
+                        b = create_bloom_filter(capacity, error_rate,
+                                                tmp.name, impl)
+                        start = time.monotonic()
+                        for i in range(0, insert, config.HASH_BATCH_SIZE):
+                            batch = real_set[i:i + config.HASH_BATCH_SIZE]
+                            if impl == 'blocked' and encoding != 'base64':
+                                b.add_many(batch)
+                            else:
+                                b.update(encode_key(h.tobytes(), encoding)
+                                         for h in batch)
+                        b.sync()
+                        insert_time = time.monotonic() - start
+                        size = os.path.getsize(tmp.name)
+                        start = time.monotonic()
+                        false_positives = 0
+                        for i in range(0, COMPARE_QUERY,
+                                       config.HASH_BATCH_SIZE):
+                            false_positives += int(contains_many(
+                                b, query_set[i:i + config.HASH_BATCH_SIZE],
+                                encoding).sum())
+                        query_time = time.monotonic() - start
+                        with open(file_path, "a") as fd:
+                            fd.write(
+                                f"{r};{impl};{capacity};{error_rate};"
+                                f"{insert};{COMPARE_QUERY};{size};"
+                                f"{insert_time};{query_time};"
+                                f"{COMPARE_QUERY / query_time};"
+                                f"{false_positives}\n")
+
+
 if __name__ == '__main__':
     p = argparse.ArgumentParser("Bloom Eval")
     p.add_argument('--resume', help="Resume Eval", action="store_true")
     p.add_argument('--fill', help="Fill up to capacity", action="store_true")
+    p.add_argument('--compare', action="store_true",
+                   help="Compare Bloom filter implementations for record "
+                        "digests (size, FP rate, query throughput)")
     p.add_argument('-r', '--reps', help="Rounds", action='store', default=0,
                    type=int)
     p.add_argument('-c', '--capacity',
@@ -218,4 +280,7 @@ if __name__ == '__main__':
         else:
             raise ValueError("Either 1 or 3 query parameters!")
     filename = args.out + ".csv"
-    bloom_full(filename)
+    if args.compare:
+        bloom_compare(filename)
+    else:
+        bloom_full(filename)
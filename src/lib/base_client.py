@@ -97,16 +97,19 @@ class BaseClient(ABC):
         return self.user, self.get_token(server_type)
 
     def get(self, url: str,
-            auth: Tuple[str, str] or None = None) -> requests.Response:
+            auth: Tuple[str, str] or None = None,
+            **kwargs) -> requests.Response:
         """
         Perform a get request and check result.
         :param url: URL to request
         :param auth: Only if no Token Authentication used.
+        :param kwargs: Further arguments of requests.get, e.g., stream
         :return: Response object.
         """
         if auth is None:
             auth = self.get_auth_data(url)
-        r = requests.get(url, verify=config.TLS_ROOT_CA, auth=auth)
+        r = requests.get(url, verify=config.TLS_ROOT_CA, auth=auth,
+                         **kwargs)
         if r.status_code == 401:
             raise RuntimeError(
                 f"Authentication failed at: {url}.")
@@ -341,9 +344,12 @@ class BaseClient(ABC):
             client_set, host, port, tls, threads: int =
             config.OT_THREADS, root_ca: str = config.TLS_ROOT_CA,
             stat_sec: int = config.OT_STATSECPARAM,
-            scheme: str = config.PSI_SCHEME) -> List[int]:
+            scheme: str = config.PSI_SCHEME,
+            server_set_size: int = None) -> List[int]:
         """
         Perform a PSI with the given client_set
+        :param server_set_size: [optional] Size of the server set,
+                                default: size of the client set
         :return: All items that matches the server_set
         """
         log.debug("Starting PSI.")
@@ -351,6 +357,7 @@ class BaseClient(ABC):
 
         recv.statSecParam = stat_sec
         recv.setSize = len(client_set)
+        recv.sendSetSize = server_set_size or len(client_set)
 
         recv.hostName = host
         recv.port = port
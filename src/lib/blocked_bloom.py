@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+"""Cache-line-blocked Bloom filter with NumPy batch operations.
+
+Copyright (c) 2020.
+Author: Erik Buchholz
+Maintainer: Erik Buchholz
+E-mail: buchholz@comsys.rwth-aachen.de
+"""
+import base64
+import hashlib
+import logging
+import math
+import os
+import struct
+import zlib
+from typing import Iterable, Tuple
+
+import numpy as np
+
+from lib import config
+
+log: logging.Logger = logging.getLogger(__name__)
+
+MAGIC = b'BBF1'
+FORMAT_VERSION = 1
+HEADER_FMT = '<4sHHIQQdQ'  # magic, format, lines, k, blocks, capacity,
+# error rate, seed
+HEADER_SIZE = 64  # Byte, keeps the blocks cache line aligned
+BLOCK_BITS = 512  # One cache line
+BLOCK_BYTES = BLOCK_BITS // 8
+MATERIAL_LEN = 16  # Byte of a key used for hashing
+_GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+_MAX_K = 48
+_POS_PER_DRAW = 4  # 16 bit lanes per 64 bit hash value
+_CHUNK = 2 ** 16  # Keys processed at once
+_BIT_MASKS = (1 << np.arange(8)).astype(np.uint8)
+
+
+def _splitmix(x: np.ndarray) -> np.ndarray:
+    """SplitMix64 finalizer, a bijection on uint64 arrays."""
+    with np.errstate(over='ignore'):
+        x = x + _GOLDEN
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def _line_fp_rates(load: np.ndarray, k: np.ndarray) -> np.ndarray:
+    """
+    False positive rate of one block that receives a Poisson distributed
+    number of insertions.
+    :param load: Expected insertions per block, shape (m,)
+    :param k: Bits set per insertion, shape (m,)
+    :return: False positive rates, shape (m,)
+    """
+    n = int(load.max() + 12 * math.sqrt(load.max()) + 30)
+    i = np.arange(n, dtype=np.float64)
+    log_fact = np.concatenate(([0.0], np.cumsum(np.log(i[1:]))))
+    pmf = np.exp(i[None, :] * np.log(load[:, None]) - load[:, None] -
+                 log_fact[None, :])
+    full = 1 - (1 - 1 / BLOCK_BITS) ** (k[:, None] * i[None, :])
+    return (pmf * full ** k[:, None]).sum(axis=1)
+
+
+def blocked_parameters(capacity: int, error_rate: float,
+                       max_overhead: float = None,
+                       max_lines: int = None) -> Tuple[int, int, int]:
+    """
+    Choose the filter dimensions. Every key sets k bits in each of 'lines'
+    blocks. One block per key is fastest but, due to the uneven load of the
+    blocks, needs much more memory than a standard Bloom filter for small
+    error rates. Therefore, the smallest number of blocks per key whose size
+    is within max_overhead of a standard filter is used.
+    :param capacity: Number of keys
+    :param error_rate: False positive rate at capacity
+    :param max_overhead: [optional] Acceptable size relative to a standard
+                         Bloom filter
+    :param max_lines: [optional] Maximal number of blocks per key
+    :return: (lines, k, number of blocks)
+    """
+    if max_overhead is None:
+        max_overhead = config.BLOOM_BLOCKED_OVERHEAD
+    if max_lines is None:
+        max_lines = config.BLOOM_BLOCKED_MAX_LINES
+    if not 0 < error_rate < 1:
+        raise ValueError("Error rate has to be in (0, 1).")
+    standard = -math.log(error_rate) / math.log(2) ** 2  # Bit per key
+    k = np.arange(1, _MAX_K + 1, dtype=np.float64)
+    best = None
+    for lines in range(1, max_lines + 1):
+        target = error_rate ** (1 / lines)
+        # Bisection of the maximal load per block for all k at once
+        lo = np.full(len(k), 10 ** -4)
+        hi = np.full(len(k), float(BLOCK_BITS))
+        for _ in range(40):
+            mid = (lo + hi) / 2
+            ok = _line_fp_rates(mid, k) <= target
+            lo = np.where(ok, mid, lo)
+            hi = np.where(ok, hi, mid)
+        valid = _line_fp_rates(lo, k) <= target
+        if not valid.any():  # pragma no cover
+            continue
+        j = int(np.argmax(np.where(valid, lo, 0)))
+        bits = BLOCK_BITS * lines / lo[j]
+        if best is None or bits < best[0]:
+            best = (bits, lines, int(k[j]), lo[j])
+        if bits <= max_overhead * standard:
+            break
+    bits, lines, k, load = best
+    blocks = max(1, math.ceil(capacity * lines / load))
+    return lines, k, blocks
+
+
+def _key_material(key) -> bytes:
+    """
+    Return the 16 byte used to hash a key. Raw digests and digest prefixes
+    (16 or 64 byte) are uniformly distributed and used directly, all other
+    keys are hashed first.
+    """
+    if isinstance(key, str):
+        key = key.encode()
+    elif not isinstance(key, (bytes, bytearray)):
+        key = str(key).encode()
+    if len(key) in (MATERIAL_LEN, 64):
+        return bytes(key[:MATERIAL_LEN])
+    return hashlib.blake2b(key, digest_size=MATERIAL_LEN).digest()
+
+
+class BlockedBloomFilter:
+    """
+    Bloom filter in which every key only touches 'lines' cache lines of 512
+    bit. Batch insertion and queries are vectorized with NumPy. The filter
+    is stored in a file consisting of a 64 byte header followed by the
+    blocks, so that it can be memory mapped and delta-synchronized like
+    pybloomfilter files.
+    """
+
+    def __init__(self, capacity: int, error_rate: float,
+                 filename: str = None, seed: int = None) -> None:
+        """
+        Create a new, empty filter.
+        :param capacity: Number of keys
+        :param error_rate: False positive rate at capacity
+        :param filename: [optional] Backing file, in memory if None
+        :param seed: [optional] Hash seed, random if None
+        """
+        lines, k, blocks = blocked_parameters(capacity, error_rate)
+        if seed is None:
+            seed = int.from_bytes(os.urandom(8), 'little')
+        header = struct.pack(HEADER_FMT, MAGIC, FORMAT_VERSION, lines, k,
+                             blocks, capacity, error_rate, seed)
+        header = header.ljust(HEADER_SIZE, b'\0')
+        if filename is not None:
+            with open(filename, 'wb') as fd:
+                fd.write(header)
+                fd.truncate(HEADER_SIZE + blocks * BLOCK_BYTES)
+        self._init(header, filename, 'rw')
+
+    @classmethod
+    def open(cls, filename: str, mode: str = 'rw') -> 'BlockedBloomFilter':
+        """
+        Open an existing filter file.
+        :param filename: Path of filter file
+        :param mode: 'rw' or 'r' for read-only access
+        :return: BlockedBloomFilter
+        """
+        with open(filename, 'rb') as fd:
+            header = fd.read(HEADER_SIZE)
+        b = cls.__new__(cls)
+        b._init(header, filename, mode)
+        return b
+
+    @classmethod
+    def from_base64(cls, filename: str,
+                    data: bytes or str) -> 'BlockedBloomFilter':
+        """
+        Create a filter file from the output of to_base64().
+        :param filename: Path of the new filter file
+        :param data: Base64 encoded, compressed filter
+        :return: BlockedBloomFilter
+        """
+        with open(filename, 'wb') as fd:
+            fd.write(zlib.decompress(base64.b64decode(data)))
+        return cls.open(filename)
+
+    @staticmethod
+    def is_blocked_file(filename: str) -> bool:
+        """Return True if the file contains a BlockedBloomFilter."""
+        with open(filename, 'rb') as fd:
+            return fd.read(len(MAGIC)) == MAGIC
+
+    def _init(self, header: bytes, filename: str or None, mode: str) -> None:
+        """Parse the header and map the blocks."""
+        (magic, fmt, self.lines, self.k, self.num_blocks, self.capacity,
+         self.error_rate, seed) = struct.unpack_from(HEADER_FMT, header)
+        if magic != MAGIC:
+            raise ValueError("Not a blocked Bloom filter file.")
+        if fmt != FORMAT_VERSION:
+            raise ValueError(f"Unsupported filter format: {fmt}")
+        self._header = header
+        self._seed = np.uint64(seed)
+        self.filename = filename
+        self.read_only = mode == 'r'
+        shape = (self.num_blocks * BLOCK_BYTES,)
+        if filename is None:
+            self._data = np.zeros(shape, dtype=np.uint8)
+        else:
+            self._data = np.memmap(filename, dtype=np.uint8,
+                                   mode='r' if self.read_only else 'r+',
+                                   offset=HEADER_SIZE, shape=shape)
+
+    def __repr__(self) -> str:
+        return (f"<BlockedBloomFilter capacity: {self.capacity}, error: "
+                f"{self.error_rate:.3g}, lines: {self.lines}, k: {self.k}>")
+
+    @property
+    def num_hashes(self) -> int:
+        """Number of bits set per key."""
+        return self.lines * self.k
+
+    @property
+    def num_bits(self) -> int:
+        """Size of the bit array."""
+        return self.num_blocks * BLOCK_BITS
+
+    def _state(self, material: np.ndarray) -> np.ndarray:
+        """
+        Return the seeded 64 bit hash of each key.
+        :param material: Keys as uint8 array of shape (n, >= 16)
+        :return: uint64 array of shape (n,)
+        """
+        words = np.ascontiguousarray(material[:, :MATERIAL_LEN]).view('<u8')
+        return _splitmix(words[:, 0] ^ self._seed) ^ \
+            _splitmix(words[:, 1] ^ ~self._seed)
+
+    def _positions(self, state: np.ndarray, line: int
+                   ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Return the byte offsets and bit masks of the bits of the given line
+        of each key.
+        :param state: Hashes of the keys, see _state()
+        :param line: Line index < self.lines
+        :return: (byte offsets (n, k), masks (n, k))
+        """
+        # Each 64 bit draw yields 4 independent positions taken from the low
+        # 9 bit of its 16 bit lanes. (Double hashing is not used: in a 512
+        # bit block, the bit patterns of many keys would only be shifted
+        # copies.)
+        draws = -(-self.k // _POS_PER_DRAW)
+        counter = np.arange(line * (draws + 1), (line + 1) * (draws + 1),
+                            dtype=np.uint64)
+        with np.errstate(over='ignore'):
+            h = _splitmix(state[:, None] + counter[None, :]).astype('<u8')
+        blocks = (h[:, 0] % np.uint64(self.num_blocks)).astype(np.intp)
+        pos = np.ascontiguousarray(h[:, 1:]).view('<u2')[:, :self.k] & \
+            np.uint16(BLOCK_BITS - 1)
+        offsets = blocks[:, None] * BLOCK_BYTES + (pos >> np.uint16(3))
+        return offsets, _BIT_MASKS[pos & np.uint16(7)]
+
+    def word_indices(self, keys: Iterable, word_size: int) -> np.ndarray:
+        """
+        Return the indices of the words of the filter file that inserting
+        the keys can change, the header included.
+        :param keys: Keys (str, bytes or numbers)
+        :param word_size: Byte per word
+        :return: Sorted word indices
+        """
+        material = self._material(keys)
+        words = [np.empty(0, dtype=np.intp)]
+        for start in range(0, len(material), _CHUNK):
+            state = self._state(material[start:start + _CHUNK])
+            for line in range(self.lines):
+                offsets, _ = self._positions(state, line)
+                words.append((offsets.reshape(-1) + HEADER_SIZE) //
+                             word_size)
+        return np.unique(np.concatenate(words))
+
+    def add_many(self, material: np.ndarray) -> None:
+        """
+        Insert keys given as array of digests or digest prefixes.
+        :param material: uint8 array of shape (n, 16) or (n, 64)
+        """
+        if self.read_only:
+            raise ValueError("Write operation on read-only filter.")
+        for start in range(0, len(material), _CHUNK):
+            state = self._state(material[start:start + _CHUNK])
+            for line in range(self.lines):
+                offsets, masks = self._positions(state, line)
+                np.bitwise_or.at(self._data, offsets.reshape(-1),
+                                 masks.reshape(-1))
+
+    def contains_many(self, material: np.ndarray) -> np.ndarray:
+        """
+        Query keys given as array of digests or digest prefixes.
+        :param material: uint8 array of shape (n, 16) or (n, 64)
+        :return: Boolean array of length n
+        """
+        if len(material) > _CHUNK:
+            return np.concatenate([
+                self.contains_many(material[start:start + _CHUNK])
+                for start in range(0, len(material), _CHUNK)])
+        result = np.zeros(len(material), dtype=bool)
+        remaining = np.arange(len(material))
+        state = self._state(material)
+        for line in range(self.lines):
+            # Only keys found in all previous blocks are checked further
+            offsets, masks = self._positions(state, line)
+            found = (self._data[offsets] & masks == masks).all(axis=1)
+            remaining = remaining[found]
+            state = state[found]
+            if remaining.size == 0:
+                return result
+        result[remaining] = True
+        return result
+
+    @staticmethod
+    def _material(keys: Iterable) -> np.ndarray:
+        """Return hash material of arbitrary keys as (n, 16) array."""
+        data = b''.join(_key_material(k) for k in keys)
+        return np.frombuffer(data, dtype=np.uint8).reshape(-1, MATERIAL_LEN)
+
+    def add(self, key) -> None:
+        """Insert one key (str, bytes or number)."""
+        self.add_many(self._material([key]))
+
+    def update(self, keys: Iterable) -> None:
+        """Insert several keys (str, bytes or numbers)."""
+        self.add_many(self._material(keys))
+
+    def __contains__(self, key) -> bool:
+        return bool(self.contains_many(self._material([key]))[0])
+
+    def clear_all(self) -> None:
+        """Remove all keys, the hash seed is kept."""
+        if self.read_only:
+            raise ValueError("Write operation on read-only filter.")
+        self._data[:] = 0
+
+    def sync(self) -> None:
+        """Write changes to the backing file."""
+        if isinstance(self._data, np.memmap) and not self.read_only:
+            self._data.flush()
+
+    def to_base64(self) -> bytes:
+        """Return the compressed filter file as Base64."""
+        self.sync()
+        return base64.b64encode(zlib.compress(
+            self._header + self._data.tobytes()))
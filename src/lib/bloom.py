@@ -0,0 +1,483 @@
+#!/usr/bin/env python3
+"""Versioning, delta synchronization, key encoding and implementation
+selection of Bloom filter files.
+
+Copyright (c) 2020.
+Author: Erik Buchholz
+Maintainer: Erik Buchholz
+E-mail: buchholz@comsys.rwth-aachen.de
+"""
+import fcntl
+import json
+import logging
+import os
+import shutil
+import tempfile
+import zlib
+from contextlib import contextmanager
+from typing import Tuple
+
+import numpy as np
+from pybloomfilter import BloomFilter
+
+from lib import config
+from lib.blocked_bloom import BlockedBloomFilter
+from lib.helpers import to_base64
+
+try:
+    import zstandard
+except ImportError:  # pragma no cover
+    zstandard = None
+
+log: logging.Logger = logging.getLogger(__name__)
+
+WORD_SIZE = 8  # Byte per word of a delta
+WORD_DTYPE = np.dtype('<u8')
+COMPRESSIONS = ('none', 'zlib', 'zstd')
+# Keys inserted for a record's long hash: Base64 string (filters created
+# before key encodings were introduced), raw digest or its 128 bit prefix.
+KEY_ENCODINGS = ('base64', 'digest', 'prefix')
+LEGACY_KEY_ENCODING = 'base64'
+KEY_PREFIX_LEN = 16  # Byte
+IMPLEMENTATIONS = ('pybloomfilter', 'blocked')
+
+
+class BloomChangeLog:
+    """
+    Version counter and change log of a Bloom filter file. Writers state
+    the words a modification can change (see key_words), otherwise changes
+    are detected by comparing the file word-wise with a shadow copy of the
+    last version. The deltas store the changed words together with their
+    values, so versions can be served without reading the filter file. All
+    state is stored next to the filter file so that the web server and the
+    celery workers share it.
+    """
+
+    def __init__(self, bloom_file: str, history: int = None) -> None:
+        """
+        :param bloom_file: Path of the Bloom filter file
+        :param history: [optional] Number of versions deltas are kept for
+        """
+        if history is None:
+            history = config.BLOOM_DELTA_HISTORY
+        self.bloom_file = bloom_file
+        self.shadow_file = bloom_file + '.shadow'
+        self.meta_file = bloom_file + '.version'
+        self.delta_dir = bloom_file + '.delta/'
+        self.lock_file = bloom_file + '.lock'
+        self.history = history
+
+    def _load_meta(self) -> dict:
+        """
+        Return version information. Deltas are available from all versions
+        between 'first' and 'version', 'size' is the size of the filter file
+        they apply to.
+        """
+        if not os.path.exists(self.meta_file):
+            return {'version': 0, 'first': 0}
+        with open(self.meta_file, 'r') as fd:
+            meta = json.load(fd)
+        if 'size' not in meta and os.path.exists(self.shadow_file):
+            # Written before the size was stored
+            meta['size'] = os.path.getsize(self.shadow_file)
+        return meta
+
+    def _store_meta(self, meta: dict) -> None:
+        """Replace version information atomically."""
+        fd, tmp = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self.meta_file)),
+            prefix=os.path.basename(self.meta_file), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(meta, f)
+            os.replace(tmp, self.meta_file)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    @contextmanager
+    def lock(self, shared: bool = False):
+        """
+        Serialize commits of concurrent processes. While held, the version
+        and the deltas do not change, and neither does the filter file if
+        all writers use modify().
+        :param shared: [optional] Only read, other readers are not blocked
+        """
+        with open(self.lock_file, 'w') as fd:
+            fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+    @property
+    def version(self) -> int:
+        """Current version of the filter."""
+        return self._load_meta()['version']
+
+    @property
+    def encoding(self) -> str:
+        """Key encoding of the filter, see KEY_ENCODINGS."""
+        return self._load_meta().get('encoding', LEGACY_KEY_ENCODING)
+
+    @property
+    def committed_file(self) -> str:
+        """
+        Path of a file with the content of the current version while the
+        lock is held: the shadow copy if changes are detected with it,
+        otherwise the filter file itself.
+        """
+        if os.path.exists(self.shadow_file):
+            return self.shadow_file
+        return self.bloom_file
+
+    def _diff(self) -> np.ndarray:
+        """
+        Return the indices of all words that differ between filter and
+        shadow copy and update the shadow copy.
+        :return: Sorted word indices
+        """
+        size = os.path.getsize(self.bloom_file)
+        live = np.memmap(self.bloom_file, dtype=np.uint8, mode='r')
+        shadow = np.memmap(self.shadow_file, dtype=np.uint8, mode='r+')
+        # Chunks are word aligned, so no word is contained in two chunks
+        chunk = config.BLOOM_DIFF_CHUNK // WORD_SIZE * WORD_SIZE
+        words = []
+        for start in range(0, size, chunk):
+            a = live[start:start + chunk]
+            b = shadow[start:start + chunk]
+            changed = np.flatnonzero(a != b)
+            if changed.size > 0:
+                b[changed] = a[changed]
+                words.append(np.unique((changed + start) // WORD_SIZE))
+        shadow.flush()
+        if not words:
+            return np.empty(0, dtype=WORD_DTYPE)
+        return np.concatenate(words).astype(WORD_DTYPE)
+
+    def commit(self, encoding: str = None) -> int:
+        """
+        Register the current content of the filter file as new version if
+        it changed since the last commit. Changes are detected with the
+        shadow copy.
+        :param encoding: [optional] New key encoding of the filter, stored
+                         together with the version it applies to
+        :return: Current version
+        """
+        with self.lock():
+            return self._commit(encoding)
+
+    @contextmanager
+    def modify(self, words: np.ndarray = None, encoding: str = None):
+        """
+        Hold the lock while the filter file is modified and commit the
+        result afterwards.
+        :param words: [optional] Indices of all words the modification can
+                      change. If not given, the filter is compared with the
+                      shadow copy.
+        :param encoding: [optional] New key encoding, see commit()
+        """
+        with self.lock():
+            before = None
+            if words is not None and os.path.exists(self.bloom_file):
+                words = np.asarray(words, dtype=WORD_DTYPE)
+                before = read_words(self.bloom_file, words)
+            yield
+            self._commit(encoding, words, before)
+
+    def _commit(self, encoding: str = None, words: np.ndarray = None,
+                before: np.ndarray = None) -> int:
+        """
+        Commit while holding the lock, see commit() and modify().
+        :param words: [optional] Words the modification could change
+        :param before: [optional] Their values before the modification
+        """
+        meta = self._load_meta()
+        recoded = encoding is not None and encoding != meta.get('encoding')
+        if recoded:
+            check_key_encoding(encoding)
+            meta['encoding'] = encoding
+        if not os.path.exists(self.bloom_file) or \
+                os.path.getsize(self.bloom_file) == 0:
+            if recoded:
+                self._store_meta(meta)
+            return meta['version']
+        size = os.path.getsize(self.bloom_file)
+        tracked = before is not None
+        if tracked and os.path.exists(self.shadow_file):
+            # The changed words are known, the copy would be outdated
+            os.remove(self.shadow_file)
+        if meta['version'] == 0 or meta.get('size') != size or \
+                not tracked and not os.path.exists(self.shadow_file):
+            # No comparable previous version, no deltas possible
+            if not tracked:
+                shutil.copyfile(self.bloom_file, self.shadow_file)
+            shutil.rmtree(self.delta_dir, ignore_errors=True)
+            meta['version'] += 1
+            meta['first'] = meta['version']
+            meta['size'] = size
+            self._store_meta(meta)
+            log.info(f"Bloom filter version {meta['version']} (new).")
+            return meta['version']
+        if tracked:
+            values = read_words(self.bloom_file, words)
+            changed = values != before
+            words, values = words[changed], values[changed]
+        else:
+            words = self._diff()
+            values = read_words(self.shadow_file, words)
+        if words.size == 0:
+            if recoded:
+                self._store_meta(meta)
+            return meta['version']
+        meta['version'] += 1
+        os.makedirs(self.delta_dir, exist_ok=True)
+        np.save(f"{self.delta_dir}{meta['version']}.npy",
+                np.stack([words, values]))
+        first = max(meta['first'], meta['version'] - self.history)
+        for v in range(meta['first'] + 1, first + 1):
+            try:
+                os.remove(f"{self.delta_dir}{v}.npy")
+            except FileNotFoundError:  # pragma no cover
+                pass
+        meta['first'] = first
+        self._store_meta(meta)
+        log.info(f"Bloom filter version {meta['version']}: "
+                 f"{words.size} words changed.")
+        return meta['version']
+
+    def delta(self, since: int) -> Tuple[int, np.ndarray, np.ndarray] or None:
+        """
+        Return the words that changed after the given version.
+        :param since: Version the requester has
+        :return: (current version, word indices, word values) or None if
+                 the changes are unknown or transferring them is not cheaper
+                 than transferring the whole filter
+        """
+        with self.lock(shared=True):
+            meta = self._load_meta()
+            if not meta['first'] <= since <= meta['version']:
+                return None
+            parts = [np.load(f"{self.delta_dir}{v}.npy")
+                     for v in range(since + 1, meta['version'] + 1)]
+        if any(p.ndim != 2 for p in parts):
+            return None  # Stored without values
+        if not parts:
+            return (meta['version'], np.empty(0, dtype=WORD_DTYPE),
+                    np.empty(0, dtype=WORD_DTYPE))
+        # Later versions overwrite the values of earlier ones
+        merged = np.concatenate(parts[::-1], axis=1)
+        words, first = np.unique(merged[0], return_index=True)
+        if words.size * 2 * WORD_SIZE >= meta.get('size', 0):
+            return None
+        return (meta['version'], words.astype(WORD_DTYPE),
+                merged[1][first].astype(WORD_DTYPE))
+
+
+def key_words(b, keys: list) -> np.ndarray or None:
+    """
+    Return the indices of the words of the filter file that inserting the
+    keys can change.
+    :param b: Bloom filter
+    :param keys: Keys to insert
+    :return: Sorted word indices or None if the implementation does not
+             expose the positions of keys (pybloomfilter)
+    """
+    if isinstance(b, BlockedBloomFilter):
+        return b.word_indices(keys, WORD_SIZE).astype(WORD_DTYPE)
+    return None
+
+
+def read_words(path: str, words: np.ndarray) -> np.ndarray:
+    """
+    Read the given words of a file. The last word is zero padded.
+    :param path: Path of file
+    :param words: Word indices
+    :return: Word values
+    """
+    data = np.memmap(path, dtype=np.uint8, mode='r')
+    full = data.size // WORD_SIZE
+    values = np.zeros(len(words), dtype=WORD_DTYPE)
+    mask = words < full
+    values[mask] = data[:full * WORD_SIZE].view(WORD_DTYPE)[words[mask]]
+    for i in np.flatnonzero(~mask):
+        tail = bytes(data[int(words[i]) * WORD_SIZE:])
+        values[i] = int.from_bytes(tail, 'little')
+    return values
+
+
+def apply_delta(path: str, words: np.ndarray, values: np.ndarray) -> None:
+    """
+    Write the given words into a file in place.
+    :param path: Path of file
+    :param words: Word indices
+    :param values: Word values
+    """
+    if len(words) == 0:
+        return
+    data = np.memmap(path, dtype=np.uint8, mode='r+')
+    full = data.size // WORD_SIZE
+    mask = words < full
+    data[:full * WORD_SIZE].view(WORD_DTYPE)[words[mask]] = values[mask]
+    for i in np.flatnonzero(~mask):
+        tail = data[int(words[i]) * WORD_SIZE:]
+        tail[:] = np.frombuffer(
+            int(values[i]).to_bytes(WORD_SIZE, 'little'),
+            dtype=np.uint8)[:tail.size]
+    data.flush()
+
+
+def check_compression(method: str) -> None:
+    """
+    Raise a ValueError if the compression method is not available.
+    :param method: One of COMPRESSIONS
+    """
+    if method not in COMPRESSIONS:
+        raise ValueError(f"Unknown compression: {method}")
+    if method == 'zstd' and zstandard is None:
+        raise ValueError("zstd compression requires the zstandard package.")
+
+
+def compress_file(src: str, dst: str, method: str,
+                  chunk_size: int = None) -> None:
+    """
+    Compress a file chunk-wise. The destination is replaced atomically.
+    :param src: Path of input file
+    :param dst: Path of compressed file
+    :param method: One of COMPRESSIONS, 'none' copies the file
+    :param chunk_size: [optional] Byte read at once
+    """
+    check_compression(method)
+    if chunk_size is None:
+        chunk_size = config.BLOOM_CHUNK_SIZE
+    if method == 'zlib':
+        c = zlib.compressobj()
+    elif method == 'zstd':
+        c = zstandard.ZstdCompressor().compressobj()
+    else:
+        c = None
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(dst)),
+                               prefix=os.path.basename(dst), suffix='.tmp')
+    try:
+        with open(src, 'rb') as fin, os.fdopen(fd, 'wb') as fout:
+            chunk = fin.read(chunk_size)
+            while chunk:
+                fout.write(chunk if c is None else c.compress(chunk))
+                chunk = fin.read(chunk_size)
+            if c is not None:
+                fout.write(c.flush())
+        os.replace(tmp, dst)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def get_decompressor(method: str):
+    """
+    Return a streaming decompressor providing decompress(chunk) and
+    flush().
+    :param method: One of COMPRESSIONS
+    :return: Decompressor or None for 'none'
+    """
+    check_compression(method)
+    if method == 'zlib':
+        return zlib.decompressobj()
+    elif method == 'zstd':
+        return zstandard.ZstdDecompressor().decompressobj()
+    return None
+
+
+def check_key_encoding(encoding: str) -> None:
+    """
+    Raise a ValueError if the key encoding is unknown.
+    :param encoding: One of KEY_ENCODINGS
+    """
+    if encoding not in KEY_ENCODINGS:
+        raise ValueError(f"Unknown Bloom key encoding: {encoding}")
+
+
+def encode_key(long_hash: bytes, encoding: str) -> str or bytes:
+    """
+    Return the Bloom filter key of a record.
+    :param long_hash: Long hash of the record
+    :param encoding: One of KEY_ENCODINGS
+    :return: Key to insert into or query from the filter
+    """
+    if encoding == 'base64':
+        return to_base64(long_hash)
+    elif encoding == 'digest':
+        return long_hash
+    elif encoding == 'prefix':
+        return long_hash[:KEY_PREFIX_LEN]
+    raise ValueError(f"Unknown Bloom key encoding: {encoding}")
+
+
+def contains_many(b, digests: np.ndarray, encoding: str) -> np.ndarray:
+    """
+    Check which of the given long hashes are contained in the filter.
+    :param b: Bloom filter
+    :param digests: Long hashes as array of shape (n, 64) and dtype uint8
+    :param encoding: Key encoding of the filter, see KEY_ENCODINGS
+    :return: Boolean array of length n
+    """
+    n = len(digests)
+    if n == 0:
+        return np.zeros(0, dtype=bool)
+    if isinstance(b, BlockedBloomFilter) and encoding != 'base64':
+        check_key_encoding(encoding)
+        return b.contains_many(digests)
+    if encoding == 'base64':
+        return np.fromiter((to_base64(h.tobytes()) in b for h in digests),
+                           dtype=bool, count=n)
+    check_key_encoding(encoding)
+    if encoding == 'prefix':
+        digests = digests[:, :KEY_PREFIX_LEN]
+    # Slicing one bytes object avoids an array view per key
+    width = digests.shape[1]
+    data = np.ascontiguousarray(digests).tobytes()
+    return np.fromiter((data[i:i + width] in b
+                        for i in range(0, n * width, width)),
+                       dtype=bool, count=n)
+
+
+def create_bloom_filter(capacity: int, error_rate: float, filename: str,
+                        implementation: str = None
+                        ) -> BloomFilter or BlockedBloomFilter:
+    """
+    Create a new, empty Bloom filter file.
+    :param capacity: Number of keys
+    :param error_rate: False positive rate at capacity
+    :param filename: Path of filter file
+    :param implementation: [optional] One of IMPLEMENTATIONS, default:
+                           config.BLOOM_IMPLEMENTATION
+    :return: Bloom filter
+    """
+    if implementation is None:
+        implementation = config.BLOOM_IMPLEMENTATION
+    if implementation == 'pybloomfilter':
+        return BloomFilter(capacity, error_rate, filename)
+    elif implementation == 'blocked':
+        return BlockedBloomFilter(capacity, error_rate, filename)
+    raise ValueError(f"Unknown Bloom filter implementation: {implementation}")
+
+
+def open_bloom_filter(filename: str,
+                      mode: str = 'rw') -> BloomFilter or BlockedBloomFilter:
+    """
+    Open a Bloom filter file of any implementation.
+    :param filename: Path of filter file
+    :param mode: 'rw' or 'r' for read-only access
+    :return: Bloom filter
+    """
+    if BlockedBloomFilter.is_blocked_file(filename):
+        return BlockedBloomFilter.open(filename, mode)
+    return BloomFilter.open(filename, mode)
+
+
+def get_implementation(b: BloomFilter or BlockedBloomFilter) -> str:
+    """Return the name of the implementation of a Bloom filter."""
+    if isinstance(b, BlockedBloomFilter):
+        return 'blocked'
+    return 'pybloomfilter'
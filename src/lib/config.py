@@ -75,6 +75,16 @@ else:  # pragma no cover
     BLOOM_CAPACITY = 10 ** 5
     BLOOM_ERROR_RATE = 10 ** -8
 STORAGE_CELERY_BROKER_URL = f'redis://localhost:{STORAGE_REDIS_PORT}/0'
+BLOOM_DELTA_HISTORY = 1000  # Versions for which filter deltas are kept
+BLOOM_DIFF_CHUNK = 2 ** 26  # Byte compared at once to detect filter changes
+BLOOM_CACHE = True  # Client keeps a local filter copy and fetches deltas
+BLOOM_CACHE_FILE = 'client.bloom'
+BLOOM_COMPRESSION = 'zlib'  # Filter transfer: 'none', 'zlib' or 'zstd'
+BLOOM_CHUNK_SIZE = 2 ** 20  # Byte per chunk of a streamed filter transfer
+BLOOM_KEY_ENCODING = 'prefix'  # Keys of new filters: base64, digest, prefix
+BLOOM_IMPLEMENTATION = 'pybloomfilter'  # Of new filters, or 'blocked'
+BLOOM_BLOCKED_OVERHEAD = 1.25  # Max. size of blocked vs. standard filter
+BLOOM_BLOCKED_MAX_LINES = 8  # Max. cache lines per key of blocked filter
 # -----------------------------------------------------------------------------
 # OT Parameters ---------------------------------------------------------------
 OT_SETSIZE = 2**20
@@ -91,6 +101,8 @@ OT_MAX_NUM = 10  # Maximal number of simultaneous OTs
 # PSI Parameters ---------------------------------------------------------------
 PSI_SCHEME = "KKRT16"
 PSI_SETSIZE = 2**20
+# Client sets are only padded to the next power of two >= this (size class)
+PSI_CLIENT_MIN_SETSIZE = 2**10
 PSI_THREADS = 1
 PSI_STATSECPARAM = 40
 PSI_MAL_SECURE = False
@@ -98,16 +110,45 @@ PSI_INPUT_BIT_COUNT = 128
 PSI_PORT = 1214
 PSI_HOST = "127.0.0.1"
 PSI_TLS = False
+PSI_SET_FILE = 'storage_psi_set.npy'  # Padded server set in data dir
+# Concurrent PSI sessions if the server set is split into buckets. With 1,
+# all buckets are performed one after another on a single port.
+PSI_BUCKET_SESSIONS = 1
+# Pre-initialized PSI sender processes of the storage server, 0: Start a
+# celery task on a random port per PSI instead
+PSI_POOL_SIZE = 0
+# Sessions of the pool still running after this time in s are killed
+PSI_POOL_SESSION_TIMEOUT = 3600
 # -----------------------------------------------------------------------------
 # KEY SETTINGS-----------------------------------------------------------------
 HASHKEY_LEN = 128
 ENCKEY_LEN = 128
+BINARY_CIPHERTEXT = True  # Upload records in binary instead of JSON format
+CRYPTO_CHUNK_SIZE = 5000  # Records en-/decrypted per process pool task
+STREAM_CHUNK_SIZE = 0  # Records per provider upload chunk, 0: no streaming
 # -----------------------------------------------------------------------------
 # HASH SETTINGS----------------------------------------------------------------
 PSI_INDEX_LEN = 127  # Bit (127 so that we can use the remainder for dummies)
 PSI_DUMMY_START_SERVER = 2 ** 127
 PSI_DUMMY_START_CLIENT = 2 ** 127 + PSI_SETSIZE
 OT_INDEX_LEN = 20  # in Bit
+HASH_BATCH_SIZE = 10000  # Candidates hashed together by a RecordBatch
+MATCHING_POOL_SIZE = 0  # Bloom matching processes, 0: CPU count
+MATCHING_POOL_SHARDS = 4  # Rank ranges per matching process and query
+HASH_CACHE = False  # Persist candidate hashes between client queries
+HASH_CACHE_FILE = 'hash_cache.sqlite'
+HASH_CACHE_SIZE = 10000000  # Maximal number of cached hashes (LRU)
+INCREMENTAL_QUERIES = False  # Only match candidates new since last query
+QUERY_STATE_FILE = 'query_state_{}.pickle'  # Per user, last query & matches
+# -----------------------------------------------------------------------------
+# PLANNER SETTINGS-------------------------------------------------------------
+PLANNER_CALIBRATION_FILE = 'planner_calibration.json'
+# Choose Bloom or PSI mode per query. With EVAL, the configured modes are
+# used and the plan is only logged and stored in the eval results.
+PLANNER_AUTO_MODE = False
+PLANNER_COST_BUDGET = 3600  # Maximal estimated cost of a query in s
+PLANNER_EXPECTED_MATCHES = 10  # Assumed number of real matches per query
+PLANNER_BLOOM_NEW_RECORDS = 1000  # Assumed new records since cached filter
 # -----------------------------------------------------------------------------
 # DISCRETIZATION SETTINGS------------------------------------------------------
 RECORD_ID_LENGTH = 10
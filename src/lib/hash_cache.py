@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""Persistent cache mapping rounded record identifiers to long hashes.
+
+Copyright (c) 2020.
+Author: Erik Buchholz
+Maintainer: Erik Buchholz
+E-mail: buchholz@comsys.rwth-aachen.de
+"""
+import hashlib
+import logging
+import os
+import sqlite3
+from typing import List, Iterable, Tuple
+
+from lib import config
+
+log: logging.Logger = logging.getLogger(__name__)
+
+# SQLite limits the number of variables per statement
+_MAX_VARS = 500
+
+
+class HashCache:
+    """
+    SQLite backed cache for (hash key, identifier) -> long hash with
+    size-bounded LRU eviction. Entries are bound to the fingerprint of the
+    hash key they were computed with, so processes using different keys
+    never see each other's hashes. Entries of other keys are dropped when
+    a cache is opened because the key server's key has changed.
+    """
+
+    def __init__(self, hash_key: bytes, path: str = None,
+                 max_entries: int = None) -> None:
+        """
+        Open (or create) the cache for the given hash key.
+        :param hash_key: Hash key of the key server
+        :param path: [optional] Path of the SQLite file
+        :param max_entries: [optional] Maximal number of cached hashes
+        """
+        if path is None:
+            path = config.DATA_DIR + config.HASH_CACHE_FILE
+        if max_entries is None:
+            max_entries = config.HASH_CACHE_SIZE
+        self.path = path
+        self.max_entries = max_entries
+        self.fingerprint = hashlib.sha3_256(hash_key).hexdigest()
+        self.hits = 0
+        self.misses = 0
+        self._conn = None
+        self._pid = None
+        self._init_db()
+
+    def _get_conn(self) -> sqlite3.Connection:
+        """Return connection, reopen in forked child processes."""
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=60)
+            # Parallel matching processes read while others write
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._pid = os.getpid()
+        return self._conn
+
+    def _init_db(self) -> None:
+        """Create tables and drop entries of other hash keys."""
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)),
+                    exist_ok=True)
+        conn = self._get_conn()
+        with conn:
+            columns = [row[1] for row in
+                       conn.execute("PRAGMA table_info(hashes)")]
+            if columns and 'fingerprint' not in columns:
+                log.info("Dropping hash cache without key binding.")
+                conn.execute("DROP TABLE hashes")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta "
+                         "(key TEXT PRIMARY KEY, value TEXT)")
+            conn.execute("CREATE TABLE IF NOT EXISTS hashes "
+                         "(fingerprint TEXT, identifier BLOB, hash BLOB, "
+                         "last_used INTEGER, "
+                         "PRIMARY KEY (fingerprint, identifier))")
+            conn.execute("CREATE INDEX IF NOT EXISTS lru "
+                         "ON hashes (last_used)")
+            conn.execute("INSERT OR IGNORE INTO meta VALUES "
+                         "('generation', '0')")
+            if conn.execute("DELETE FROM hashes WHERE fingerprint != ?",
+                            (self.fingerprint,)).rowcount:
+                log.info("Hash key changed, dropped hashes of old key.")
+
+    def _next_generation(self, conn: sqlite3.Connection) -> int:
+        """Return the next LRU time stamp."""
+        conn.execute("UPDATE meta SET value = CAST(value AS INTEGER) + 1 "
+                     "WHERE key = 'generation'")
+        return int(conn.execute("SELECT value FROM meta WHERE key = "
+                                "'generation'").fetchone()[0])
+
+    def lookup(self, identifiers: List[bytes]) -> List[bytes or None]:
+        """
+        Return the cached long hashes for the given identifiers.
+        :param identifiers: Rounded identifiers as used for hashing
+        :return: Long hash for each identifier or None if not cached
+        """
+        found = {}
+        conn = self._get_conn()
+        with conn:
+            gen = self._next_generation(conn)
+            for i in range(0, len(identifiers), _MAX_VARS):
+                part = identifiers[i:i + _MAX_VARS]
+                marks = ",".join("?" * len(part))
+                found.update(conn.execute(
+                    f"SELECT identifier, hash FROM hashes "
+                    f"WHERE fingerprint = ? AND identifier IN ({marks})",
+                    [self.fingerprint] + part).fetchall())
+                conn.execute(
+                    f"UPDATE hashes SET last_used = ? "
+                    f"WHERE fingerprint = ? AND identifier IN ({marks})",
+                    [gen, self.fingerprint] + part)
+        result = [found.get(i) for i in identifiers]
+        hits = len(identifiers) - result.count(None)
+        self.hits += hits
+        self.misses += len(identifiers) - hits
+        return result
+
+    def store(self, pairs: Iterable[Tuple[bytes, bytes]]) -> None:
+        """
+        Add the given (identifier, long hash) pairs and evict the least
+        recently used entries if the cache is full.
+        :param pairs: Iterable of (identifier, long hash)
+        """
+        conn = self._get_conn()
+        with conn:
+            gen = self._next_generation(conn)
+            conn.executemany(
+                "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?)",
+                ((self.fingerprint, i, h, gen) for i, h in pairs))
+            size = conn.execute("SELECT COUNT(*) FROM hashes").fetchone()[0]
+            if size > self.max_entries:
+                # Entries of all keys share the size bound
+                conn.execute(
+                    "DELETE FROM hashes WHERE rowid IN "
+                    "(SELECT rowid FROM hashes ORDER BY last_used "
+                    "LIMIT ?)", (size - self.max_entries,))
+
+    def __len__(self) -> int:
+        return self._get_conn().execute(
+            "SELECT COUNT(*) FROM hashes WHERE fingerprint = ?",
+            (self.fingerprint,)).fetchone()[0]
+
+    def clear(self) -> None:
+        """Remove all cached hashes of the hash key."""
+        conn = self._get_conn()
+        with conn:
+            conn.execute("DELETE FROM hashes WHERE fingerprint = ?",
+                         (self.fingerprint,))
+
+    def __getstate__(self) -> dict:
+        # Connections cannot be pickled, reopen on demand
+        state = self.__dict__.copy()
+        state['_conn'] = None
+        state['_pid'] = None
+        return state
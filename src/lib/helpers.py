@@ -7,6 +7,7 @@ Maintainer: Erik Buchholz
 E-mail: buchholz@comsys.rwth-aachen.de
 """
 import base64
+import json
 import logging
 import multiprocessing
 import os
@@ -23,10 +24,15 @@ from contextlib import contextmanager
 from io import StringIO
 from typing import List, Tuple
 
+import numpy as np
+
 import lib.config as config
 
 log: logging.Logger = logging.getLogger(__name__)
 
+BINARY_RECORD_EXT = '.npy'  # Binary record files are stored as NumPy arrays
+_LIST_CHARS = str.maketrans('[]\n', '   ')
+
 
 def get_temp_file() -> str:
     """Generate random tempfile and create directory if not exits."""
@@ -297,6 +303,87 @@ def parse_list(string: str) -> List[float]:
     return r_list
 
 
+def parse_lists(lines: List[str]) -> np.ndarray:
+    """
+    Vectorized version of parse_list for many lines yielding exactly the
+    same floats.
+    :param lines: String lists, one record per line, empty lines are skipped
+    :return: 2-D float64 array with one row per record
+    """
+    lines = [line for line in lines if line.strip()]
+    if not lines:
+        return np.empty((0, 0), dtype=np.float64)
+    width = lines[0].count(',') + 1
+    text = ",".join(lines).translate(_LIST_CHARS)
+    try:
+        values = np.fromstring(text, dtype=np.float64, sep=',')
+    except ValueError:
+        values = None
+    if values is None or values.size != len(lines) * width:
+        raise ValueError("Lines contain non-numeric values or records of "
+                         "different lengths.")
+    return values.reshape(len(lines), width)
+
+
+def is_binary_record_file(file: str) -> bool:
+    """Return True if the file uses the binary (.npy) record format."""
+    return file.endswith(BINARY_RECORD_EXT)
+
+
+def load_records(file: str) -> np.ndarray:
+    """
+    Load all records from a text or binary (.npy) record file. Binary files
+    are memory-mapped.
+    :param file: Path to the record file
+    :return: 2-D float64 array with one row per record
+    """
+    if is_binary_record_file(file):
+        vectors = np.load(file, mmap_mode='r')
+        if vectors.ndim != 2 or vectors.dtype != np.float64:
+            raise ValueError(f"{file} does not contain a 2-D float64 "
+                             f"matrix.")
+        return vectors
+    with open(file, "r") as fd:
+        return parse_lists(fd.readlines())
+
+
+def save_records(file: str, records: List[List[float]] or np.ndarray) -> None:
+    """
+    Write records into a text or binary (.npy) record file depending on the
+    file extension.
+    :param file: Path to the record file
+    :param records: Records to write, one per row
+    """
+    if is_binary_record_file(file):
+        np.save(file, np.asarray(records, dtype=np.float64))
+    else:
+        if isinstance(records, np.ndarray):
+            records = records.tolist()
+        with open(file, "w") as fd:
+            fd.writelines([f"{str(list(r))}\n" for r in records])
+
+
+def json_length(rows: List[Tuple[str, ...]]) -> int:
+    """
+    Return len(json.dumps(rows)) for a list of string tuples without
+    serializing the data again.
+    :param rows: List of tuples (or lists) of strings
+    :return: Length of the JSON representation
+    """
+    if not rows:
+        return 2
+    total = 2 + 2 * (len(rows) - 1)  # [] and ', '
+    for row in rows:
+        total += 2 + 2 * (len(row) - 1)
+        for s in row:
+            if s.isascii() and s.isprintable():
+                # Only quotes and backslashes are escaped
+                total += len(s) + 2 + s.count('"') + s.count('\\')
+            else:
+                total += len(json.dumps(s))
+    return total
+
+
 def get_tls_context(cert: str, key: str) -> ssl.SSLContext:
     """Return an SSL Context with high security level"""
     context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""Persistent worker pool for matching candidates with a Bloom filter.
+
+Copyright (c) 2020.
+Author: Erik Buchholz
+Maintainer: Erik Buchholz
+E-mail: buchholz@comsys.rwth-aachen.de
+"""
+import atexit
+import logging
+import math
+import multiprocessing
+import os
+from multiprocessing.connection import Connection, wait
+from typing import Tuple
+
+import numpy as np
+from pybloomfilter import BloomFilter
+
+from lib import config
+from lib.bloom import (contains_many, open_bloom_filter,
+                       LEGACY_KEY_ENCODING)
+from lib.hash_cache import HashCache
+from lib.record import RecordBatch
+from lib.similarity_metrics import RecordIterator
+
+log: logging.Logger = logging.getLogger(__name__)
+
+# Settings of the client process the workers adopt for each query, because
+# they may have changed since the workers were started.
+_SETTINGS = ('RECORD_LENGTH', 'RECORD_ID_LENGTH', 'ROUNDING_VEC',
+             'HASH_BATCH_SIZE')
+
+_pool: 'MatchingPool' = None
+
+
+def match_batch(batch: RecordBatch, b: BloomFilter,
+                encoding: str) -> np.ndarray:
+    """
+    Return the indices of the records of the batch contained in the bloom
+    filter.
+    :param batch: Candidates to check
+    :param b: Bloom filter of the storage server
+    :param encoding: Key encoding of the filter
+    :return: Sorted indices into the batch
+    """
+    return np.flatnonzero(contains_many(b, batch.get_long_hashes(),
+                                        encoding))
+
+
+def _match_range(query: dict, b: BloomFilter, start: int,
+                 stop: int) -> Tuple[np.ndarray, np.ndarray, int, int]:
+    """
+    Match the candidates with the ranks start to stop - 1.
+    :return: (vectors, long hashes, cache hits, cache misses)
+    """
+    cache: HashCache = query['cache']
+    if cache is not None:
+        cache.hits = 0
+        cache.misses = 0
+    client_set = RecordIterator(query['candidates'][start:stop],
+                                query['hash_key'], cache)
+    vectors = [np.empty((0, config.RECORD_LENGTH), dtype=np.float64)]
+    hashes = [np.empty((0, RecordBatch.HASH_LEN), dtype=np.uint8)]
+    for batch in client_set.iter_batches():
+        found = match_batch(batch, b, query['encoding'])
+        if found.size > 0:
+            vectors.append(batch.vectors[found])
+            hashes.append(batch.get_long_hashes()[found])
+    if cache is not None:
+        return (np.concatenate(vectors), np.concatenate(hashes),
+                cache.hits, cache.misses)
+    return np.concatenate(vectors), np.concatenate(hashes), 0, 0
+
+
+def _worker(conn: Connection) -> None:  # pragma no cover
+    """
+    Serve requests of the pool until it is closed. Messages are
+    ('query', dict) to start a new query and ('match', start, stop) to
+    match a rank range of the current query's candidates.
+    :param conn: Pipe to the client process
+    """
+    b = None
+    bloom_token = None
+    query = None
+    while True:
+        try:
+            msg = conn.recv()
+        except EOFError:
+            return
+        try:
+            if msg[0] == 'stop':
+                return
+            elif msg[0] == 'query':
+                query = msg[1]
+                for name, value in query['settings'].items():
+                    setattr(config, name, value)
+                if query['bloom'] != bloom_token:
+                    # Read-only mapping, shared with all other workers
+                    b = open_bloom_filter(query['bloom'][0], 'r')
+                    bloom_token = query['bloom']
+                conn.send(('ok',))
+            elif msg[0] == 'match':
+                conn.send(('ok', msg[1]) + _match_range(query, b, msg[1],
+                                                        msg[2]))
+            else:
+                raise ValueError(f"Unknown message: {msg[0]}")
+        except Exception as e:
+            conn.send(('error', f"{type(e).__name__}: {e}"))
+
+
+class MatchingPool:
+    """
+    Long-lived worker processes that match rank ranges of a candidate
+    iterator against a Bloom filter file. Each worker opens the filter once
+    and keeps it until the file or its version changes. Matches are returned
+    as packed arrays over one pipe per worker.
+    """
+
+    def __init__(self, processes: int = None) -> None:
+        """
+        Start the workers.
+        :param processes: [optional] Number of workers, default:
+                          config.MATCHING_POOL_SIZE or CPU count
+        """
+        if processes is None:
+            processes = config.MATCHING_POOL_SIZE or \
+                multiprocessing.cpu_count()
+        self.pid = os.getpid()
+        self._workers = []
+        for _ in range(processes):
+            conn, child_conn = multiprocessing.Pipe()
+            p = multiprocessing.Process(target=_worker, args=(child_conn,),
+                                        daemon=True)
+            p.start()
+            child_conn.close()
+            self._workers.append((p, conn))
+        log.debug(f"Started matching pool with {processes} processes.")
+
+    def __len__(self) -> int:
+        return len(self._workers)
+
+    @property
+    def alive(self) -> bool:
+        """True if the pool belongs to this process and no worker died."""
+        return self.pid == os.getpid() and len(self._workers) > 0 and \
+            all(p.is_alive() for p, _ in self._workers)
+
+    def close(self) -> None:
+        """Stop all workers."""
+        if self.pid != os.getpid():
+            return
+        for p, conn in self._workers:
+            try:
+                conn.send(('stop',))
+            except (BrokenPipeError, OSError):
+                pass
+        for p, conn in self._workers:
+            p.join(timeout=1)
+            if p.is_alive():  # pragma no cover
+                p.terminate()
+            conn.close()
+        self._workers = []
+
+    def _recv(self, conn: Connection) -> tuple:
+        """
+        Return the next reply of a worker. The pool is closed on errors
+        because outstanding replies would be received by the next query.
+        """
+        try:
+            reply = conn.recv()
+        except EOFError:
+            reply = ('error', "Worker process died.")
+        if reply[0] != 'ok':
+            self.close()
+            raise RuntimeError(f"Bloom matching failed: {reply[1]}")
+        return reply
+
+    def match(self, candidates, bloom_file: str, bloom_version,
+              hash_key: bytes, cache: HashCache = None,
+              encoding: str = LEGACY_KEY_ENCODING
+              ) -> Tuple[np.ndarray, np.ndarray, int, int]:
+        """
+        Return all candidates contained in the Bloom filter in the order of
+        the candidate iterator.
+        :param candidates: Sliceable candidate iterator with size attribute
+        :param bloom_file: Path of the Bloom filter file
+        :param bloom_version: Version of the filter file, workers reopen the
+                              file if it changes
+        :param hash_key: Key used for hashing
+        :param cache: [optional] HashCache of the hash key
+        :param encoding: [optional] Key encoding of the filter
+        :return: (vectors, long hashes, cache hits, cache misses)
+        """
+        stat = os.stat(bloom_file)
+        query = {
+            'candidates': candidates,
+            'bloom': (bloom_file, stat.st_ino, stat.st_size, bloom_version),
+            'hash_key': hash_key,
+            'cache': cache,
+            'encoding': encoding,
+            'settings': {name: getattr(config, name) for name in _SETTINGS}
+        }
+        for _, conn in self._workers:
+            conn.send(('query', query))
+        for _, conn in self._workers:
+            self._recv(conn)
+        total = candidates.size
+        # Several shards per worker balance uneven matching times
+        shard = max(1, math.ceil(total / (
+            len(self._workers) * config.MATCHING_POOL_SHARDS)))
+        shards = iter(range(0, total, shard))
+        results = []
+        busy = []
+        for _, conn in self._workers:
+            start = next(shards, None)
+            if start is None:
+                break
+            conn.send(('match', start, min(start + shard, total)))
+            busy.append(conn)
+        while busy:
+            for conn in wait(busy):
+                results.append(self._recv(conn)[1:])
+                start = next(shards, None)
+                if start is None:
+                    busy.remove(conn)
+                else:
+                    conn.send(('match', start, min(start + shard, total)))
+        results.sort(key=lambda r: r[0])
+        vectors = [np.empty((0, config.RECORD_LENGTH), dtype=np.float64)]
+        hashes = [np.empty((0, RecordBatch.HASH_LEN), dtype=np.uint8)]
+        vectors.extend(r[1] for r in results)
+        hashes.extend(r[2] for r in results)
+        return (np.concatenate(vectors), np.concatenate(hashes),
+                sum(r[3] for r in results), sum(r[4] for r in results))
+
+
+def get_matching_pool() -> MatchingPool:
+    """
+    Return the matching pool of this process, started on first use.
+    :return: MatchingPool
+    """
+    global _pool
+    if _pool is None or not _pool.alive:
+        if _pool is not None:
+            _pool.close()
+        _pool = MatchingPool()
+        atexit.register(_pool.close)
+    return _pool
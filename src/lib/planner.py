@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""Cost estimation of client queries before they are executed.
+
+Copyright (c) 2020.
+Author: Erik Buchholz
+Maintainer: Erik Buchholz
+E-mail: buchholz@comsys.rwth-aachen.de
+"""
+import json
+import logging
+import math
+import os
+import time
+from typing import Dict, Tuple
+
+from lib import config
+from lib.blocked_bloom import blocked_parameters, BLOCK_BITS
+from lib.bloom import WORD_SIZE
+from lib.helpers import to_base64
+from lib.psi_set import client_set_size
+from lib.similarity_metrics import RecordIterator, RelativeOffsetIterator
+
+log: logging.Logger = logging.getLogger(__name__)
+
+# Machine and network dependent constants. hash_rate is measured by
+# calibrate(), all others cannot be measured without the servers and are
+# rough defaults that may be adjusted in the calibration file.
+DEFAULT_CALIBRATION = {
+    'hash_rate': 10 ** 5,  # Candidates generated, hashed and checked per s
+    'bandwidth': 12.5 * 10 ** 6,  # Byte/s between client and servers
+    'ot_setup_time': 1.0,  # s per OT session (connection, base OTs)
+    'ot_key_rate': 2 * 10 ** 7,  # Keys masked per s by the key server
+    'psi_setup_time': 1.0,  # s per PSI session (connection, base OTs)
+    'psi_item_rate': 10 ** 6,  # Set elements per s and party
+    'psi_item_bytes': 300,  # Byte transferred per set element and party
+}
+
+
+def calibrate(n: int = 20000) -> Dict[str, float]:
+    """
+    Measure the constants of this machine with a small benchmark.
+    :param n: Number of candidates to hash
+    :return: Measured constants
+    """
+    target = [float(i + 1) for i in range(config.RECORD_LENGTH)]
+    offset = 1
+    it = RelativeOffsetIterator(target, offset)
+    while it.size < n and offset < 99:
+        offset += 1
+        it = RelativeOffsetIterator(target, offset)
+    it = it[:n]
+    server_set = set()
+    start = time.monotonic()
+    for batch in RecordIterator(it, os.urandom(16)).iter_batches():
+        for h in batch.get_long_hashes():
+            _ = to_base64(h.tobytes()) in server_set
+    duration = max(time.monotonic() - start, 10 ** -6)
+    result = {'hash_rate': len(it) / duration}
+    log.info(f"Calibration: {result['hash_rate']:.0f} candidates/s.")
+    return result
+
+
+def load_calibration(path: str = None,
+                     benchmark: bool = True) -> Dict[str, float]:
+    """
+    Return the calibration constants of this machine. Values stored in the
+    calibration file override the defaults. If no file exists yet, the
+    benchmark is executed and its results are stored.
+    :param path: [optional] Path of calibration file
+    :param benchmark: Run benchmark if no calibration file exists
+    :return: Calibration constants
+    """
+    if path is None:
+        path = config.DATA_DIR + config.PLANNER_CALIBRATION_FILE
+    result = DEFAULT_CALIBRATION.copy()
+    if os.path.exists(path):
+        with open(path, 'r') as fd:
+            result.update(json.load(fd))
+    elif benchmark:
+        result.update(calibrate())
+        save_calibration(result, path)
+    return result
+
+
+def save_calibration(values: Dict[str, float], path: str = None) -> None:
+    """
+    Store calibration constants.
+    :param values: Calibration constants
+    :param path: [optional] Path of calibration file
+    """
+    if path is None:
+        path = config.DATA_DIR + config.PLANNER_CALIBRATION_FILE
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as fd:
+        json.dump(values, fd, indent=4)
+
+
+def _bloom_dimensions(capacity: int = None, error_rate: float = None
+                      ) -> Tuple[int, int]:
+    """
+    Return the number of bits of the Bloom filter and the bits set per key.
+    :param capacity: [optional] Capacity of the filter
+    :param error_rate: [optional] False positive rate of the filter
+    :return: (bits, bits per key)
+    """
+    if capacity is None:
+        capacity = config.BLOOM_CAPACITY
+    if error_rate is None:
+        error_rate = config.BLOOM_ERROR_RATE
+    if config.BLOOM_IMPLEMENTATION == 'blocked':
+        lines, k, blocks = blocked_parameters(capacity, error_rate)
+        return blocks * BLOCK_BITS, lines * k
+    bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+    return bits, max(1, math.floor(-math.log2(error_rate)))
+
+
+def bloom_size(capacity: int = None, error_rate: float = None,
+               compression: str = None, entries: int = None) -> int:
+    """
+    Return the size of the Bloom filter file transmitted by the storage
+    server.
+    :param capacity: [optional] Capacity of the filter
+    :param error_rate: [optional] False positive rate of the filter
+    :param compression: [optional] Transfer compression, default:
+                        config.BLOOM_COMPRESSION
+    :param entries: [optional] Number of keys in the filter, default:
+                    capacity
+    :return: Size of the binary, possibly compressed filter in Byte
+    """
+    if compression is None:
+        compression = config.BLOOM_COMPRESSION
+    bits, k = _bloom_dimensions(capacity, error_rate)
+    size = bits / 8
+    if compression != 'none':
+        if entries is None:
+            entries = config.BLOOM_CAPACITY if capacity is None else capacity
+        # The compressed size is bounded by the entropy of the bits, a
+        # filter filled up to its capacity is incompressible. Compressors
+        # do not exceed a ratio of about 1000:1 on empty filters.
+        fill = 1 - math.exp(-k * entries / bits)
+        entropy = 0.0
+        if 0 < fill < 1:
+            entropy = -fill * math.log2(fill) - \
+                (1 - fill) * math.log2(1 - fill)
+        size *= min(1.0, max(entropy, 0.001))
+    return math.ceil(size)
+
+
+def bloom_delta_size(records: int = None, capacity: int = None,
+                     error_rate: float = None) -> int:
+    """
+    Return the size of the update of a cached Bloom filter. The server
+    sends the whole filter instead if that is not larger.
+    :param records: [optional] Records added since the cached version,
+                    default: config.PLANNER_BLOOM_NEW_RECORDS
+    :param capacity: [optional] Capacity of the filter
+    :param error_rate: [optional] False positive rate of the filter
+    :return: Size of the transferred data in Byte
+    """
+    if records is None:
+        records = config.PLANNER_BLOOM_NEW_RECORDS
+    bits, k = _bloom_dimensions(capacity, error_rate)
+    # Index and value of each changed word, Base64 encoded
+    delta = records * k * 2 * WORD_SIZE
+    if delta >= bits / 8:
+        return bloom_size(capacity, error_rate)
+    return math.ceil(delta * 4 / 3)
+
+
+def _ot_time(ots: int, calibration: Dict[str, float]) -> float:
+    """Estimated time in s to retrieve the keys of ots records."""
+    sessions = math.ceil(ots / config.OT_MAX_NUM)
+    return (sessions * calibration['ot_setup_time'] +
+            ots * config.OT_SETSIZE / calibration['ot_key_rate'] +
+            ots * config.OT_SETSIZE * config.ENCKEY_LEN / 8 /
+            calibration['bandwidth'])
+
+
+def plan_query(candidates: int, calibration: Dict[str, float] = None,
+               expected_matches: int = None,
+               budget: float = None, psi_buckets: int = 1,
+               bloom_cached: bool = False) -> dict:
+    """
+    Estimate the costs of retrieving the given number of candidates in
+    Bloom and in PSI mode and choose the cheaper mode within the budget.
+    :param candidates: Exact number of candidates
+    :param calibration: [optional] Calibration constants
+    :param expected_matches: [optional] Expected number of real matches
+    :param budget: [optional] Maximal estimated cost in s
+    :param psi_buckets: [optional] Number of buckets of the server set
+    :param bloom_cached: [optional] The client has a local copy of the
+                         Bloom filter and only retrieves the changes
+    :return: Dict with all estimates, 'mode' is 'bloom', 'psi' or None if
+             no mode fits into the budget
+    """
+    if calibration is None:
+        calibration = load_calibration()
+    if expected_matches is None:
+        expected_matches = config.PLANNER_EXPECTED_MATCHES
+    if budget is None:
+        budget = config.PLANNER_COST_BUDGET
+    plan = {'candidates': candidates}
+    plan['hash_time'] = candidates / calibration['hash_rate']
+    # Bloom filter mode
+    if bloom_cached:
+        plan['bloom_bytes'] = bloom_delta_size()
+    else:
+        plan['bloom_bytes'] = bloom_size()
+    plan['bloom_time'] = plan['bloom_bytes'] / calibration['bandwidth']
+    plan['bloom_false_positives'] = candidates * config.BLOOM_ERROR_RATE
+    # Both modes retrieve the keys of all matches via OT
+    matches = min(expected_matches, candidates)
+    bloom_matches = min(matches + plan['bloom_false_positives'], candidates)
+    plan['ot_count'] = math.ceil(bloom_matches)
+    # The key server sends all OT_SETSIZE masked keys per OT
+    plan['ot_bytes'] = plan['ot_count'] * config.OT_SETSIZE * \
+        config.ENCKEY_LEN // 8
+    plan['ot_time'] = _ot_time(plan['ot_count'], calibration)
+    # PSI mode: the server set is padded to the PSI set size, the client
+    # set only to its size class. Both parties compute in parallel.
+    # A server set split into buckets requires one PSI per bucket.
+    plan['psi_sessions'] = math.ceil(candidates / config.PSI_SETSIZE)
+    server_items = plan['psi_sessions'] * config.PSI_SETSIZE * psi_buckets
+    last = candidates - (plan['psi_sessions'] - 1) * config.PSI_SETSIZE
+    client_items = (plan['psi_sessions'] - 1) * config.PSI_SETSIZE + \
+        client_set_size(math.ceil(last / psi_buckets)) * psi_buckets
+    plan['psi_bytes'] = (server_items + client_items) * \
+        calibration['psi_item_bytes']
+    parallel = min(psi_buckets, max(1, config.PSI_BUCKET_SESSIONS))
+    plan['psi_time'] = (
+        plan['psi_sessions'] * psi_buckets *
+        calibration['psi_setup_time'] / parallel +
+        max(server_items, client_items) / calibration['psi_item_rate'] /
+        parallel +
+        plan['psi_bytes'] / calibration['bandwidth']
+    )
+    plan['bloom_cost'] = plan['hash_time'] + plan['bloom_time'] + \
+        plan['ot_time']
+    # No false positives in PSI mode
+    plan['psi_cost'] = plan['hash_time'] + plan['psi_time'] + \
+        _ot_time(math.ceil(matches), calibration)
+    plan['budget'] = budget
+    # The client performs only one PSI per query
+    options = [('bloom', plan['bloom_cost'])]
+    if plan['psi_sessions'] <= 1:
+        options.append(('psi', plan['psi_cost']))
+    options = [o for o in options if o[1] <= budget]
+    if options:
+        plan['mode'] = min(options, key=lambda o: o[1])[0]
+    else:
+        plan['mode'] = None
+    return plan
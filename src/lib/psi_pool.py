@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+"""Pool of pre-initialized PSI sender processes of the storage server.
+
+Copyright (c) 2020.
+Author: Erik Buchholz
+Maintainer: Erik Buchholz
+E-mail: buchholz@comsys.rwth-aachen.de
+"""
+import atexit
+import logging
+import multiprocessing
+import os
+import secrets
+import threading
+import time
+import uuid
+from multiprocessing.connection import Connection
+from typing import List, Tuple
+
+from lib import config, helpers
+from lib.psi_set import PSIServerSet
+from lib.storage_server_backend import StorageServer
+
+log: logging.Logger = logging.getLogger(__name__)
+
+_pool: 'PSISenderPool' = None
+
+
+def _warm_up(psi_set: PSIServerSet) -> None:
+    """Load the server set into the per-process cache of the sender."""
+    if psi_set.exists() and psi_set.buckets() == 1:
+        psi_set.load()
+
+
+def _worker(conn: Connection, data_dir: str,
+            port: int) -> None:  # pragma no cover
+    """
+    Offer one PSI session per request on the worker's port. The server set
+    is loaded before the worker reports to be idle, so a session starts
+    without touching the database or converting the set. Messages are
+    ('psi', kwargs of StorageServer.offer_psi) and ('stop',).
+    :param conn: Pipe to the web server process
+    :param data_dir: Data directory of the storage server
+    :param port: Port all sessions of this worker listen on
+    """
+    backend = StorageServer(data_dir)
+    psi_set = PSIServerSet(data_dir + config.PSI_SET_FILE)
+    duration = None
+    error = None
+    while True:
+        try:
+            _warm_up(psi_set)
+        except Exception as e:
+            log.exception("Loading the PSI set failed.")
+            error = f"{type(e).__name__}: {e}"
+        conn.send(('idle', duration, error))
+        try:
+            msg = conn.recv()
+        except EOFError:
+            return
+        if msg[0] == 'stop':
+            return
+        start = time.monotonic()
+        error = None
+        try:
+            backend.offer_psi(port=port, **msg[1])
+        except Exception as e:
+            log.exception(f"PSI on port {port} failed.")
+            error = f"{type(e).__name__}: {e}"
+        duration = time.monotonic() - start
+
+
+class PSISenderPool:
+    """
+    Long-lived PSI sender processes of the storage server, each with its
+    own port. An idle sender has the server set loaded already and starts
+    listening as soon as it is handed out, so a client does not wait for a
+    celery task, a port probe or the set conversion. The base OTs require
+    the connection to the client and are still done per session.
+    """
+
+    def __init__(self, data_dir: str, processes: int = None,
+                 randomize_ports: bool = True) -> None:
+        """
+        Start the senders.
+        :param data_dir: Data directory of the storage server
+        :param processes: [optional] Number of senders,
+                          default: config.PSI_POOL_SIZE
+        :param randomize_ports: [optional] Use random free ports instead of
+                                the ports following config.PSI_PORT
+        """
+        if processes is None:
+            processes = config.PSI_POOL_SIZE
+        self.data_dir = data_dir
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._ports = []
+        for i in range(processes):
+            if randomize_ports:
+                port = secrets.randbelow(65536 - 1024) + 1024
+                while port in self._ports or not helpers.port_free(port):
+                    port = secrets.randbelow(65536 - 1024) + 1024
+            else:  # pragma no cover
+                port = config.PSI_PORT + 1 + i
+            self._ports.append(port)
+        self._workers = [self._start(port) for port in self._ports]
+        self._idle = [False] * processes
+        # Session and start time of the busy senders
+        self._sessions = [None] * processes
+        self._busy_since = [None] * processes
+        # Session ID -> (state, error) with celery's state names
+        self._states = {}
+        self.sessions = 0
+        self.fallbacks = 0
+        self.failures = 0
+        self.session_time = 0.0
+        log.debug(f"Started PSI sender pool with {processes} processes.")
+
+    def _start(self, port: int) -> tuple:
+        """Start one sender process listening on the given port."""
+        conn, child_conn = multiprocessing.Pipe()
+        p = multiprocessing.Process(target=_worker,
+                                    args=(child_conn, self.data_dir, port),
+                                    daemon=True)
+        p.start()
+        child_conn.close()
+        return p, conn
+
+    def __len__(self) -> int:
+        return len(self._workers)
+
+    @property
+    def ports(self) -> List[int]:
+        """Ports of the senders."""
+        return list(self._ports)
+
+    def _finish(self, i: int, state: str, error: str = None) -> None:
+        """Record the end of the session of sender i."""
+        if self._sessions[i] is not None:
+            self._states[self._sessions[i]] = (state, error)
+        self._sessions[i] = None
+        self._busy_since[i] = None
+
+    def _terminate(self, i: int, state: str, error: str) -> None:
+        """Terminate sender i, it is restarted by the next _update."""
+        p = self._workers[i][0]
+        p.terminate()
+        p.join()
+        self._finish(i, state, error)
+
+    def _update(self) -> None:
+        """
+        Receive the state of all senders, terminate senders busy for longer
+        than config.PSI_POOL_SESSION_TIMEOUT and replace dead ones.
+        """
+        for i, (p, conn) in enumerate(self._workers):
+            try:
+                while conn.poll():
+                    _, duration, error = conn.recv()
+                    self._idle[i] = True
+                    if duration is not None:
+                        self.session_time += duration
+                    if error is not None:
+                        self.failures += 1
+                        log.warning(f"PSI sender on port {self._ports[i]}: "
+                                    f"{error}")
+                    self._finish(i, 'SUCCESS' if error is None else
+                                 'FAILURE', error)
+            except (EOFError, OSError):
+                pass
+            if self._busy_since[i] is not None and \
+                    time.monotonic() - self._busy_since[i] > \
+                    config.PSI_POOL_SESSION_TIMEOUT:
+                log.warning(f"PSI session on port {self._ports[i]} timed "
+                            f"out.")
+                self.failures += 1
+                self._terminate(i, 'FAILURE', "Session timed out.")
+            if not p.is_alive():
+                log.warning(f"PSI sender on port {self._ports[i]} died.")
+                conn.close()
+                self._finish(i, 'FAILURE', "PSI sender died.")
+                self._workers[i] = self._start(self._ports[i])
+                self._idle[i] = False
+
+    def acquire(self, **kwargs) -> Tuple[int, str] or None:
+        """
+        Hand out an idle sender that immediately offers a PSI with the
+        given arguments.
+        :param kwargs: Arguments of StorageServer.offer_psi except port
+        :return: Port of the sender and ID of the session or None if all
+                 senders are busy
+        """
+        if self.pid != os.getpid():
+            return None
+        with self._lock:
+            self._update()
+            for i, idle in enumerate(self._idle):
+                if idle:
+                    self._workers[i][1].send(('psi', kwargs))
+                    self._idle[i] = False
+                    session_id = str(uuid.uuid4())
+                    self._sessions[i] = session_id
+                    self._busy_since[i] = time.monotonic()
+                    self._states[session_id] = ('STARTED', None)
+                    self.sessions += 1
+                    log.debug(f"PSI sender pool: {self.stats()}")
+                    return self._ports[i], session_id
+            self.fallbacks += 1
+        log.warning(f"No idle PSI sender. Pool: {self.stats()}")
+        return None
+
+    def state(self, session_id: str) -> Tuple[str, str or None]:
+        """
+        Return the state of a session handed out by this pool.
+        :param session_id: ID of the session
+        :return: Celery state name and error message of failed sessions,
+                 PENDING for unknown sessions
+        """
+        with self._lock:
+            self._update()
+            return self._states.get(session_id, ('PENDING', None))
+
+    def kill(self, session_id: str) -> bool:
+        """
+        Abort a running session, the sender is restarted.
+        :param session_id: ID of the session
+        :return: True if the session was running
+        """
+        with self._lock:
+            self._update()
+            if session_id not in self._sessions:
+                return False
+            i = self._sessions.index(session_id)
+            log.warning(f"Killing PSI session '{session_id}'.")
+            self._terminate(i, 'REVOKED', "Session was killed.")
+            self._update()
+            return True
+
+    def stats(self) -> dict:
+        """
+        Return the usage of the pool.
+        :return: Dict with the number of senders, idle senders, handed out
+                 sessions, requests no sender was idle for, failed sessions
+                 and the total duration of finished sessions in s
+        """
+        return {
+            'size': len(self._workers),
+            'idle': sum(self._idle),
+            'sessions': self.sessions,
+            'fallbacks': self.fallbacks,
+            'failures': self.failures,
+            'session_time': self.session_time
+        }
+
+    def close(self) -> None:
+        """Stop all senders, running sessions are aborted."""
+        if self.pid != os.getpid():
+            return
+        for p, conn in self._workers:
+            try:
+                conn.send(('stop',))
+            except (BrokenPipeError, OSError):
+                pass
+        for p, conn in self._workers:
+            p.join(timeout=1)
+            if p.is_alive():
+                p.terminate()
+            conn.close()
+        self._workers = []
+        self._idle = []
+        self._sessions = []
+        self._busy_since = []
+
+
+def get_psi_pool(data_dir: str, randomize_ports: bool = True
+                 ) -> PSISenderPool:
+    """
+    Return the PSI sender pool of this process, started on first use.
+    :param data_dir: Data directory of the storage server
+    :param randomize_ports: [optional] Use random free ports
+    :return: PSISenderPool
+    """
+    global _pool
+    if _pool is None or _pool.pid != os.getpid() or \
+            _pool.data_dir != data_dir:
+        if _pool is not None:
+            _pool.close()
+        _pool = PSISenderPool(data_dir, randomize_ports=randomize_ports)
+        atexit.register(_pool.close)
+    return _pool
+
+
+class PoolSession:
+    """
+    Session of the PSI sender pool with the attributes of a celery
+    AsyncResult used by the status pages of the storage server.
+    """
+
+    def __init__(self, session_id: str) -> None:
+        """
+        Look up the session in the pool of this process. Sessions of other
+        processes of the web server are unknown and reported as PENDING.
+        :param session_id: ID returned by PSISenderPool.acquire
+        """
+        self.id = session_id
+        if _pool is not None and _pool.pid == os.getpid():
+            self.state, self.info = _pool.state(session_id)
+        else:
+            self.state, self.info = 'PENDING', None
+
+    def revoke(self, **kwargs) -> None:
+        """Kill the session, arguments of celery's revoke are ignored."""
+        if _pool is not None and _pool.pid == os.getpid():
+            _pool.kill(self.id)
+
+
+class PoolSessions:
+    """Sessions of the PSI sender pool with the interface of a celery task."""
+
+    @staticmethod
+    def AsyncResult(session_id: str) -> PoolSession:
+        """Return the session with the given ID."""
+        return PoolSession(session_id)
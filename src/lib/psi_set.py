@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+"""Persisted, padded PSI input set of the storage server.
+
+Copyright (c) 2020.
+Author: Erik Buchholz
+Maintainer: Erik Buchholz
+E-mail: buchholz@comsys.rwth-aachen.de
+"""
+import fcntl
+import json
+import logging
+import os
+from contextlib import contextmanager
+from typing import List, Dict, Tuple
+
+import numpy as np
+
+from lib import config
+from lib.record import (WIDE_INDEX_DTYPE, wide_indices_to_ints,
+                        ints_to_wide_indices)
+
+log: logging.Logger = logging.getLogger(__name__)
+
+# Sets loaded by this process: path -> (generation, count, indices as ints)
+_loaded: Dict[str, Tuple[int, int, List[int]]] = {}
+# Bucket counts computed by this process: (path, set size) -> (version, count)
+_buckets: Dict[Tuple[str, int], Tuple[int, int]] = {}
+# Number of entries scanned at once when splitting the set into buckets
+_CHUNK = 2 ** 22
+
+
+def dummies(start: int, stop: int) -> np.ndarray:
+    """
+    Return the server dummies of the given set positions. The dummy at
+    position i is PSI_DUMMY_START_SERVER + i.
+    :param start: First position
+    :param stop: Last position (exclusive)
+    :return: Array of dtype WIDE_INDEX_DTYPE
+    """
+    res = np.empty(max(0, stop - start), dtype=WIDE_INDEX_DTYPE)
+    first = ints_to_wide_indices([config.PSI_DUMMY_START_SERVER])[0]
+    res['hi'] = first['hi']
+    with np.errstate(over='ignore'):
+        res['lo'] = first['lo'] + np.arange(start, stop, dtype=np.uint64)
+    return res
+
+
+def client_set_size(n: int) -> int:
+    """
+    Return the size class a client set of n PSI indices is padded to: the
+    next power of two, at least config.PSI_CLIENT_MIN_SETSIZE and at most
+    config.PSI_SETSIZE. Only the size class leaks to the server.
+    :param n: Number of PSI indices
+    :return: Padded set size
+    """
+    size = max(1, config.PSI_CLIENT_MIN_SETSIZE, n)
+    size = 2 ** (size - 1).bit_length()
+    return min(size, config.PSI_SETSIZE)
+
+
+def check_client_set_size(size: int) -> None:
+    """Raise a ValueError if size is not a valid client set size class."""
+    if size != client_set_size(size):
+        raise ValueError(f"Invalid client set size: {size}")
+
+
+def psi_bucket(index: int, buckets: int) -> int:
+    """
+    Return the bucket of a PSI index if the server set is split into the
+    given number of buckets. The function is public, client and server
+    partition their sets alike.
+    :param index: PSI index
+    :param buckets: Number of buckets, power of two
+    :return: Bucket in [0, buckets)
+    """
+    return index % buckets
+
+
+def check_buckets(buckets: int) -> None:
+    """Raise a ValueError if buckets is not a valid number of buckets."""
+    if buckets < 1 or buckets & (buckets - 1) != 0:
+        raise ValueError(f"Invalid number of PSI buckets: {buckets}")
+
+
+class PSIServerSet:
+    """
+    PSI input set of the storage server, stored as memory-mapped array of
+    128 bit values. The first 'count' entries are the distinct PSI indices
+    of the stored records in insertion order, the following entries are
+    server dummies. New records replace dummies, so a PSI session neither
+    reads the database nor pads the set. The metadata next to the array is
+    shared by the web server and the celery workers.
+    If the set holds more records than one PSI allows, it is split into
+    buckets by psi_bucket() and each bucket is padded to the full set size.
+    """
+
+    def __init__(self, path: str, set_size: int = None) -> None:
+        """
+        :param path: Path of the array file
+        :param set_size: [optional] Size of the padded set,
+                         default: config.PSI_SETSIZE
+        """
+        if set_size is None:
+            set_size = config.PSI_SETSIZE
+        self.path = path
+        self.meta_file = path + '.meta'
+        self.lock_file = path + '.lock'
+        self.set_size = set_size
+
+    def _load_meta(self) -> dict:
+        """
+        Return the number of records and the version counters. 'generation'
+        changes whenever existing entries are moved or removed.
+        """
+        if not os.path.exists(self.meta_file):
+            return {'count': 0, 'version': 0, 'generation': 0}
+        with open(self.meta_file, 'r') as fd:
+            return json.load(fd)
+
+    def _store_meta(self, meta: dict) -> None:
+        """Replace metadata atomically."""
+        tmp = self.meta_file + '.tmp'
+        with open(tmp, 'w') as fd:
+            json.dump(meta, fd)
+        os.replace(tmp, self.meta_file)
+
+    @contextmanager
+    def _lock(self):
+        """Serialize modifications of concurrent processes."""
+        with open(self.lock_file, 'w') as fd:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def exists(self) -> bool:
+        """Return True if the set has been built."""
+        return os.path.isfile(self.path) and os.path.isfile(self.meta_file)
+
+    @property
+    def count(self) -> int:
+        """Number of record indices in the set."""
+        return self._load_meta()['count']
+
+    @property
+    def version(self) -> int:
+        """Incremented on every modification."""
+        return self._load_meta()['version']
+
+    def _write(self, indices: np.ndarray, meta: dict,
+               size: int = 0) -> None:
+        """
+        Replace the array file by the given indices and padding.
+        :param size: [optional] Minimal length of the array
+        """
+        size = max(self.set_size, len(indices), size)
+        tmp = self.path + '.tmp'
+        arr = np.lib.format.open_memmap(tmp, mode='w+',
+                                        dtype=WIDE_INDEX_DTYPE,
+                                        shape=(size,))
+        arr[:len(indices)] = indices
+        arr[len(indices):] = dummies(len(indices), size)
+        arr.flush()
+        del arr
+        os.replace(tmp, self.path)
+        meta['count'] = len(indices)
+        meta['version'] += 1
+        meta['generation'] += 1
+        self._store_meta(meta)
+
+    def rebuild(self, indices: np.ndarray) -> None:
+        """
+        Replace the set by the given PSI indices.
+        :param indices: Array of dtype WIDE_INDEX_DTYPE, may contain
+                        duplicates
+        """
+        with self._lock():
+            _, first = np.unique(indices, return_index=True)
+            self._write(indices[np.sort(first)], self._load_meta())
+        log.info(f"Built PSI server set with {self.count} records.")
+
+    @staticmethod
+    def _contained(existing: np.ndarray, new: np.ndarray) -> np.ndarray:
+        """
+        Return which of the new indices are contained in the existing ones.
+        Only the new indices are sorted, the existing entries are searched
+        in them.
+        :param existing: Array of dtype WIDE_INDEX_DTYPE
+        :param new: Array of dtype WIDE_INDEX_DTYPE without duplicates
+        :return: Boolean array of length len(new)
+        """
+        res = np.zeros(len(new), dtype=bool)
+        if len(new) == 0 or len(existing) == 0:
+            return res
+        # Sort by (lo, hi) and search the low word first
+        order = np.lexsort((new['hi'], new['lo']))
+        lo = np.asarray(new['lo'])[order]
+        hi = np.asarray(new['hi'])[order]
+        existing_lo = np.asarray(existing['lo'])
+        # Only search existing entries whose low bits occur in new
+        bits = min(26, max(10, (8 * len(new)).bit_length()))
+        mask = np.uint64((1 << bits) - 1)
+        table = np.zeros(1 << bits, dtype=bool)
+        table[(lo & mask).astype(np.intp)] = True
+        cand = np.flatnonzero(table[(existing_lo & mask).astype(np.intp)])
+        existing_lo = existing_lo[cand]
+        existing_hi = np.asarray(existing['hi'])[cand]
+        start = np.searchsorted(lo, existing_lo)
+        found = start < len(lo)
+        found[found] = lo[start[found]] == existing_lo[found]
+        # Equal low words are rare, those are compared one by one
+        collision = np.zeros(len(lo), dtype=bool)
+        collision[:-1] = lo[1:] == lo[:-1]
+        single = found & ~collision[np.minimum(start, len(lo) - 1)]
+        pos = start[single]
+        res[order[pos[hi[pos] == existing_hi[single]]]] = True
+        for i in np.flatnonzero(found & ~single):
+            j = start[i]
+            while j < len(lo) and lo[j] == existing_lo[i]:
+                if hi[j] == existing_hi[i]:
+                    res[order[j]] = True
+                j += 1
+        return res
+
+    def add(self, indices: np.ndarray) -> int:
+        """
+        Add the PSI indices of new records that are not contained yet.
+        :param indices: Array of dtype WIDE_INDEX_DTYPE
+        :return: Number of added indices
+        """
+        with self._lock():
+            meta = self._load_meta()
+            count = meta['count']
+            arr = np.load(self.path, mmap_mode='r+')
+            _, first = np.unique(indices, return_index=True)
+            new = indices[np.sort(first)]
+            new = new[~self._contained(arr[:count], new)]
+            if new.size == 0:
+                return 0
+            if count + len(new) > len(arr):
+                # Grow geometrically, the set is split into buckets
+                log.info("Growing PSI server set beyond PSI Setsize.")
+                self._write(np.concatenate([arr[:count], new]), meta,
+                            2 * (count + len(new)))
+            else:
+                arr[count:count + len(new)] = new
+                arr.flush()
+                meta['count'] = count + len(new)
+                meta['version'] += 1
+                self._store_meta(meta)
+        log.debug(f"Added {len(new)} indices to the PSI server set.")
+        return len(new)
+
+    def _bucket_ids(self, buckets: int):
+        """
+        Yield the offset and the buckets of consecutive chunks of the
+        record indices.
+        """
+        count = self.count
+        arr = np.load(self.path, mmap_mode='r')
+        mask = np.uint64(buckets - 1)
+        for start in range(0, count, _CHUNK):
+            yield start, arr['lo'][start:min(start + _CHUNK, count)] & mask
+
+    def buckets(self, set_size: int = None) -> int:
+        """
+        Return the smallest number of buckets such that no bucket contains
+        more than set_size records. Only powers of two are used, so a
+        larger number of buckets fits as well.
+        :param set_size: [optional] Size of the padded set,
+                         default: self.set_size
+        :return: Number of buckets, power of two
+        """
+        if set_size is None:
+            set_size = self.set_size
+        meta = self._load_meta()
+        if meta['count'] <= set_size:
+            return 1
+        cached = _buckets.get((self.path, set_size))
+        if cached is not None and cached[0] == meta['version']:
+            return cached[1]
+        buckets = 2 ** (-(-meta['count'] // set_size) - 1).bit_length()
+        while True:
+            # Loads of buckets, 2 * buckets, ... from one pass
+            n = 8 * buckets
+            loads = np.zeros(n, dtype=np.int64)
+            for _, ids in self._bucket_ids(n):
+                loads += np.bincount(ids.astype(np.intp), minlength=n)
+            while buckets <= n:
+                if loads.reshape(-1, buckets).sum(axis=0).max() <= \
+                        set_size:
+                    _buckets[(self.path, set_size)] = (meta['version'],
+                                                       buckets)
+                    return buckets
+                buckets *= 2
+
+    def load_bucket(self, bucket: int, buckets: int,
+                    set_size: int = None) -> List[int]:
+        """
+        Return one bucket of the set padded with dummies as ints for the
+        PSI sender.
+        :param bucket: Bucket to return
+        :param buckets: Number of buckets, power of two
+        :param set_size: [optional] Size of the padded bucket,
+                         default: self.set_size
+        :return: List of set_size ints
+        """
+        if set_size is None:
+            set_size = self.set_size
+        if buckets == 1:
+            return self.load(set_size)
+        check_buckets(buckets)
+        if not 0 <= bucket < buckets:
+            raise ValueError(f"Invalid PSI bucket: {bucket}")
+        arr = np.load(self.path, mmap_mode='r')
+        pos = [start + np.flatnonzero(ids == bucket)
+               for start, ids in self._bucket_ids(buckets)]
+        pos = np.concatenate([np.empty(0, dtype=np.intp)] + pos)
+        if len(pos) > set_size:
+            raise RuntimeError("More records than PSI Setsize allows.")
+        return wide_indices_to_ints(np.concatenate(
+            [arr[pos], dummies(len(pos), set_size)]))
+
+    def load(self, set_size: int = None) -> List[int]:
+        """
+        Return the padded set as ints for the PSI sender. The ints are kept
+        per process; after modifications only new records are converted.
+        :param set_size: [optional] Size of the padded set,
+                         default: self.set_size
+        :return: List of set_size ints
+        """
+        if set_size is None:
+            set_size = self.set_size
+        meta = self._load_meta()
+        if meta['count'] > set_size:
+            raise RuntimeError("More records than PSI Setsize allows.")
+        arr = np.load(self.path, mmap_mode='r')
+        cached = _loaded.get(self.path)
+        if cached is None or cached[0] != meta['generation'] or \
+                len(cached[2]) != len(arr):
+            ints = wide_indices_to_ints(arr)
+            log.debug(f"Loaded PSI server set of size {len(ints)}.")
+        else:
+            ints = cached[2]
+            ints[cached[1]:meta['count']] = wide_indices_to_ints(
+                arr[cached[1]:meta['count']])
+        _loaded[self.path] = (meta['generation'], meta['count'], ints)
+        if len(ints) >= set_size:
+            return ints[:set_size]
+        return ints + wide_indices_to_ints(dummies(len(ints), set_size))
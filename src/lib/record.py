@@ -8,15 +8,21 @@ Maintainer: Erik Buchholz
 E-mail: buchholz@comsys.rwth-aachen.de
 """
 import hashlib
+import itertools
 import json
 import logging
+import multiprocessing as mp
 import struct
-from typing import List, Tuple, Any
+from multiprocessing.pool import Pool
+from typing import List, Tuple, Any, Iterable, Iterator
 
+import numpy as np
 from Crypto.Cipher import AES
 
 from lib import config
-from lib.helpers import to_base64, from_base64
+from lib.hash_cache import HashCache
+from lib.helpers import (to_base64, from_base64, parse_lists, load_records,
+                         is_binary_record_file)
 
 log: logging.Logger = logging.getLogger(__name__)
 
@@ -61,6 +67,78 @@ def round_s(n: float, rnd: int) -> float:
     return n
 
 
+# Powers of ten as computed by the scalar code: 10 ** k is an int for k >= 0
+# (converted to float on multiplication) and a float for k < 0.
+_POW10_MIN = -308
+_POW10 = np.array([float(10 ** k) for k in range(_POW10_MIN, -_POW10_MIN + 1)])
+# Range in which the float powers compare exactly like the scalar loop
+_EXACT_POWER_MIN = -300
+_EXACT_POWER_MAX = 22
+_POWER_TABLE = _POW10[_EXACT_POWER_MIN - _POW10_MIN:
+                      _EXACT_POWER_MAX - _POW10_MIN + 1]
+
+
+def _pow10(k: np.ndarray) -> np.ndarray:
+    """Return 10 ** k for an int array k as floats."""
+    return _POW10[k - _POW10_MIN]
+
+
+def _round_array(x: np.ndarray, ndigits: np.ndarray) -> (np.ndarray,
+                                                         np.ndarray):
+    """
+    Vectorized version of the builtin round(x, ndigits) for ndigits >= 0.
+    The builtin rounds the exact binary value correctly (half to even)
+    and returns the float closest to the decimal result. Both steps are
+    exact with NumPy unless the scaled value lies too close to a tie or
+    the scaling itself is inexact. These values are marked as unsafe.
+    :return: (Rounded values, Boolean array of unsafe positions)
+    """
+    unsafe = ndigits > _EXACT_POWER_MAX
+    scale = _pow10(np.minimum(ndigits, _EXACT_POWER_MAX))
+    y = x * scale
+    frac = np.abs(y - np.trunc(y))
+    unsafe |= np.abs(frac - 0.5) <= 2 * np.spacing(np.abs(y))
+    unsafe |= np.abs(y) >= 2 ** 52
+    return np.rint(y) / scale, unsafe
+
+
+def round_array(values: np.ndarray or List[float],
+                rnd: np.ndarray or List[int] or int) -> np.ndarray:
+    """
+    Vectorized version of round_s yielding exactly the same floats.
+    :param values: Array of values to round
+    :param rnd: Rounding value(s), broadcast against values (e.g. one per
+                column)
+    :return: Array of rounded values
+    """
+    values = np.asarray(values, dtype=np.float64)
+    rnd = np.broadcast_to(np.asarray(rnd, dtype=np.int64), values.shape)
+    if (rnd < 0).any():
+        raise ValueError(
+            f"Rounding values has to be 0 or larger, but is: {rnd.min()}")
+    result = values.copy()
+    abs_v = np.abs(values)
+    active = (rnd != 0) & (values != 0)
+    unsafe = active & ~((abs_v >= _POWER_TABLE[0]) &
+                        (abs_v < _POWER_TABLE[-1]))
+    work = active & ~unsafe
+    n = values[work]
+    r = rnd[work]
+    power = np.searchsorted(_POWER_TABLE, np.abs(n), side='right') - 1 + \
+        _EXACT_POWER_MIN
+    n = n * _pow10(-power)
+    n, unsafe1 = _round_array(n, r - 1)  # One number before point
+    n = n * _pow10(power)
+    fac = np.maximum(0, r - 1 - power)
+    n, unsafe2 = _round_array(n, fac)  # Round because of imprecision
+    result[work] = n
+    unsafe[work] = unsafe1 | unsafe2
+    # Fall back to scalar code where NumPy might deviate
+    for i in zip(*np.nonzero(unsafe)):
+        result[i] = round_s(float(values[i]), int(rnd[i]))
+    return result
+
+
 def hash_to_index(hash_v: bytes, bit_len: int) -> int:
     """Return a index of given bit length derived from the hash value."""
 
@@ -73,6 +151,261 @@ def hash_to_index(hash_v: bytes, bit_len: int) -> int:
     return num
 
 
+def hashes_to_indices(hashes: np.ndarray, bit_len: int) -> np.ndarray:
+    """
+    Vectorized version of hash_to_index for indices of at most 64 bit.
+    :param hashes: Array of shape (n, hash length) with dtype uint8
+    :param bit_len: Bit length of the indices
+    :return: Array of n indices with dtype uint64
+    """
+    if bit_len > 64:
+        raise ValueError(f"Only indices up to 64 Bit fit into an array, "
+                         f"but {bit_len} Bit requested.")
+    byte_len = bit_len // 8
+    overhang = bit_len % 8
+    num = np.zeros(len(hashes), dtype=np.uint64)
+    for i in range(byte_len):
+        num |= hashes[:, i].astype(np.uint64) << np.uint64(8 * i)
+    if overhang != 0:
+        rest = hashes[:, byte_len] % (2 ** overhang)
+        num |= rest.astype(np.uint64) << np.uint64(8 * byte_len)
+    return num
+
+
+# Indices of up to 128 bit as pairs of 64 bit words, sorted like the ints
+WIDE_INDEX_DTYPE = np.dtype([('hi', '<u8'), ('lo', '<u8')])
+
+
+def hashes_to_wide_indices(hashes: np.ndarray, bit_len: int) -> np.ndarray:
+    """
+    Vectorized version of hash_to_index for indices of up to 128 bit.
+    :param hashes: Array of shape (n, hash length) with dtype uint8
+    :param bit_len: Bit length of the indices
+    :return: Array of n indices with dtype WIDE_INDEX_DTYPE
+    """
+    if bit_len > 128:
+        raise ValueError(f"Only indices up to 128 Bit are supported, "
+                         f"but {bit_len} Bit requested.")
+    res = np.zeros(len(hashes), dtype=WIDE_INDEX_DTYPE)
+    res['lo'] = hashes_to_indices(hashes, min(bit_len, 64))
+    if bit_len > 64:
+        res['hi'] = hashes_to_indices(hashes[:, 8:], bit_len - 64)
+    return res
+
+
+def wide_indices_to_ints(indices: np.ndarray) -> List[int]:
+    """Convert an array of dtype WIDE_INDEX_DTYPE to a list of ints."""
+    return [(hi << 64) | lo for hi, lo in zip(indices['hi'].tolist(),
+                                              indices['lo'].tolist())]
+
+
+def ints_to_wide_indices(indices: Iterable[int]) -> np.ndarray:
+    """Convert ints of up to 128 bit to an array of dtype WIDE_INDEX_DTYPE."""
+    return np.array([(i >> 64, i & 0xFFFFFFFFFFFFFFFF) for i in indices],
+                    dtype=WIDE_INDEX_DTYPE)
+
+
+# Binary ciphertext format: version | nonce | length | ciphertext | tag
+CIPHERTEXT_VERSION = 1
+NONCE_LEN = 16  # Byte
+TAG_LEN = 16  # Byte
+_ENVELOPE_HEADER = struct.Struct(f'>B{NONCE_LEN}sI')
+
+
+def _encode_length(length: int) -> bytes:
+    """Return the length encoding used as associated data."""
+    return length.to_bytes((length.bit_length() + 7) // 8, byteorder='big')
+
+
+def pack_ciphertext(nonce: bytes, length: int, ciphertext: bytes,
+                    mac: bytes) -> bytes:
+    """
+    Pack the components of an encrypted record into the binary format.
+    The long hash is not contained because it is implied by the DB row.
+    :param nonce: GCM nonce
+    :param length: Number of floats in the record
+    :param ciphertext: Encrypted record
+    :param mac: GCM tag
+    :return: Binary ciphertext
+    """
+    if len(nonce) != NONCE_LEN or len(mac) != TAG_LEN:
+        raise ValueError(f"Binary format requires a {NONCE_LEN} Byte nonce "
+                         f"and a {TAG_LEN} Byte tag.")
+    return (_ENVELOPE_HEADER.pack(CIPHERTEXT_VERSION, nonce, length) +
+            ciphertext + mac)
+
+
+def unpack_ciphertext(data: bytes) -> Tuple[bytes, int, bytes, bytes]:
+    """
+    Split a binary ciphertext into its components.
+    :param data: Binary ciphertext
+    :return: (nonce, length, ciphertext, mac)
+    """
+    if len(data) < _ENVELOPE_HEADER.size + TAG_LEN:
+        raise ValueError("Binary ciphertext is too short.")
+    version, nonce, length = _ENVELOPE_HEADER.unpack_from(data)
+    if version != CIPHERTEXT_VERSION:
+        raise ValueError(f"Unsupported ciphertext version: {version}")
+    ciphertext = data[_ENVELOPE_HEADER.size:-TAG_LEN]
+    if len(ciphertext) != 8 * length:
+        raise ValueError("Ciphertext does not match the record length.")
+    return nonce, length, ciphertext, data[-TAG_LEN:]
+
+
+def is_json_ciphertext(ciphertext: str) -> bool:
+    """Return True if the stored ciphertext uses the legacy JSON format."""
+    return ciphertext.lstrip().startswith('{')
+
+
+def json_to_binary_ciphertext(ciphertext: str) -> str:
+    """
+    Convert a ciphertext from the JSON format into the binary format.
+    No key is required because the associated data is unchanged.
+    :param ciphertext: json.dumps(ciphertext-dict)
+    :return: Base64(binary ciphertext)
+    """
+    d = {k: from_base64(v) for k, v in json.loads(ciphertext).items()}
+    length = int.from_bytes(d['length'], byteorder='big')
+    return to_base64(
+        pack_ciphertext(d['nonce'], length, d['ciphertext'], d['mac']))
+
+
+def encrypt_vector(key: bytes, record: List[float] or np.ndarray,
+                   long_hash: bytes,
+                   nonce: bytes = None) -> Tuple[bytes, int, bytes, bytes]:
+    """
+    Encrypt a record with AES-GCM authenticating its length and long hash.
+    :param key: Encryption key
+    :param record: Record as list of floats or 1-D array
+    :param long_hash: Long hash of the record
+    :param nonce: DEBUG ONLY!
+    :return: (nonce, length, ciphertext, mac)
+    """
+    if isinstance(record, np.ndarray):
+        # Same native double representation as struct
+        data = np.ascontiguousarray(record, dtype=np.float64).tobytes()
+    else:
+        data = struct.pack('%sd' % len(record), *record)
+    if nonce is not None:
+        cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
+    else:
+        cipher = AES.new(key, AES.MODE_GCM)
+    cipher.update(_encode_length(len(record)))
+    cipher.update(long_hash)
+    ciphertext, mac = cipher.encrypt_and_digest(data)
+    return cipher.nonce, len(record), ciphertext, mac
+
+
+def decrypt_ciphertext(ciphertext: dict or str or bytes, key: bytes,
+                       long_hash: bytes = None) -> Tuple[float]:
+    """
+    Decrypt a ciphertext in any of the supported formats.
+    :param ciphertext: Ciphertext dict, binary ciphertext or the stored
+                       string form of either (JSON or Base64)
+    :param key: Encryption key
+    :param long_hash: Long hash of the record, required for the binary
+                      format
+    :return: Decrypted record as tuple of floats
+    """
+    if isinstance(ciphertext, str):
+        if is_json_ciphertext(ciphertext):
+            ciphertext = json.loads(ciphertext)
+        else:
+            ciphertext = from_base64(ciphertext)
+    if isinstance(ciphertext, dict):
+        json_k = ['nonce', 'length', 'hash', 'ciphertext', 'mac']
+        jv = {k: from_base64(ciphertext[k]) for k in json_k}
+        nonce, length_bytes, long_hash = (
+            jv['nonce'], jv['length'], jv['hash'])
+        ciphertext, mac = jv['ciphertext'], jv['mac']
+        length = int.from_bytes(length_bytes, byteorder='big')
+    else:
+        if long_hash is None:
+            raise ValueError(
+                "Decryption of binary ciphertexts requires the long hash.")
+        nonce, length, ciphertext, mac = unpack_ciphertext(ciphertext)
+        length_bytes = _encode_length(length)
+    cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
+    cipher.update(length_bytes)
+    cipher.update(long_hash)
+    plaintext = cipher.decrypt_and_verify(ciphertext, mac)
+    return struct.unpack('%sd' % length, plaintext)
+
+
+def _encrypt_chunk(chunk: List[Tuple[bytes, list]]) -> List[str]:
+    """
+    Encrypt one chunk of the batch crypto stage.
+    :param chunk: List of (key, [(record, long_hash, binary), ...])
+    :return: Upload representation of all ciphertexts in chunk order
+    """
+    result = []
+    for key, items in chunk:
+        for record, long_hash, binary in items:
+            nonce, length, ciphertext, mac = encrypt_vector(
+                key, record, long_hash)
+            if binary:
+                result.append(to_base64(
+                    pack_ciphertext(nonce, length, ciphertext, mac)))
+            else:
+                json_k = ['nonce', 'length', 'hash', 'ciphertext', 'mac']
+                json_v = [to_base64(x) for x in
+                          (nonce, _encode_length(length), long_hash,
+                           ciphertext, mac)]
+                result.append(json.dumps(dict(zip(json_k, json_v))))
+    return result
+
+
+def _decrypt_chunk(chunk: List[Tuple[bytes, list]]) -> List[Tuple[float]]:
+    """
+    Decrypt one chunk of the batch crypto stage.
+    :param chunk: List of (key, [(ciphertext, long_hash), ...])
+    :return: Decrypted records in chunk order
+    """
+    result = []
+    for key, items in chunk:
+        for ciphertext, long_hash in items:
+            result.append(decrypt_ciphertext(ciphertext, key, long_hash))
+    return result
+
+
+def _run_crypto_stage(func, items: List[tuple], keys: List[bytes],
+                      pool: Pool = None) -> List[Any]:
+    """
+    Apply a chunk function to all items, grouped by encryption key.
+    Chunks are distributed over a process pool if parallelism is enabled.
+    :param func: _encrypt_chunk or _decrypt_chunk
+    :param items: Per item arguments
+    :param keys: Encryption key of each item
+    :param pool: [optional] Process pool to use instead of a new one, e.g.,
+                 because other threads are running
+    :return: Results in input order
+    """
+    if len(items) != len(keys):
+        raise ValueError("Exactly one key per item is required.")
+    order = sorted(range(len(items)), key=lambda i: keys[i])
+    step = config.CRYPTO_CHUNK_SIZE
+    chunks = []
+    for start in range(0, len(order), step):
+        chunk = []
+        for i in order[start:start + step]:
+            if not chunk or chunk[-1][0] != keys[i]:
+                chunk.append((keys[i], []))
+            chunk[-1][1].append(items[i])
+        chunks.append(chunk)
+    if pool is not None and len(chunks) > 1:
+        chunk_results = pool.map(func, chunks)
+    elif config.PARALLEL and len(chunks) > 1:
+        with mp.Pool(min(len(chunks), config.MAX_PROCS)) as pool:
+            chunk_results = pool.map(func, chunks)
+    else:
+        chunk_results = [func(c) for c in chunks]
+    result = [None] * len(items)
+    for i, res in zip(order,
+                      (r for chunk in chunk_results for r in chunk)):
+        result[i] = res
+    return result
+
+
 def round_record(record: List[float],
                  rnd_vec: List[int] = config.ROUNDING_VEC,
                  id_len: int = config.RECORD_ID_LENGTH) -> List[float]:
@@ -90,6 +423,20 @@ def round_record(record: List[float],
     return res
 
 
+def round_records(vectors: np.ndarray,
+                  rnd_vec: List[int] = config.ROUNDING_VEC,
+                  id_len: int = config.RECORD_ID_LENGTH) -> np.ndarray:
+    """
+    Vectorized version of round_record for a 2-D block of records.
+    :param vectors: Array of records, one per row
+    :param rnd_vec: Record Rounding Parameters
+    :param id_len: ID length of record (X Part)
+    :return: Array of shape (n, id_len) with rounded identifiers
+    """
+    id_part = np.asarray(vectors, dtype=np.float64)[:, :id_len]
+    return round_array(id_part, rnd_vec[:id_part.shape[1]])
+
+
 class Record:
     """Class representing one data record."""
 
@@ -102,7 +449,7 @@ class Record:
         return not self.__eq__(o)
 
     def __eq__(self, o: object) -> bool:
-        if not isinstance(o, Record):
+        if not isinstance(o, (Record, RecordView)):
             return False
         if self.owner is None or o.owner is None:
             return self.record == o.record
@@ -161,9 +508,15 @@ class Record:
         return round_record(self.record, self._rounding_vector,
                             config.RECORD_ID_LENGTH)
 
-    def set_hash_key(self, key: bytes) -> None:
-        """Set the key ussed in hashing."""
+    def set_hash_key(self, key: bytes, long_hash: bytes = None) -> None:
+        """Set the key ussed in hashing.
+
+        :param key: Hash key
+        :param long_hash: [optional] Long hash already computed with this
+                          key, e.g., by a RecordBatch
+        """
         self._hash_key = key
+        self._long_hash = long_hash
 
     def set_encryption_key(self, key: bytes) -> None:
         """Define the key used for encryption."""
@@ -176,54 +529,61 @@ class Record:
         # two entries per position.
         return str(self._get_rounded_record()).encode('utf-8')
 
-    def get_encrypted_record(self, enc_key: bytes = None, nonce: bytes =
-                             None) -> dict:
+    def _encrypt(self, enc_key: bytes = None, nonce: bytes = None
+                 ) -> Tuple[bytes, int, bytes, bytes]:
         """
-        Return the encrypted form of the record.
+        Encrypt the record.
         :param enc_key: Key used for encryption.
         :param nonce: DEBUG ONLY!
-        :return: Encrypted record as dict
+        :return: (nonce, length, ciphertext, mac)
         """
         if enc_key is None and self._encryption_key is None:
             raise ValueError("No encryption key defined.")
         if enc_key is not None:
             self._encryption_key = enc_key
-        length = len(self.record).to_bytes((len(self.record).bit_length() + 7)
-                                           // 8,
-                                           byteorder='big')
-        buf = struct.pack('%sd' % len(self.record), *self.record)
-        data = buf
-        longhash = self.get_long_hash()
-        key = self._encryption_key
-        # log.debug(f"Encryption - Using key: {self._encryption_key}")
-        if nonce is not None:
-            cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
-        else:
-            cipher = AES.new(key, AES.MODE_GCM)
-        cipher.update(length)
-        cipher.update(longhash)
-        ciphertext, mac = cipher.encrypt_and_digest(data)
+        return encrypt_vector(self._encryption_key, self.record,
+                              self.get_long_hash(), nonce)
+
+    def get_encrypted_record(self, enc_key: bytes = None, nonce: bytes =
+                             None) -> dict:
+        """
+        Return the encrypted form of the record.
+        :param enc_key: Key used for encryption.
+        :param nonce: DEBUG ONLY!
+        :return: Encrypted record as dict
+        """
+        nonce, length, ciphertext, mac = self._encrypt(enc_key, nonce)
         json_k = ['nonce', 'length', 'hash', 'ciphertext', 'mac']
         json_v = [to_base64(x) for x in
-                  (cipher.nonce, length, longhash, ciphertext, mac)]
+                  (nonce, _encode_length(length), self.get_long_hash(),
+                   ciphertext, mac)]
         result = dict(zip(json_k, json_v))
         return result
 
+    def get_encrypted_bytes(self, enc_key: bytes = None, nonce: bytes =
+                            None) -> bytes:
+        """
+        Return the encrypted form of the record in the binary format.
+        :param enc_key: Key used for encryption.
+        :param nonce: DEBUG ONLY!
+        :return: Binary ciphertext (without long hash)
+        """
+        return pack_ciphertext(*self._encrypt(enc_key, nonce))
+
     @classmethod
-    def from_ciphertext(cls, ciphertext: dict, key: bytes) -> Any:
-        """Create a record by decrypting a ciphertext"""
+    def from_ciphertext(cls, ciphertext: dict or str or bytes, key: bytes,
+                        long_hash: bytes = None) -> Any:
+        """
+        Create a record by decrypting a ciphertext
+        :param ciphertext: Ciphertext dict, binary ciphertext or the stored
+                           string form of either (JSON or Base64)
+        :param key: Encryption key
+        :param long_hash: Long hash of the record, required for the binary
+                          format
+        :return: Decrypted record
+        """
         log.debug(f"Decryption - Using key: {key}")
-        b64 = ciphertext
-        json_k = ['nonce', 'length', 'hash', 'ciphertext', 'mac']
-        jv = {k: from_base64(b64[k]) for k in json_k}
-        cipher = AES.new(key, AES.MODE_GCM, nonce=jv['nonce'])
-        cipher.update(jv['length'])
-        cipher.update(jv['hash'])
-        length = int.from_bytes(jv['length'], byteorder='big')
-        plaintext = cipher.decrypt_and_verify(jv['ciphertext'], jv['mac'])
-        record_list = struct.unpack('%sd' % length, plaintext)
-        record = Record(record_list)
-        return record
+        return Record(decrypt_ciphertext(ciphertext, key, long_hash))
 
     def to_hash_rec_tuple(self) -> Tuple[str, List[float]]:
         """Return record as a tuple (long-hash HEX, record)"""
@@ -245,11 +605,17 @@ class Record:
     def get_upload_format(self) -> Tuple[str, str, str]:
         """
         Return format required for upload to storage server
-        :return: [Base64(long_hash), json.dumps(ciphertext), owner]
+        :return: [Base64(long_hash), Base64(binary ciphertext), owner] or
+                 [Base64(long_hash), json.dumps(ciphertext), owner] if the
+                 binary format is disabled
         """
+        if config.BINARY_CIPHERTEXT:
+            ciphertext = to_base64(self.get_encrypted_bytes())
+        else:
+            ciphertext = json.dumps(self.get_encrypted_record())
         return (
             to_base64(self.get_long_hash()),
-            json.dumps(self.get_encrypted_record()),
+            ciphertext,
             self.get_owner()
         )
 
@@ -262,3 +628,353 @@ class Record:
             return str(self.to_hash_rec_tuple())
         else:
             return str(self.to_full_tuple())
+
+
+def batch_get_upload_format(records: List[Record]
+                            ) -> List[Tuple[str, str, str]]:
+    """
+    Return the upload format of all records, see Record.get_upload_format.
+    Encryption is performed in parallel chunks grouped by encryption key.
+    :param records: Records with hash key, encryption key and owner set
+    :return: List of [Base64(long_hash), ciphertext, owner]
+    """
+    keys = []
+    for r in records:
+        if r._encryption_key is None:
+            raise ValueError("No encryption key defined.")
+        keys.append(r._encryption_key)
+    hashes = [r.get_long_hash() for r in records]
+    items = [(r.record, h, config.BINARY_CIPHERTEXT)
+             for r, h in zip(records, hashes)]
+    ciphertexts = _run_crypto_stage(_encrypt_chunk, items, keys)
+    return [
+        (to_base64(h), c, r.get_owner())
+        for r, h, c in zip(records, hashes, ciphertexts)
+    ]
+
+
+def batch_from_ciphertext(ciphertexts: List[Tuple[str, str]],
+                          keys: List[bytes]) -> List[Record]:
+    """
+    Decrypt all ciphertexts, see Record.from_ciphertext.
+    Decryption is performed in parallel chunks grouped by encryption key.
+    :param ciphertexts: List of (Base64(long_hash), ciphertext) as returned
+                        by the storage server
+    :param keys: Encryption key of each ciphertext
+    :return: Decrypted records in input order
+    """
+    items = [(c, from_base64(h)) for h, c in ciphertexts]
+    return [Record(r)
+            for r in _run_crypto_stage(_decrypt_chunk, items, keys)]
+
+
+class RecordBatch:
+    """
+    Block of record vectors that are hashed together.
+    Yields the same long hashes, PSI indices and OT indices as the
+    corresponding Record objects without creating one object per vector.
+    """
+
+    HASH_LEN = 64  # Byte, SHA3-512
+
+    def __init__(self, vectors: Iterable[Iterable[float]] or np.ndarray,
+                 hash_key: bytes = None,
+                 rounding_vec: List[int] = None,
+                 id_len: int = None,
+                 cache: HashCache = None) -> None:
+        """
+        Store vectors as 2-D float64 array. Hashes are only generated
+        on-demand.
+        :param vectors: 2-D block of record vectors (one per row)
+        :param hash_key: Key used for hashing
+        :param rounding_vec: [optional] Record Rounding Parameters
+        :param id_len: [optional] ID length of records (X Part)
+        :param cache: [optional] HashCache for the given hash key
+        """
+        try:
+            self.vectors = np.asarray(vectors, dtype=np.float64)
+        except (TypeError, ValueError):
+            raise TypeError("Records must only contain numbers!")
+        if self.vectors.size == 0:
+            self.vectors = self.vectors.reshape(0, config.RECORD_LENGTH)
+        if self.vectors.ndim != 2 or \
+                self.vectors.shape[1] != config.RECORD_LENGTH:
+            raise ValueError(
+                f"Records have not a length of {config.RECORD_LENGTH},"
+                f"But: {self.vectors.shape}!")
+        if rounding_vec is None:
+            rounding_vec = config.ROUNDING_VEC
+        if id_len is None:
+            id_len = config.RECORD_ID_LENGTH
+        self._rounding_vector = rounding_vec
+        self._identifier_length = id_len
+        self._hash_key = hash_key
+        self._long_hashes: np.ndarray = None
+        self._psi_indices: List[int] = None
+        self.cache = cache
+
+    def __len__(self) -> int:
+        return len(self.vectors)
+
+    def set_hash_key(self, key: bytes) -> None:
+        """Set the key used in hashing and drop hashes of the old key."""
+        self._hash_key = key
+        self._long_hashes = None
+        self._psi_indices = None
+        self.cache = None  # Belongs to old key
+
+    def get_identifiers(self) -> List[bytes]:
+        """Return the identifier of each vector as used for hashing."""
+        rounded = round_records(self.vectors, self._rounding_vector,
+                                self._identifier_length).tolist()
+        return [str(v).encode('utf-8') for v in rounded]
+
+    def get_long_hashes(self) -> np.ndarray:
+        """
+        Return the long hashes of all vectors packed into an array of shape
+        (n, 64) and dtype uint8. Row i equals Record.get_long_hash() of
+        vector i.
+        """
+        if self._hash_key is None:
+            raise ValueError("The hash key has to be set before hashes can "
+                             "be computed!")
+        if self._long_hashes is None:
+            keyed = hashlib.sha3_512(self._hash_key)
+            identifiers = self.get_identifiers()
+            if self.cache is not None:
+                cached = self.cache.lookup(identifiers)
+            else:
+                cached = [None] * len(identifiers)
+            digests = bytearray()
+            new = []
+            for identifier, h in zip(identifiers, cached):
+                if h is None:
+                    m = keyed.copy()
+                    m.update(identifier)
+                    h = m.digest()
+                    new.append((identifier, h))
+                digests += h
+            if self.cache is not None and new:
+                self.cache.store(new)
+            self._long_hashes = np.frombuffer(
+                bytes(digests), dtype=np.uint8).reshape(len(self),
+                                                        self.HASH_LEN)
+        return self._long_hashes
+
+    def get_long_hash(self, i: int) -> bytes:
+        """Return long hash of the i-th vector as bytes."""
+        return self.get_long_hashes()[i].tobytes()
+
+    def get_psi_indices(self) -> List[int]:
+        """Return the PSI indices of all vectors as ints (too long for an
+        array)."""
+        if self._psi_indices is None:
+            self._psi_indices = [
+                hash_to_index(h, config.PSI_INDEX_LEN)
+                for h in self._iter_hash_bytes()
+            ]
+        return self._psi_indices
+
+    def get_wide_psi_indices(self) -> np.ndarray:
+        """Return the PSI indices of all vectors as array of dtype
+        WIDE_INDEX_DTYPE."""
+        return hashes_to_wide_indices(self.get_long_hashes(),
+                                      config.PSI_INDEX_LEN)
+
+    def get_ot_indices(self) -> np.ndarray:
+        """Return the OT indices of all vectors as array."""
+        return hashes_to_indices(self.get_long_hashes(), config.OT_INDEX_LEN)
+
+    def get_record(self, i: int) -> Record:
+        """Return the i-th vector as Record with hash key and long hash
+        already set."""
+        r = Record(self.vectors[i].tolist())
+        if self._hash_key is not None:
+            r.set_hash_key(self._hash_key,
+                           long_hash=self.get_long_hash(i))
+        return r
+
+    def _iter_hash_bytes(self) -> Iterable[bytes]:
+        """Iterate over the long hashes as bytes objects."""
+        raw = self.get_long_hashes().tobytes()
+        for i in range(0, len(raw), self.HASH_LEN):
+            yield raw[i:i + self.HASH_LEN]
+
+
+class RecordTable(RecordBatch):
+    """
+    Columnar container for many records of one owner. All vectors are
+    kept in one contiguous float64 array, hashes and encryption keys in
+    uint8 arrays. Rows are only materialized as lightweight views.
+    """
+
+    def __init__(self, vectors: Iterable[Iterable[float]] or np.ndarray,
+                 hash_key: bytes = None,
+                 owner: str = None,
+                 rounding_vec: List[int] = None,
+                 id_len: int = None) -> None:
+        """
+        Create table from a 2-D block of vectors.
+        :param vectors: 2-D block of record vectors (one per row)
+        :param hash_key: Key used for hashing
+        :param owner: Owner of all records
+        :param rounding_vec: [optional] Record Rounding Parameters
+        :param id_len: [optional] ID length of records (X Part)
+        """
+        super().__init__(vectors, hash_key, rounding_vec, id_len)
+        self.owner = owner
+        self._encryption_keys: np.ndarray = None
+
+    @classmethod
+    def iter_file(cls, file: str, chunk_size: int,
+                  **kwargs) -> Iterator['RecordTable']:
+        """
+        Read a record file chunk-wise. Text files contain one record per
+        line, binary (.npy) files are memory-mapped.
+        :param file: Path to the file containing the records
+        :param chunk_size: Maximal number of records per table
+        :return: Iterator over RecordTables
+        """
+        if is_binary_record_file(file):
+            vectors = load_records(file)
+            for i in range(0, len(vectors), chunk_size):
+                yield cls(vectors[i:i + chunk_size], **kwargs)
+            return
+        with open(file, "r") as fd:
+            while True:
+                lines = list(itertools.islice(fd, chunk_size))
+                if not lines:
+                    return
+                vectors = parse_lists(lines)
+                if len(vectors) > 0:
+                    yield cls(vectors, **kwargs)
+
+    @classmethod
+    def from_file(cls, file: str, **kwargs) -> 'RecordTable':
+        """
+        Read all records from a text or binary (.npy) record file.
+        Text lines are converted block-wise to keep the overhead low.
+        :param file: Path to the file containing the records
+        :return: RecordTable containing all records
+        """
+        if is_binary_record_file(file):
+            return cls(load_records(file), **kwargs)
+        blocks = [t.vectors for t in
+                  cls.iter_file(file, config.HASH_BATCH_SIZE)]
+        if not blocks:
+            return cls([], **kwargs)
+        return cls(np.concatenate(blocks), **kwargs)
+
+    def __getitem__(self, i: int) -> 'RecordView':
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("RecordTable index out of range.")
+        return RecordView(self, i)
+
+    def __iter__(self) -> Iterable['RecordView']:
+        for i in range(len(self)):
+            yield RecordView(self, i)
+
+    def get_owner(self) -> str:
+        """Return owner."""
+        if self.owner is None:
+            raise RuntimeError("No owner set.")
+        return self.owner
+
+    def set_encryption_keys(self, keys: List[bytes]) -> None:
+        """
+        Define the encryption key of each record.
+        :param keys: One key per record in table order
+        """
+        if len(keys) != len(self):
+            raise ValueError("Exactly one key per record is required.")
+        self._encryption_keys = np.frombuffer(
+            b"".join(keys), dtype=np.uint8).reshape(len(self), -1)
+
+    def get_encryption_key(self, i: int) -> bytes:
+        """Return the encryption key of the i-th record."""
+        if self._encryption_keys is None:
+            raise ValueError("No encryption key defined.")
+        return self._encryption_keys[i].tobytes()
+
+    def get_upload_format(self, pool: Pool = None
+                          ) -> List[Tuple[str, str, str]]:
+        """
+        Return format required for upload of all records to storage server,
+        see Record.get_upload_format.
+        :param pool: [optional] Process pool for the encryption
+        :return: List of [Base64(long_hash), ciphertext, owner]
+        """
+        if self._encryption_keys is None:
+            raise ValueError("No encryption key defined.")
+        owner = self.get_owner()
+        hashes = list(self._iter_hash_bytes())
+        keys = [k.tobytes() for k in self._encryption_keys]
+        items = [(self.vectors[i], hashes[i], config.BINARY_CIPHERTEXT)
+                 for i in range(len(self))]
+        ciphertexts = _run_crypto_stage(_encrypt_chunk, items, keys, pool)
+        return [(to_base64(h), c, owner)
+                for h, c in zip(hashes, ciphertexts)]
+
+
+class RecordView:
+    """Row of a RecordTable offering the read-only Record interface."""
+
+    __slots__ = ('_table', '_index')
+
+    def __init__(self, table: RecordTable, index: int) -> None:
+        self._table = table
+        self._index = index
+
+    def __eq__(self, o: object) -> bool:
+        if not isinstance(o, (Record, RecordView)):
+            return False
+        if self.owner is None or o.owner is None:
+            return self.record == o.record
+        else:
+            return self.record == o.record and self.owner == o.owner
+
+    def __ne__(self, o: object) -> bool:
+        return not self.__eq__(o)
+
+    def __str__(self) -> str:
+        return str(self.to_record())
+
+    @property
+    def record(self) -> List[float]:
+        """Return the record as list of floats."""
+        return self._table.vectors[self._index].tolist()
+
+    @property
+    def owner(self) -> str:
+        """Return owner of the table."""
+        return self._table.owner
+
+    def get_owner(self) -> str:
+        """Return owner."""
+        return self._table.get_owner()
+
+    def get_long_hash(self) -> bytes:
+        """Return long hash of the record."""
+        return self._table.get_long_hash(self._index)
+
+    def get_psi_index(self) -> int:
+        """Return PSI index of the record."""
+        return self._table.get_psi_indices()[self._index]
+
+    def get_ot_index(self) -> int:
+        """Return OT index of the record."""
+        return hash_to_index(self.get_long_hash(), config.OT_INDEX_LEN)
+
+    def to_record(self) -> Record:
+        """Materialize the row as full Record object."""
+        r = self._table.get_record(self._index)
+        r.owner = self._table.owner
+        if self._table._encryption_keys is not None:
+            r.set_encryption_key(self._table.get_encryption_key(self._index))
+        return r
+
+    def get_upload_format(self) -> Tuple[str, str, str]:
+        """Return format required for upload to storage server."""
+        return self.to_record().get_upload_format()
@@ -5,7 +5,9 @@ Author: Erik Buchholz
 Maintainer: Erik Buchholz
 E-mail: buchholz@comsys.rwth-aachen.de
 """
+import bisect
 import copy
+import itertools
 import logging
 import math
 import re
@@ -13,12 +15,37 @@ from abc import ABC, abstractmethod
 from collections.abc import Iterator
 from typing import List, Iterable, Sized
 
+import numpy as np
+
 from lib import config as cnf
-from lib.record import Record, round_s, get_power
+from lib.hash_cache import HashCache
+from lib.record import Record, RecordBatch, round_s, get_power
 
 log: logging.Logger = logging.getLogger(__name__)
 
 
+def _count(digits: List[int], radices: List[int],
+           n: int) -> (List[np.ndarray], List[int]):
+    """
+    Add 0..n to the mixed-radix number given by digits, the last position
+    changing fastest. Only the small offsets are NumPy integers, so
+    arbitrarily large ranks are supported.
+    :param digits: Digits of the first number
+    :param radices: Radix of each position
+    :param n: Number of consecutive numbers
+    :return: Digit array (length n) for each position, digits of the number
+             following the n numbers (wraps around at the end)
+    """
+    columns = [None for _ in radices]
+    following = list(digits)
+    carry = np.arange(n + 1, dtype=np.int64)
+    for pos in range(len(radices) - 1, -1, -1):
+        carry, d = np.divmod(carry + digits[pos], radices[pos])
+        columns[pos] = d[:n]
+        following[pos] = int(d[n])
+    return columns, following
+
+
 class SimilarityMetricIterator(Iterator, ABC):  # pragma no cover
     """Base class for similarity metrics."""
 
@@ -44,16 +71,20 @@ class SimilarityMetricIterator(Iterator, ABC):  # pragma no cover
         self.id_len = record_id_length
 
     @abstractmethod
-    def split(self, n: int, j: int = 0) -> List[Iterator]:
+    def split(self, n: int) -> List[Iterator]:
         """
-        Try to split iterator into at least (!) n smaller, as equal sized as
-        possible, iterators if possible and into the maximal number otherwise.
+        Split iterator into n (or fewer if too short) iterators over
+        contiguous parts of equal size.
         :param n: # Iterators to generate
-        :param j: Index to split on
         :return: List of created Iterators
         """
         pass
 
+    @abstractmethod
+    def __getitem__(self, key: int or slice):
+        """Return candidate at index or iterator over slice."""
+        pass
+
     @abstractmethod
     def __len__(self):
         pass
@@ -68,7 +99,13 @@ class RecordIterator(Iterator):
     objects.
     """
 
-    def __init__(self, it: Iterable, hash_key: bytes):
+    def __init__(self, it: Iterable, hash_key: bytes,
+                 cache: HashCache = None):
+        """
+        :param it: Iterator over candidate vectors
+        :param hash_key: Key used for hashing
+        :param cache: [optional] HashCache used by iter_batches
+        """
         # noinspection PyTypeChecker
         self._iterator = iter(it)
         if isinstance(it, Sized):
@@ -76,6 +113,7 @@ class RecordIterator(Iterator):
         else:
             self._len = 0
         self._hash_key = hash_key
+        self.cache = cache
 
     def __iter__(self):
         return self
@@ -85,6 +123,43 @@ class RecordIterator(Iterator):
         r = Record(vec, hash_key=self._hash_key)
         return r
 
+    @property
+    def supports_best_first(self) -> bool:
+        """True if iter_batches can order candidates by distance."""
+        return isinstance(self._iterator,
+                          (OffsetIterator, GridRegionIterator))
+
+    def iter_batches(self, size: int = None,
+                     best_first: bool = False) -> Iterator:
+        """
+        Iterate over the remaining candidates in RecordBatches so that
+        hashes are computed block-wise instead of per Record object.
+        :param size: Maximal number of candidates per batch
+        :param best_first: Order candidates by increasing distance from the
+                           target (offset and grid region metrics only)
+        :return: Iterator over RecordBatch objects
+        """
+        if size is None:
+            size = cnf.HASH_BATCH_SIZE
+        if best_first:
+            if not self.supports_best_first:
+                raise ValueError(
+                    f"Best-first order is not supported by "
+                    f"{self._iterator.__class__.__name__}.")
+            for vectors in self._iterator.iter_rings(size):
+                yield RecordBatch(vectors, self._hash_key, cache=self.cache)
+            return
+        if isinstance(self._iterator, (OffsetIterator, OffsetDeltaIterator)):
+            # Generate candidates directly as array
+            for vectors in self._iterator.iter_blocks(size):
+                yield RecordBatch(vectors, self._hash_key, cache=self.cache)
+            return
+        while True:
+            vectors = list(itertools.islice(self._iterator, size))
+            if not vectors:
+                return
+            yield RecordBatch(vectors, self._hash_key, cache=self.cache)
+
     def __len__(self) -> int:
         if isinstance(self._iterator, Sized):
             return len(self._iterator)
@@ -99,57 +174,26 @@ class OffsetIterator(SimilarityMetricIterator, ABC):
 
     end = False
 
-    def split(self, n: int, j: int = 0) -> List[Iterator]:
+    def split(self, n: int) -> List[Iterator]:
         """
-        Try to split iterator into at least n smaller, as equal sized as
-        possible, iterators if possible and into the maximal number otherwise.
+        Split iterator into n iterators over contiguous rank ranges of equal
+        size (+-1). Fewer iterators are returned if the iterator has less
+        than n elements. The parts share the precomputed axes.
         :param n: # Iterators to generate
-        :param j: Index to split on
         :return: List of created Iterators
         """
-        if self.cur_vec != self.min or self.end:
+        if self._rank != self._start:
             raise RuntimeError("Cannot call split on used iterator!")
+        n = max(1, min(n, self.size))
+        size, rest = divmod(self.size, n)
         iterators = []
-        inc = self.increments[j]
-        diff = (self.max[j] - self.min[j]) / n
-        diff = max(diff / inc, 1)
+        start = self._start
         for i in range(n):
-            if i == 0:
-                it = copy.deepcopy(self)
-                it.min[j] = round_s(it.min[j], self._rounding_vec[j])
-                it.max[j] = round_s(it.min[j] + int(diff) * inc,
-                                    self._rounding_vec[j])
-                iterators.append(it)
-            elif round_s(iterators[-1].max[j] + inc,
-                         self._rounding_vec[j]) <= self.max[
-                    j]:
-                it = copy.deepcopy(self)
-                it.min[j] = round_s(iterators[-1].max[j] + inc,
-                                    self._rounding_vec[j])
-                it.max[j] = round_s(
-                    self.min[j] + int((i + 1) * diff) * inc,
-                    self._rounding_vec[j])
-                iterators.append(it)
-            else:  # pragma no cover
-                break
-        # Last iterator has to go till end
-        iterators[-1].max[j] = self.max[j]
-        for it in iterators:
-            it.cur_vec = it.min[:]
-        final_iterators = []
-        if len(iterators) < n and j < self.id_len - 1:
-            # Try to split on next index
-            sub_num = int(math.ceil((n - len(iterators)) / len(iterators)))
-            for it in iterators:
-                final_iterators.extend(it.split(sub_num, j + 1))
-        else:
-            final_iterators = iterators
-        if j == 0:
-            log.debug(f"Final split into {len(final_iterators)} iterators.")
-        # Debug
-        # for it in final_iterators:
-        #     print(it.min, it.max)
-        return final_iterators
+            stop = start + size + (1 if i < rest else 0)
+            iterators.append(self._view(start, stop))
+            start = stop
+        log.debug(f"Split into {len(iterators)} iterators of size {size}.")
+        return iterators
 
     @abstractmethod  # min and max are dependent on concrete implementation
     def __init__(self, target: List[float], offsets: List[float],
@@ -157,57 +201,250 @@ class OffsetIterator(SimilarityMetricIterator, ABC):
                  record_id_length: int = None):
         super().__init__(target, rounding_vec=rounding_vec,
                          record_id_length=record_id_length)
+        self.target = list(target)
         self.offsets = offsets
-        self.start_pos = 0
-        self.pos = self.id_len - 1
         self.end = False
         self.increments = []
         self.min = []
         self.max = []
         self.cur_vec = []
+        self.axes = []
+        self._digits = []
+        self._total = 0
+        self._start = 0
+        self._stop = 0
+        self._rank = 0
+
+    def _init_axes(self) -> None:
+        """
+        Precompute the admissible values of each identifier position between
+        min and max. Candidates are then enumerated by a mixed-radix counter
+        over these axes, the last position changing fastest. The rank of a
+        candidate is its position in this enumeration.
+        """
+        self.axes = []
+        for i in range(len(self.max)):
+            rnd = self._rounding_vec[i]
+            axis = [self.min[i]]
+            # The first step uses the increment of the rounded minimum, even
+            # if min has been replaced by the target value. Afterwards, the
+            # increment changes when the value crosses a power of ten.
+            v = round_s(axis[-1] + self.increments[i], rnd)
+            while v <= self.max[i]:
+                axis.append(v)
+                v = round_s(v + compute_increment(v, rnd), rnd)
+            self.axes.append(axis)
+        self._set_axes()
+
+    def _set_axes(self) -> None:
+        """Derive the counter state from the axes and reset the iterator."""
+        # Used for block-wise generation
+        self._axis_arrays = [np.array(a, dtype=np.float64) for a in self.axes]
+        # Used for membership tests
+        self._axis_keys = [set(round_s(v, rnd) for v in axis)
+                           for axis, rnd in zip(self.axes, self._rounding_vec)]
+        self._tail = np.array(self.min[len(self.axes):], dtype=np.float64)
+        self._total = 1
+        for axis in self.axes:
+            self._total *= len(axis)
+        self._start = 0
+        self._stop = self._total
+        self._reset()
+
+    def _reset(self) -> None:
+        """Position the counter at the start of the rank range."""
+        self._rank = self._start
+        self.end = self._start >= self._stop
+        # An empty range keeps valid digits, it is never advanced
+        first = max(min(self._start, self._stop - 1), 0)
+        self._digits = self._to_digits(first)
+        self.cur_vec = [axis[d] for axis, d in zip(self.axes, self._digits)]
+        self.cur_vec.extend(self.min[len(self.axes):])
+
+    def _to_digits(self, rank: int) -> List[int]:
+        """
+        Convert a rank into the mixed-radix digits (axis positions).
+        :param rank: Rank of the candidate
+        :return: Index into each axis
+        """
+        digits = [0 for _ in self.axes]
+        for pos in range(len(self.axes) - 1, -1, -1):
+            rank, digits[pos] = divmod(rank, len(self.axes[pos]))
+        return digits
+
+    def _view(self, start: int, stop: int) -> 'OffsetIterator':
+        """
+        Return a fresh iterator over the given rank range that shares the
+        axes with this one instead of copying them.
+        :param start: First rank (inclusive)
+        :param stop: Last rank (exclusive)
+        :return: New iterator
+        """
+        it = self.__class__.__new__(self.__class__)
+        it.__dict__.update(self.__dict__)
+        it._start = start
+        it._stop = stop
+        it._reset()
+        return it
+
+    def unrank(self, rank: int) -> tuple:
+        """
+        Return the candidate with the given rank, i.e., the rank-th candidate
+        of the full (unsplit) iterator.
+        :param rank: Global rank of the candidate
+        :return: Candidate
+        """
+        digits = self._to_digits(rank)
+        return tuple([axis[d] for axis, d in zip(self.axes, digits)] +
+                     self.min[len(self.axes):])
+
+    def contains(self, candidate: Iterable[float]) -> bool:
+        """
+        Check whether the identifier of the candidate lies on the grid of
+        this iterator, independent of the rank range.
+        :param candidate: Candidate vector
+        :return: True if the candidate is enumerated by the full iterator
+        """
+        return all(round_s(v, rnd) in keys for v, rnd, keys in
+                   zip(candidate, self._rounding_vec, self._axis_keys))
+
+    def __getitem__(self, key: int or slice) -> tuple or 'OffsetIterator':
+        """
+        Random access relative to the rank range of this iterator.
+        :param key: Index or slice (step 1 only)
+        :return: Candidate for an index, new iterator for a slice
+        """
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.size)
+            if step != 1:
+                raise ValueError("Only slices with step 1 are supported.")
+            return self._view(self._start + start,
+                              self._start + max(start, stop))
+        if key < 0:
+            key += self.size
+        if not 0 <= key < self.size:
+            raise IndexError(f"Candidate index {key} out of range.")
+        return self.unrank(self._start + key)
 
     def __next__(self) -> tuple:
         if self.end:
             raise StopIteration
-        state = self.cur_vec[:]
-        # Increment state
-        while self.pos >= 0 and (
-                self.increments[self.pos] == 0 or (
-                round_s(self.cur_vec[self.pos] + self.increments[self.pos],
-                        self._rounding_vec[self.pos]) > self.max[self.pos]
-                )
-        ):
-            # We are at the maximum for this position, so we move one position
-            # to the left.
-            # 1. Reset current pos. to minimum
-            self.cur_vec[self.pos] = self.min[self.pos]
-            # 2. The increment may decrease the value over potency such that the
-            # increment itself changes
-            self.increments[self.pos] = compute_increment(
-                self.cur_vec[self.pos], self._rounding_vec[self.pos])
-            # 3. Move cursor left
-            self.pos -= 1
-        if self.pos >= 0 and \
-                self.increments[self.pos] > 0 and \
-                round_s(self.cur_vec[self.pos] + self.increments[self.pos],
-                        self._rounding_vec[self.pos]) <= self.max[self.pos]:
-            # We can increment the value at the current position
-            self.cur_vec[self.pos] = round_s(
-                self.cur_vec[self.pos] + self.increments[self.pos],
-                self._rounding_vec[self.pos])
-            # The increment may increase the value over potency such that the
-            # increment itself changes
-            self.increments[self.pos] = compute_increment(
-                self.cur_vec[self.pos], self._rounding_vec[self.pos])
-            # Go back to last value
-            self.pos = self.id_len - 1
-        else:
-            # No increment possible
+        state = tuple(self.cur_vec)
+        self._rank += 1
+        if self._rank >= self._stop:
             self.end = True
-        return tuple(state)
+            return state
+        # Increment counter, carry to the left
+        pos = len(self.axes) - 1
+        while pos >= 0:
+            axis = self.axes[pos]
+            digit = self._digits[pos] + 1
+            if digit < len(axis):
+                self._digits[pos] = digit
+                self.cur_vec[pos] = axis[digit]
+                break
+            self._digits[pos] = 0
+            self.cur_vec[pos] = axis[0]
+            pos -= 1
+        return state
+
+    @property
+    def size(self) -> int:
+        """Number of candidates, also if too large for len()."""
+        return self._stop - self._start
 
     def __len__(self) -> int:
-        return comp_offset_num(self)
+        return self.size
+
+    def next_block(self, k: int) -> np.ndarray:
+        """
+        Return the next (up to) k candidates as one 2-D float64 array
+        (one candidate per row) and advance the iterator accordingly.
+        The non-identifier tail is written by broadcasting.
+        :param k: Maximal number of candidates
+        :return: Array of shape (n, record length) with n <= k, n = 0 if
+                 the iterator is exhausted
+        """
+        n = 0 if self.end else min(k, self._stop - self._rank)
+        block = np.empty((n, len(self.cur_vec)), dtype=np.float64)
+        if n == 0:
+            return block
+        columns, self._digits = _count(self._digits,
+                                       [len(a) for a in self.axes], n)
+        for pos, digits in enumerate(columns):
+            block[:, pos] = self._axis_arrays[pos][digits]
+            self.cur_vec[pos] = self.axes[pos][self._digits[pos]]
+        block[:, len(self.axes):] = self._tail
+        self._rank += n
+        if self._rank >= self._stop:
+            self.end = True
+        return block
+
+    def iter_blocks(self, k: int = None) -> Iterator:
+        """
+        Iterate over the remaining candidates in blocks, see next_block.
+        :param k: Maximal number of candidates per block
+        :return: Iterator over 2-D float64 arrays
+        """
+        if k is None:
+            k = cnf.HASH_BATCH_SIZE
+        while True:
+            block = self.next_block(k)
+            if len(block) == 0:
+                return
+            yield block
+
+    def iter_rings(self, k: int = None) -> Iterator:
+        """
+        Iterate over all candidates ordered by increasing distance from the
+        target in blocks of at most k candidates. Ring r contains the
+        candidates that are at most r grid steps away from the grid point
+        closest to the target in every identifier position and exactly r
+        steps in at least one. Blocks never span two rings.
+        :param k: Maximal number of candidates per block
+        :return: Iterator over 2-D float64 arrays
+        """
+        if k is None:
+            k = cnf.HASH_BATCH_SIZE
+        if self._rank != 0 or self._start != 0 or self._stop != self._total:
+            raise RuntimeError("Best-first enumeration requires an unused "
+                               "and unsplit iterator!")
+        width = len(self.cur_vec)
+        if not self.axes:
+            yield self._tail.reshape(1, width).copy()
+            return
+        centers = [int(np.argmin(np.abs(a - t)))
+                   for a, t in zip(self._axis_arrays, self.target)]
+        max_ring = max(max(c, len(a) - 1 - c)
+                       for a, c in zip(self.axes, centers))
+        for r in range(max_ring + 1):
+            # Split ring by the first position that is exactly r steps away
+            for j in range(len(self.axes)):
+                positions = []
+                for i, (axis, c) in enumerate(zip(self.axes, centers)):
+                    if i < j:
+                        idx = range(max(c - r + 1, 0), min(c + r, len(axis)))
+                    elif i == j:
+                        idx = sorted({p for p in (c - r, c + r)
+                                      if 0 <= p < len(axis)})
+                    else:
+                        idx = range(max(c - r, 0), min(c + r + 1, len(axis)))
+                    positions.append(np.array(idx, dtype=np.int64))
+                radices = [len(p) for p in positions]
+                remaining = 1
+                for radix in radices:
+                    remaining *= radix
+                digits = [0 for _ in radices]
+                while remaining > 0:
+                    n = min(k, remaining)
+                    columns, digits = _count(digits, radices, n)
+                    block = np.empty((n, width), dtype=np.float64)
+                    for pos, d in enumerate(columns):
+                        block[:, pos] = self._axis_arrays[pos][
+                            positions[pos][d]]
+                    block[:, len(self.axes):] = self._tail
+                    yield block
+                    remaining -= n
 
 
 class AbsoluteOffsetIterator(OffsetIterator):
@@ -234,7 +471,7 @@ class AbsoluteOffsetIterator(OffsetIterator):
                     self.min[-1] = e
             else:
                 self.min.append(e)
-        self.cur_vec = self.min[:]
+        self._init_axes()
 
 
 class RelativeOffsetIterator(OffsetIterator):
@@ -272,8 +509,7 @@ class RelativeOffsetIterator(OffsetIterator):
                     self.min[-1] = e
             else:
                 self.min.append(e)
-        self.cur_vec = self.min[:]
-        # print(self.min, self.max, self.increments)
+        self._init_axes()
 
 
 class VariableOffsetIterator(OffsetIterator):
@@ -324,7 +560,555 @@ class VariableOffsetIterator(OffsetIterator):
                     self.min[-1] = e
             else:
                 self.min.append(e)
-        self.cur_vec = self.min[:]
+        self._init_axes()
+
+
+class OffsetBoxIterator(OffsetIterator):
+    """
+    Offset Metric over explicitly given axes, used for the parts of an
+    OffsetDeltaIterator.
+    """
+
+    def __init__(self, target: List[float], axes: List[List[float]],
+                 tail: List[float],
+                 rounding_vec: List[int] = None,
+                 record_id_length: int = None):
+        """
+        :param target: Target the axes belong to
+        :param axes: Admissible values of each identifier position
+        :param tail: Values of the non-identifier positions
+        :param rounding_vec: Vector with rounding values
+        :param record_id_length:
+        """
+        super().__init__(target, [0 for _ in target],
+                         rounding_vec=rounding_vec,
+                         record_id_length=record_id_length)
+        self.axes = [list(a) for a in axes]
+        self.min = [a[0] for a in self.axes] + list(tail)
+        self.max = [a[-1] for a in self.axes]
+        self._set_axes()
+
+
+class OffsetDeltaIterator(SimilarityMetricIterator):
+    """
+    Iterator over the candidates of an offset metric that are not
+    candidates of a previous offset query, i.e., the set difference of two
+    hypercubes. The difference is enumerated as disjoint boxes: box i
+    contains the candidates whose first i-1 positions lie within the old
+    hypercube and whose i-th position lies outside of it.
+    """
+
+    def __init__(self, new: OffsetIterator, old: OffsetIterator):
+        """
+        :param new: Candidates of the current query
+        :param old: Candidates of the previous query
+        """
+        if (new.id_len != old.id_len or
+                list(new._rounding_vec) != list(old._rounding_vec) or
+                len(new.axes) != len(old.axes)):
+            raise ValueError("Delta requires iterators with equal ID length "
+                             "and rounding vector.")
+        super().__init__(new.target, rounding_vec=new._rounding_vec,
+                         record_id_length=new.id_len)
+        self.target = new.target
+        tail = new.min[len(new.axes):]
+        inside = []
+        outside = []
+        for axis, rnd, keys in zip(new.axes, new._rounding_vec,
+                                   old._axis_keys):
+            inside.append([v for v in axis if round_s(v, rnd) in keys])
+            outside.append([v for v in axis if round_s(v, rnd) not in keys])
+        self.parts = []
+        for i in range(len(new.axes)):
+            axes = inside[:i] + [outside[i]] + new.axes[i + 1:]
+            if all(axes):
+                self.parts.append(OffsetBoxIterator(
+                    new.target, axes, tail, rounding_vec=new._rounding_vec,
+                    record_id_length=new.id_len))
+        self._part = 0
+
+    def __repr__(self) -> str:
+        return f"<OffsetDeltaIterator over {len(self.parts)} boxes>"
+
+    def _with_parts(self, parts: List[OffsetIterator]) -> \
+            'OffsetDeltaIterator':
+        """Return a fresh iterator over the given parts."""
+        it = self.__class__.__new__(self.__class__)
+        it.__dict__.update(self.__dict__)
+        it.parts = [p for p in parts if p.size > 0]
+        it._part = 0
+        return it
+
+    def _slice(self, start: int, stop: int) -> 'OffsetDeltaIterator':
+        """Return a fresh iterator over the candidates start..stop-1."""
+        parts = []
+        offset = 0
+        for p in self.parts:
+            lo, hi = max(start - offset, 0), min(stop - offset, p.size)
+            if lo < hi:
+                parts.append(p[lo:hi])
+            offset += p.size
+        return self._with_parts(parts)
+
+    @property
+    def size(self) -> int:
+        """Number of candidates, also if too large for len()."""
+        return sum(p.size for p in self.parts)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __next__(self) -> tuple:
+        while self._part < len(self.parts):
+            try:
+                return next(self.parts[self._part])
+            except StopIteration:
+                self._part += 1
+        raise StopIteration
+
+    def iter_blocks(self, k: int = None) -> Iterator:
+        """
+        Iterate over the remaining candidates in blocks, see
+        OffsetIterator.next_block. Blocks never span two boxes.
+        :param k: Maximal number of candidates per block
+        :return: Iterator over 2-D float64 arrays
+        """
+        while self._part < len(self.parts):
+            yield from self.parts[self._part].iter_blocks(k)
+            self._part += 1
+
+    def split(self, n: int) -> List[Iterator]:
+        """
+        Split iterator into n iterators over contiguous parts of equal
+        size (+-1).
+        :param n: # Iterators to generate
+        :return: List of created Iterators
+        """
+        if self._part != 0 or any(p._rank != p._start for p in self.parts):
+            raise RuntimeError("Cannot call split on used iterator!")
+        n = max(1, min(n, self.size))
+        size, rest = divmod(self.size, n)
+        iterators = []
+        start = 0
+        for i in range(n):
+            stop = start + size + (1 if i < rest else 0)
+            iterators.append(self._slice(start, stop))
+            start = stop
+        return iterators
+
+    def __getitem__(self, key: int or slice) -> \
+            tuple or 'OffsetDeltaIterator':
+        """
+        Random access relative to the unused iterator.
+        :param key: Index or slice (step 1 only)
+        :return: Candidate for an index, new iterator for a slice
+        """
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.size)
+            if step != 1:
+                raise ValueError("Only slices with step 1 are supported.")
+            return self._slice(start, max(start, stop))
+        if key < 0:
+            key += self.size
+        if not 0 <= key < self.size:
+            raise IndexError(f"Candidate index {key} out of range.")
+        for p in self.parts:
+            if key < p.size:
+                return p[key]
+            key -= p.size
+
+
+class GridRegionIterator(SimilarityMetricIterator, ABC):
+    """
+    Common base class for metrics that only enumerate the rounded grid
+    points of a relative offset hypercube whose summed per-position costs
+    stay within a budget. The grid point closest to the target has cost 0
+    in every position. Candidates are enumerated depth-first, in each
+    position ordered by increasing cost.
+    """
+
+    # Tolerance for float costs on the border of the region
+    EPS = 1e-9
+    # Costs are integers, counts can be memorized per (position, budget)
+    discrete = False
+
+    @abstractmethod  # costs are dependent on concrete implementation
+    def __init__(self, target: List[float], offset: float, budget: float,
+                 rounding_vec: List[int] = None,
+                 record_id_length: int = None):
+        """
+        :param target: Target vector
+        :param offset: Relative offset of the bounding hypercube in percent
+        :param budget: Maximal sum of costs
+        :param rounding_vec: Vector with rounding values
+        :param record_id_length: ID Length
+        """
+        super().__init__(target, rounding_vec=rounding_vec,
+                         record_id_length=record_id_length)
+        self.target = list(target)
+        self.budget = budget
+        box = RelativeOffsetIterator(target, offset,
+                                     rounding_vec=self._rounding_vec,
+                                     record_id_length=self.id_len)
+        self.min = box.min
+        self.max = box.max
+        self._tail = tuple(box.min[len(box.axes):])
+        self._values = []  # Axis values ordered by cost
+        self._costs = []  # Sorted costs
+        self._steps = []  # Grid steps from the center in the same order
+        for i, axis in enumerate(box.axes):
+            center = min(range(len(axis)),
+                         key=lambda j: abs(axis[j] - target[i]))
+            costs = self._compute_costs(i, axis, center)
+            order = sorted(range(len(axis)), key=lambda j: (costs[j], j))
+            self._values.append([axis[j] for j in order])
+            self._costs.append([costs[j] for j in order])
+            self._steps.append([abs(j - center) for j in order])
+        self._counts = {}
+        self._size = None
+        self._start = 0
+        self._stop = None  # Until exhausted
+        self._reset()
+
+    @abstractmethod
+    def _compute_costs(self, i: int, axis: List[float],
+                       center: int) -> List[float]:
+        """
+        Return the cost of each value of the axis.
+        :param i: Position in the identifier
+        :param axis: Admissible values of the position
+        :param center: Index of the value closest to the target (cost 0)
+        :return: Cost for each axis value
+        """
+        pass  # pragma no cover
+
+    def __repr__(self) -> str:
+        return (f"<{self.__class__.__name__} from {self.min} to {self.max}, "
+                f"budget {self.budget}>")
+
+    def _reset(self) -> None:
+        """Position the iterator at the start of the rank range."""
+        self._rank = self._start
+        self._path = None  # Index into self._values per position
+        self._budgets = None  # Remaining budget before each position
+
+    def _count(self, pos: int, budget: float) -> int:
+        """
+        Number of completions of the positions pos.. within the budget.
+        :param pos: First free position
+        :param budget: Remaining budget
+        :return: Number of candidates
+        """
+        if pos == len(self._values):
+            return 1
+        if self.discrete and (pos, budget) in self._counts:
+            return self._counts[(pos, budget)]
+        costs = self._costs[pos]
+        if pos == len(self._values) - 1:
+            total = bisect.bisect_right(costs, budget + self.EPS)
+        else:
+            total = 0
+            for c in costs:
+                if c > budget + self.EPS:
+                    break
+                total += self._count(pos + 1, budget - c)
+        if self.discrete:
+            self._counts[(pos, budget)] = total
+        return total
+
+    @property
+    def size(self) -> int:
+        """Number of candidates."""
+        if self._size is None:
+            self._size = self._count(0, self.budget)
+        if self._stop is None:
+            return self._size - self._start
+        return self._stop - self._start
+
+    def __len__(self) -> int:
+        return self.size
+
+    def _unrank_path(self, rank: int) -> List[int]:
+        """
+        Return the index into the ordered values of each position for the
+        candidate with the given global rank.
+        :param rank: Rank of the candidate
+        :return: Path
+        """
+        path = []
+        budget = self.budget
+        for pos in range(len(self._values)):
+            for j, c in enumerate(self._costs[pos]):
+                if c > budget + self.EPS:
+                    raise IndexError("Candidate rank out of range.")
+                n = self._count(pos + 1, budget - c)
+                if rank < n:
+                    path.append(j)
+                    budget -= c
+                    break
+                rank -= n
+            else:
+                raise IndexError("Candidate rank out of range.")
+        if rank != 0:
+            raise IndexError("Candidate rank out of range.")
+        return path
+
+    def _candidate(self, path: List[int]) -> tuple:
+        """Return candidate for the given path."""
+        return tuple([v[j] for v, j in zip(self._values, path)]) + \
+            self._tail
+
+    def unrank(self, rank: int) -> tuple:
+        """
+        Return the candidate with the given rank, i.e., the rank-th candidate
+        of the full (unsplit) iterator.
+        :param rank: Global rank of the candidate
+        :return: Candidate
+        """
+        return self._candidate(self._unrank_path(rank))
+
+    def _init_path(self) -> None:
+        """Set path and remaining budgets to the current rank."""
+        if self._rank == 0:
+            self._path = [0 for _ in self._values]
+        else:
+            self._path = self._unrank_path(self._rank)
+        self._budgets = [self.budget]
+        for c, j in zip(self._costs, self._path):
+            self._budgets.append(self._budgets[-1] - c[j])
+
+    def _advance(self) -> bool:
+        """
+        Move path to the next candidate.
+        :return: False if no candidate is left
+        """
+        for pos in range(len(self._values) - 1, -1, -1):
+            j = self._path[pos] + 1
+            costs = self._costs[pos]
+            if j < len(costs) and costs[j] <= self._budgets[pos] + self.EPS:
+                self._path[pos] = j
+                # Cheapest completion has cost 0
+                for p in range(pos, len(self._values)):
+                    self._budgets[p + 1] = self._budgets[pos] - costs[j]
+                for p in range(pos + 1, len(self._values)):
+                    self._path[p] = 0
+                return True
+        return False
+
+    def __next__(self) -> tuple:
+        if self._stop is not None and self._rank >= self._stop:
+            raise StopIteration
+        if self._path is None:
+            if self._size is not None and self._rank >= self._size:
+                raise StopIteration
+            self._init_path()
+        elif self._path is False:
+            raise StopIteration
+        state = self._candidate(self._path)
+        self._rank += 1
+        if not self._advance():
+            self._path = False
+        return state
+
+    def _iter_ring(self, r: int) -> Iterator:
+        """
+        Enumerate the candidates of ring r, see OffsetIterator.iter_rings,
+        depth-first by increasing cost.
+        :param r: Ring, i.e., maximal distance from the center in grid steps
+        :return: Iterator over candidates
+        """
+        n = len(self._values)
+        # Split ring by the first position that is exactly r steps away
+        for j in range(n):
+            allowed = []  # (cost, value) per position ordered by cost
+            for i in range(n):
+                allowed.append([
+                    (c, v) for v, c, s in
+                    zip(self._values[i], self._costs[i], self._steps[i])
+                    if (s < r if i < j else s == r if i == j else s <= r)
+                ])
+            if not all(allowed):
+                continue
+            # Cheapest completion of the positions i..
+            need = [0 for _ in range(n + 1)]
+            for i in range(n - 1, -1, -1):
+                need[i] = need[i + 1] + allowed[i][0][0]
+            if need[0] > self.budget + self.EPS:
+                continue
+
+            def walk(pos: int, budget: float, prefix: tuple) -> Iterator:
+                if pos == n:
+                    yield prefix + self._tail
+                    return
+                for c, v in allowed[pos]:
+                    if c + need[pos + 1] > budget + self.EPS:
+                        break
+                    yield from walk(pos + 1, budget - c, prefix + (v,))
+
+            yield from walk(0, self.budget, ())
+
+    def iter_rings(self, k: int = None) -> Iterator:
+        """
+        Iterate over all candidates ordered by increasing distance from the
+        target in blocks of at most k candidates, see
+        OffsetIterator.iter_rings. Blocks never span two rings.
+        :param k: Maximal number of candidates per block
+        :return: Iterator over 2-D float64 arrays
+        """
+        if k is None:
+            k = cnf.HASH_BATCH_SIZE
+        if self._rank != 0 or self._start != 0 or self._stop is not None:
+            raise RuntimeError("Best-first enumeration requires an unused "
+                               "and unsplit iterator!")
+        if not self._values:
+            yield np.array([self._tail], dtype=np.float64)
+            return
+        max_ring = max(max(steps) for steps in self._steps)
+        for r in range(max_ring + 1):
+            block = []
+            for candidate in self._iter_ring(r):
+                block.append(candidate)
+                if len(block) == k:
+                    yield np.array(block, dtype=np.float64)
+                    block = []
+            if block:
+                yield np.array(block, dtype=np.float64)
+
+    def _view(self, start: int, stop: int) -> 'GridRegionIterator':
+        """
+        Return a fresh iterator over the given rank range sharing the
+        precomputed values and counts.
+        :param start: First rank (inclusive)
+        :param stop: Last rank (exclusive)
+        :return: New iterator
+        """
+        it = self.__class__.__new__(self.__class__)
+        it.__dict__.update(self.__dict__)
+        it._start = start
+        it._stop = stop
+        it._reset()
+        return it
+
+    def split(self, n: int) -> List[Iterator]:
+        """
+        Split iterator into n iterators over contiguous rank ranges of equal
+        size (+-1). Fewer iterators are returned if the iterator has less
+        than n elements.
+        :param n: # Iterators to generate
+        :return: List of created Iterators
+        """
+        if self._rank != self._start:
+            raise RuntimeError("Cannot call split on used iterator!")
+        total = self.size
+        n = max(1, min(n, total))
+        size, rest = divmod(total, n)
+        iterators = []
+        start = self._start
+        for i in range(n):
+            stop = start + size + (1 if i < rest else 0)
+            iterators.append(self._view(start, stop))
+            start = stop
+        log.debug(f"Split into {len(iterators)} iterators of size {size}.")
+        return iterators
+
+    def __getitem__(self, key: int or slice) -> tuple or 'GridRegionIterator':
+        """
+        Random access relative to the rank range of this iterator.
+        :param key: Index or slice (step 1 only)
+        :return: Candidate for an index, new iterator for a slice
+        """
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.size)
+            if step != 1:
+                raise ValueError("Only slices with step 1 are supported.")
+            return self._view(self._start + start,
+                              self._start + max(start, stop))
+        if key < 0:
+            key += self.size
+        if not 0 <= key < self.size:
+            raise IndexError(f"Candidate index {key} out of range.")
+        return self.unrank(self._start + key)
+
+
+class L2BallIterator(GridRegionIterator):
+    """
+    Metric that uses all grid points within a (weighted) Euclidean ball
+    around the target. The radius is relative to the target value in each
+    position. The squared distances are rounded up to multiples of
+    1/RESOLUTION of the squared radius, so that the candidates can be
+    counted exactly by dynamic programming. Hence, grid points very close
+    to the border of the ball might be missing.
+    """
+
+    discrete = True
+    RESOLUTION = 1000
+
+    def __init__(self, target: List[float], radius: float,
+                 weights: List[float] = None,
+                 rounding_vec: List[int] = None,
+                 record_id_length: int = None):
+        """
+
+        :param target:
+        :param radius: Radius in Percent of the target value of each entry
+        :param weights: [optional] Weight of each entry of the ID,
+                        len(weights) == ID length. Larger weights allow for
+                        less deviation, 0: only limited by the radius.
+        :param rounding_vec: Vector with rounding values
+        :param record_id_length:
+        """
+        if record_id_length is None:
+            record_id_length = cnf.RECORD_ID_LENGTH
+        if weights is None:
+            weights = [1 for _ in range(record_id_length)]
+        if len(weights) != record_id_length:
+            raise ValueError(
+                f"Weight List {len(weights)} has to have ID length "
+                f"({record_id_length}).")
+        self.radius = radius
+        self.weights = weights
+        super().__init__(target, radius, self.RESOLUTION,
+                         rounding_vec=rounding_vec,
+                         record_id_length=record_id_length)
+
+    def _compute_costs(self, i: int, axis: List[float],
+                       center: int) -> List[int]:
+        scale = abs(self.target[i]) * self.radius / 100
+        if scale == 0:
+            return [0 for _ in axis]
+        return [
+            math.ceil(((v - axis[center]) * self.weights[i] / scale) ** 2 *
+                      self.RESOLUTION - self.EPS)
+            for v in axis
+        ]
+
+
+class MaxDeviationIterator(GridRegionIterator):
+    """
+    Metric that uses a relative offset for each item in list, but only
+    up to max_dev items may deviate from the target at once.
+    """
+
+    discrete = True
+
+    def __init__(self, target: List[float], max_dev: int, offset: float,
+                 rounding_vec: List[int] = None,
+                 record_id_length: int = None):
+        """
+
+        :param target:
+        :param max_dev: Maximal number of entries deviating from the target
+        :param offset: Offset in Percent
+        :param rounding_vec: Vector with rounding values
+        :param record_id_length:
+        """
+        self.max_dev = max_dev
+        super().__init__(target, offset, max_dev, rounding_vec=rounding_vec,
+                         record_id_length=record_id_length)
+
+    def _compute_costs(self, i: int, axis: List[float],
+                       center: int) -> List[int]:
+        return [0 if j == center else 1 for j in range(len(axis))]
 
 
 def compute_increment(n: float, rnd: int) -> float:
@@ -349,34 +1133,7 @@ def compute_increment(n: float, rnd: int) -> float:
 
 def comp_offset_num(o: OffsetIterator) -> int:
     """Compute the number of elements produces by an offest iterator"""
-    total = 1
-    var_per_pos = []
-    for i in range(o.id_len):
-        possibilities = 0
-        # increment might change
-        cur_min = o.min[i]
-        inc = compute_increment(o.min[i], o._rounding_vec[i])
-        if cur_min == 0:
-            power = 0
-        else:
-            power = get_power(cur_min) + 1
-        if 10 ** power < o.max[i]:
-            cur_max = 10 ** power
-            # +0.5inc b/c of float imprecision
-            possibilities += int((cur_max - cur_min + 0.5 * inc) / inc)
-            # Update increment
-            inc = compute_increment(cur_max, o._rounding_vec[i])
-            cur_min = cur_max
-            power = get_power(cur_min) + 1
-        # Now, we can cound till end
-        # +0.5inc b/c of float imprecision
-        possibilities += int((o.max[i] - cur_min + 0.5 * inc) / inc)
-        possibilities += 1
-        # +1 because min and max are always contained
-        var_per_pos.append(possibilities)
-    for n in var_per_pos:
-        total *= n
-    return round(total)
+    return o.size
 
 
 def map_metric(name: str) -> (SimilarityMetricIterator, list):
@@ -404,6 +1161,24 @@ def map_metric(name: str) -> (SimilarityMetricIterator, list):
             # float
             args = (float(f"{found[0]}.{found[1]}"),)
         return RelativeOffsetIterator, args
+    elif re.match(r'l2-\d+', name) is not None:
+        found = re.findall(r'\d+', name)[1:]
+        if len(found) == 1:
+            # int
+            args = (int(found[0]),)
+        else:
+            # float
+            args = (float(f"{found[0]}.{found[1]}"),)
+        return L2BallIterator, args
+    elif re.match(r'maxdev-\d+-\d+', name) is not None:
+        found = re.findall(r'\d+', name)
+        if len(found) == 2:
+            # int
+            args = (int(found[0]), int(found[1]))
+        else:
+            # float
+            args = (int(found[0]), float(f"{found[1]}.{found[2]}"))
+        return MaxDeviationIterator, args
     elif name == "wzl1":
         # Any werkstueck, rest exact
         offsets = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1000, 0, 0]
@@ -7,17 +7,26 @@ Author: Erik Buchholz
 Maintainer: Erik Buchholz
 E-mail: buchholz@comsys.rwth-aachen.de
 """
+import glob
 import logging
+import math
 import os
 import sys
 from typing import List, Iterable, Tuple
 
+import numpy as np
 from pybloomfilter import BloomFilter
 
 import lib.config as config
 from lib.base_client import UserType
+from lib.bloom import (BloomChangeLog, check_compression, compress_file,
+                       check_key_encoding, encode_key, LEGACY_KEY_ENCODING,
+                       create_bloom_filter, open_bloom_filter,
+                       get_implementation, key_words)
 from lib.helpers import from_base64
-from lib.record import hash_to_index
+from lib.psi_set import PSIServerSet
+from lib.record import (hash_to_index, json_to_binary_ciphertext,
+                        hashes_to_wide_indices, RecordBatch)
 from lib.user_database import Owner, Client, get_user
 from storage_server.storage_database import StoredRecord, db, \
     BillingInfo, RecordRetrieval
@@ -40,7 +49,8 @@ class StorageServer:
     @property
     def bloom(self):
         """
-        Return bloom filter containing the record hashes (as base64 encoding).
+        Return bloom filter containing the record hashes (encoded as given
+        by bloom_log.encoding).
         Needs to be a property to avoid concurrency problems with mutltiple
         threads. Initialize with database contents it no bloom filter exists.
 
@@ -50,14 +60,29 @@ class StorageServer:
             # Initialize
             bloom_file = self.data_dir + config.BLOOM_FILE
             if os.path.isfile(bloom_file):
-                self._bloom = BloomFilter.open(
-                    filename=bloom_file)
+                self._bloom = open_bloom_filter(bloom_file)
                 log.info(f"Bloom Filter loaded from file {bloom_file}!")
             else:
                 # new Bloom filter
                 self._initialize_bloom_filter()
         return self._bloom
 
+    @property
+    def bloom_log(self) -> BloomChangeLog:
+        """Return the version information of the bloom filter."""
+        return BloomChangeLog(self.data_dir + config.BLOOM_FILE)
+
+    @property
+    def psi_set(self) -> PSIServerSet:
+        """
+        Return the padded PSI input set. Initialize with database contents
+        if it does not exist.
+        """
+        psi_set = PSIServerSet(self.data_dir + config.PSI_SET_FILE)
+        if not psi_set.exists():
+            self._initialize_psi_set()
+        return psi_set
+
     def __init__(self, data_dir=config.DATA_DIR) -> None:
         """Set data directory and create it, if it does not exist."""
         self.data_dir = data_dir
@@ -65,22 +90,61 @@ class StorageServer:
 
     def _initialize_bloom_filter(self) -> None:
         """
-        Create new bloom filter and add all values from storage DB.
+        Create new bloom filter of type config.BLOOM_IMPLEMENTATION and add
+        all values from storage DB with the key encoding
+        config.BLOOM_KEY_ENCODING.
+        An existing filter with the same parameters is cleared instead so
+        that its hash seeds are kept and unchanged records lead to an
+        unchanged filter version.
         """
+        encoding = config.BLOOM_KEY_ENCODING
+        check_key_encoding(encoding)
         bloom_file = self.data_dir + config.BLOOM_FILE
-        self._bloom = BloomFilter(config.BLOOM_CAPACITY,
-                                  config.BLOOM_ERROR_RATE,
-                                  bloom_file)
         records = StoredRecord.query.all()
-        for r in records:
-            self._bloom.add(r.hash)
+        with self.bloom_log.modify(encoding=encoding):
+            old = None
+            if os.path.isfile(bloom_file):
+                old = open_bloom_filter(bloom_file)
+            if old is not None and \
+                    old.capacity == config.BLOOM_CAPACITY and \
+                    math.isclose(old.error_rate, config.BLOOM_ERROR_RATE) \
+                    and get_implementation(old) == \
+                    config.BLOOM_IMPLEMENTATION:
+                old.clear_all()
+                self._bloom = old
+            else:
+                self._bloom = create_bloom_filter(config.BLOOM_CAPACITY,
+                                                  config.BLOOM_ERROR_RATE,
+                                                  bloom_file)
+            self._bloom.update(self._bloom_key(r.hash, encoding)
+                               for r in records)
+            self._bloom.sync()
         log.info(f"Created new Bloom Filter @ {bloom_file}.")
 
+    def _initialize_psi_set(self) -> None:
+        """Build the PSI input set from all records of the storage DB."""
+        records = StoredRecord.query.all()
+        PSIServerSet(self.data_dir + config.PSI_SET_FILE).rebuild(
+            get_psi_indices([r.hash for r in records]))
+
+    @staticmethod
+    def _bloom_key(hash_val: str, encoding: str) -> str or bytes:
+        """
+        Return the bloom filter key of a record.
+        :param hash_val: Base64 of record's long hash
+        :param encoding: Key encoding of the filter
+        :return: Key
+        """
+        if encoding == LEGACY_KEY_ENCODING:
+            return hash_val
+        return encode_key(from_base64(hash_val), encoding)
+
     def store_record(self, hash_val: str, ciphertext: str, owner: str) -> None:
         """
         Store the record with the given attributes into the DB.
         :param hash_val: Base64 of record's long hash
-        :param ciphertext: json.dumps(ciphertext-dict)
+        :param ciphertext: Base64(binary ciphertext) or
+                           json.dumps(ciphertext-dict)
         :param owner: owner of record as string
         :return:
         """
@@ -90,9 +154,9 @@ class StorageServer:
         self.batch_store_records_bloom(records)
         log.info(f"Stored record: {hash_val} - {ciphertext} of {owner}")
 
-    @staticmethod
-    def batch_store_records_db(records: List[Iterable[str]]) -> None:
-        """Store all records in the list into the database.
+    def batch_store_records_db(self, records: List[Iterable[str]]) -> None:
+        """Store all records in the list into the database and add their
+        PSI indices to the PSI input set.
 
         :param records: List of records, each represented as a tuple of the
             base64 encoded long hash, the ciphertext as json.dumps and the
@@ -113,6 +177,14 @@ class StorageServer:
             db.session.add(r)
         db.session.commit()
         log.info("Successfully stored records into DB.")
+        self._add_to_psi_set([h for (h, c, o) in records])
+
+    def _add_to_psi_set(self, hashes: List[str]) -> None:
+        """
+        Add the PSI indices of new records to the PSI input set.
+        :param hashes: Base64 encoded long hashes of the records
+        """
+        self.psi_set.add(get_psi_indices(hashes))
 
     def batch_store_records_bloom(self, records: List[Iterable[str]]) -> None:
         """Store all records in the list into the bloom filter.
@@ -128,8 +200,17 @@ class StorageServer:
 
         """
         log.debug("Batch store record Bloom called.")
-        for (hash_val, record, owner) in records:
-            self.bloom.add(hash_val)
+        b = self.bloom
+        bloom_log = self.bloom_log
+        # Keys are always added with the encoding of the existing filter
+        encoding = bloom_log.encoding
+        keys = [self._bloom_key(hash_val, encoding)
+                for (hash_val, record, owner) in records]
+        # Only the words of the keys are checked for changes if the
+        # implementation provides them
+        with bloom_log.modify(key_words(b, keys)):
+            b.update(keys)
+            b.sync()
 
     @staticmethod
     def get_record(hash_base64: str,
@@ -250,6 +331,21 @@ class StorageServer:
             for r in res
         ]
 
+    @staticmethod
+    def convert_ciphertexts() -> int:
+        """
+        Convert all records stored in the legacy JSON format into the binary
+        ciphertext format. Keys are not required for the conversion.
+        :return: Number of converted records
+        """
+        res: List[StoredRecord] = StoredRecord.query.filter(
+            StoredRecord.ciphertext.like('{%')).all()
+        for r in res:
+            r.ciphertext = json_to_binary_ciphertext(r.ciphertext)
+        db.session.commit()
+        log.info(f"Converted {len(res)} records into the binary format.")
+        return len(res)
+
     def get_bloom_filter(self) -> bytes:
         """
         Return a base64 encoding of the server's bloom filter.
@@ -257,6 +353,58 @@ class StorageServer:
         """
         return self.bloom.to_base64()
 
+    def get_bloom_file(self, compression: str = 'none') -> Tuple[str, int]:
+        """
+        Return the path of a file containing the current version of the
+        server's bloom filter. The file is created once per version and not
+        modified afterwards, so transfers never mix versions.
+        :param compression: One of lib.bloom.COMPRESSIONS
+        :return: (path, version)
+        """
+        check_compression(compression)
+        _ = self.bloom  # Create if not existing
+        bloom_log = self.bloom_log
+        if bloom_log.version == 0:
+            bloom_log.commit()
+        prefix = f"{self.data_dir}{config.BLOOM_FILE}."
+        with bloom_log.lock():
+            # Store exactly the committed version, once
+            version = bloom_log.version
+            target = f"{prefix}{version}.{compression}"
+            if not os.path.exists(target):
+                compress_file(bloom_log.committed_file, target, compression)
+            # Remove older versions, the previous one might still be sent
+            for f in glob.glob(f"{prefix}*.{compression}"):
+                v = f[len(prefix):-len(compression) - 1]
+                if v.isdigit() and int(v) < version - 1:
+                    os.remove(f)
+        return target, version
+
+    def get_bloom_encoding(self) -> str:
+        """
+        Return the key encoding of the server's bloom filter.
+        :return: One of lib.bloom.KEY_ENCODINGS
+        """
+        return self.bloom_log.encoding
+
+    def get_bloom_version(self) -> int:
+        """
+        Return the current version of the server's bloom filter.
+        :return: Version number
+        """
+        return self.bloom_log.version
+
+    def get_bloom_delta(self, since: int) -> \
+            Tuple[int, np.ndarray, np.ndarray] or None:
+        """
+        Return the words of the bloom filter that changed since the given
+        version.
+        :param since: Version of the requester's copy
+        :return: (current version, word indices, word values) or None if
+                 the whole filter has to be transferred
+        """
+        return self.bloom_log.delta(since)
+
     @staticmethod
     def get_all_record_psi_hashes() -> List[int]:
         """
@@ -267,45 +415,52 @@ class StorageServer:
         res = [get_psi_index(r.hash) for r in records]
         return res
 
-    @staticmethod
-    def offer_psi(setSize: int = config.PSI_SETSIZE,
+    def offer_psi(self, setSize: int = config.PSI_SETSIZE,
                   port: int = config.PSI_PORT,
-                  scheme: str = config.PSI_SCHEME) -> None:
+                  scheme: str = config.PSI_SCHEME,
+                  clientSetSize: int = None,
+                  buckets: int = 1,
+                  bucket: int = None) -> None:
         """
-        Initialize an PSI to transit the Indices.
-        :param setSize: Size of the sets compared with PSI
+        Initialize an PSI to transit the Indices. If the server set is
+        split into buckets, one PSI per bucket is performed on the port.
+        :param setSize: Size of the server set
         :param port: For PSI server to listen on
         :param scheme: Which PSI to use
+        :param clientSetSize: [optional] Size of the client set,
+                              default: setSize
+        :param buckets: [optional] Number of buckets of the server set
+        :param bucket: [optional] Only offer this bucket,
+                       default: all buckets one after another
         :return: None
         """
-        sender = PyPSISender()
-        records = StorageServer.get_all_record_psi_hashes()
-        log.debug(f"Server set without dummies: {str(records)}")
-        if len(records) > setSize:
-            raise RuntimeError("More records than PSI Setsize allows.")
-
-        # Add unique dummies
-        dummy = config.PSI_DUMMY_START_SERVER
-        while len(records) < setSize:
-            records.append(dummy)
-            dummy += 1
+        if bucket is None:
+            bucket_list = range(buckets)
+        else:
+            bucket_list = [bucket]
+        for b in bucket_list:
+            sender = PyPSISender()
+            # Padded with unique dummies already
+            records = self.psi_set.load_bucket(b, buckets, setSize)
 
-        sender.statSecParam = config.PSI_STATSECPARAM
-        sender.setSize = setSize
+            sender.statSecParam = config.PSI_STATSECPARAM
+            sender.setSize = setSize
+            sender.recvSetSize = clientSetSize or setSize
 
-        sender.hostName = config.PSI_HOST
-        sender.port = port
-        sender.numThreads = config.PSI_THREADS
-        sender.tls = config.PSI_TLS
+            sender.hostName = config.PSI_HOST
+            sender.port = port
+            sender.numThreads = config.PSI_THREADS
+            sender.tls = config.PSI_TLS
 
-        sender.serverCert = config.KEY_TLS_CERT
-        sender.serverKey = config.KEY_TLS_KEY
+            sender.serverCert = config.KEY_TLS_CERT
+            sender.serverKey = config.KEY_TLS_KEY
 
-        log.info(
-            f"Listening for PSI connection on {sender.hostName}:{sender.port}."
-            f"TLS: {sender.tls}")
-        sender.execute(scheme, records)
-        log.debug(f"PSI done. Thread for port {sender.port} terminating.")
+            log.info(
+                f"Listening for PSI connection on {sender.hostName}:"
+                f"{sender.port} for bucket {b + 1}/{buckets}. "
+                f"TLS: {sender.tls}")
+            sender.execute(scheme, records)
+        log.debug(f"PSI done. Thread for port {port} terminating.")
 
 
 def get_psi_index(long_hash_base64: str) -> int:
@@ -318,3 +473,15 @@ def get_psi_index(long_hash_base64: str) -> int:
     long_hash_bytes: bytes = from_base64(long_hash_base64)
     psi_index = hash_to_index(long_hash_bytes, config.PSI_INDEX_LEN)
     return psi_index
+
+
+def get_psi_indices(long_hashes_base64: List[str]) -> np.ndarray:
+    """
+    Convert base64 encoded long hashes into the corresponding PSI indices.
+    :param long_hashes_base64: Long hashes in Base64 encoding
+    :return: Array of PSI indices with dtype WIDE_INDEX_DTYPE
+    """
+    hashes = np.frombuffer(
+        b''.join(from_base64(h) for h in long_hashes_base64),
+        dtype=np.uint8).reshape(-1, RecordBatch.HASH_LEN)
+    return hashes_to_wide_indices(hashes, config.PSI_INDEX_LEN)
@@ -11,6 +11,7 @@ import sys
 from typing import List
 
 from lib import config
+from lib.helpers import save_records
 import random
 
 
@@ -23,7 +24,8 @@ def main(args=List[str]):
     parser.add_argument('num', type=int, help="Number of records to generate.",
                         metavar="NUM")
     parser.add_argument('-o', '--output', type=str, default="records.tmp",
-                        help="Output file.")
+                        help="Output file. Records are stored in the binary "
+                             "format if it ends with '.npy'.")
     parser.add_argument('-l', '--length', type=int, default=config.RECORD_LENGTH,
                         help="Length of records")
     parser.add_argument('--max', type=float, default=100,
@@ -42,8 +44,7 @@ def main(args=List[str]):
                 for _ in range(args.length)
             ]
         )
-    with open(args.output, "w") as fd:
-        fd.writelines([f"{str(r)}\n" for r in records])
+    save_records(args.output, records)
 
 
 if __name__ == '__main__':  # pragma no cover
@@ -67,6 +67,12 @@ def create_app(test_config=None, logging_level=config.LOGLEVEL,
         database.db.create_all()
         # Initialize Bloom Filter
         get_storageserver_backend()._initialize_bloom_filter()
+        # Initialize PSI set
+        get_storageserver_backend()._initialize_psi_set()
+    if config.PSI_POOL_SIZE > 0:
+        # Senders load the PSI set while the server starts
+        from lib.psi_pool import get_psi_pool
+        get_psi_pool(data_dir, app.config['RANDOMIZE_PORTS'])
     # Include pages
     from storage_server import main
     app.register_blueprint(main.bp)
@@ -7,15 +7,19 @@ Maintainer: Erik Buchholz
 E-mail: buchholz@comsys.rwth-aachen.de
 """
 import logging
+import os
 import secrets
 
-from flask import Blueprint, jsonify, request, current_app as app
+from flask import Blueprint, jsonify, request, current_app as app, \
+    Response, send_file
 from flask_httpauth import HTTPBasicAuth
 
 from lib import helpers, config, database
 from lib.base_client import UserType
 from lib.base_server import verify_token, gen_token, client_pw
 from lib.database import db
+from lib.psi_pool import get_psi_pool
+from lib.psi_set import check_client_set_size, check_buckets
 from lib.storage_server_backend import StorageServer
 from lib.user_database import get_user
 from storage_server.connector import get_storageserver_backend, execute_psi, \
@@ -76,22 +80,110 @@ def client_get_bloom() -> str:
     """
     Return a base64 encoding of the bloom filter encoding the storage
     server's record set.
-    :return: Dict containing base64 encoded bloom filter
+    :return: Dict containing base64 encoded bloom filter, its version and
+             its key encoding
     """
     try:
+        backend = get_storageserver_backend()
+        version = backend.get_bloom_version()
+        if str(version) in request.if_none_match:
+            # Conditional GET, the client's copy is up to date
+            resp = Response(status=304)
+            resp.set_etag(str(version))
+            return resp
         _track_bloom_access(UserType.CLIENT, client_auth.username())
-        b = get_storageserver_backend().get_bloom_filter(
-                        ).decode()
+        b = backend.get_bloom_filter().decode()
+        encoding = backend.get_bloom_encoding()
     except ValueError as e:
         return jsonify(
             {
                 "success": False,
                 "msg": str(e)
             })
+    resp = jsonify(
+        {
+            "success": True,
+            "bloom": b,
+            "version": version,
+            "encoding": encoding
+        })
+    resp.set_etag(str(version))
+    return resp
+
+
+@bp.route('/bloom_file')
+@client_auth.login_required
+def client_get_bloom_file():
+    """
+    Stream the binary bloom filter file, optionally compressed as given by
+    the GET parameter 'compression' (none, zlib or zstd). Conditional and
+    range requests are supported, the ETag contains the filter version.
+    :return: application/octet-stream response with headers
+             X-Bloom-Version, X-Bloom-Encoding and X-Compression or dict
+             containing an error message
+    """
+    compression = request.args.get('compression', 'none')
+    try:
+        backend = get_storageserver_backend()
+        path, version = backend.get_bloom_file(compression)
+        encoding = backend.get_bloom_encoding()
+        _track_bloom_access(UserType.CLIENT, client_auth.username())
+    except ValueError as e:
+        return jsonify(
+            {
+                "success": False,
+                "msg": str(e)
+            })
+    resp = send_file(path, mimetype='application/octet-stream',
+                     conditional=False, add_etags=False)
+    resp.set_etag(f"{version}-{compression}")
+    resp.headers['X-Bloom-Version'] = str(version)
+    resp.headers['X-Bloom-Encoding'] = encoding
+    resp.headers['X-Compression'] = compression
+    return resp.make_conditional(request, accept_ranges=True,
+                                 complete_length=os.path.getsize(path))
+
+
+@bp.route('/bloom_delta')
+@client_auth.login_required
+def client_get_bloom_delta() -> str:
+    """
+    Return the words of the bloom filter that changed since the version
+    given as GET parameter 'since'.
+    :return: Dict containing the current version and, if 'full' is False,
+             the key encoding and the base64 encoded word indices and values
+             (little endian uint64 arrays). If 'full' is True, the whole
+             filter has to be retrieved.
+    """
+    since = request.args.get('since', None, type=int)
+    try:
+        if since is None:
+            raise ValueError("No version defined.")
+        _track_bloom_access(UserType.CLIENT, client_auth.username())
+        backend = get_storageserver_backend()
+        delta = backend.get_bloom_delta(since)
+    except ValueError as e:
+        return jsonify(
+            {
+                "success": False,
+                "msg": str(e)
+            })
+    if delta is None:
+        return jsonify(
+            {
+                "success": True,
+                "full": True,
+                "version": backend.get_bloom_version()
+            })
+    version, words, values = delta
     return jsonify(
         {
             "success": True,
-            "bloom": b
+            "full": False,
+            "version": version,
+            "encoding": backend.get_bloom_encoding(),
+            "words": helpers.to_base64(words.tobytes()),
+            "values": helpers.to_base64(values.tobytes())
         })
 
 
@@ -140,10 +232,11 @@ def batch_retrieve_records() -> str:
              message otherwise. On success:
              'records':
              [
-                ('Base64(HASH-1)', 'json.dumps(CIPHERTEXT-1)'),
-                ('Base64(HASH-1)', 'json.dumps(CIPHERTEXT-2)'),
+                ('Base64(HASH-1)', 'Base64(CIPHERTEXT-1)'),
+                ('Base64(HASH-1)', 'Base64(CIPHERTEXT-2)'),
                 ('Base64(HASH-2)', 'json.dumps(CIPHERTEXT-3)')
             ]
+             Ciphertexts are returned in the format they were stored in.
     """
     try:
         if request.json is None:
@@ -176,20 +269,11 @@ def _track_PSI_access(user_type: str, username: str) -> PSIAccess:
     return t
 
 
-@bp.route('/psi')
-@client_auth.login_required
-def psi():
+def _start_psi_task(client_set_size: int, buckets: int,
+                    bucket: int or None) -> int:
     """
-    Start a PSI Server and return connection information.
-    :return: Dict containing PSI Server access information.
-    {
-        'success': bool,
-        'port': int,
-        'host': str,
-        'tls': bool,
-        'setSize': int,
-        'msg': str (On failure only)
-    }
+    Start a PSI sender as celery task on a free port.
+    :return: Port of the PSI sender
     """
     # Get free port
     port = secrets.randbelow(65536 - 1024) + 1024
@@ -202,18 +286,84 @@ def psi():
             app.logger.warning(f"Port {config.PSI_PORT} already in use!"
                                f"Using {port} instead.")
     app.logger.info(f"Starting PSI Sending instance on port {port}.")
-    _track_PSI_access(UserType.CLIENT, client_auth.username())
-    task = execute_psi.delay(port)
+    task = execute_psi.delay(port, client_set_size, buckets, bucket)
     database.add_task(client_auth.username(),
                                          UserType.CLIENT,
                                          task.id, TaskType.PSI)
     app.logger.debug(f"PSI Server Thread started on port {port}.")
+    return port
+
+
+@bp.route('/psi')
+@client_auth.login_required
+def psi():
+    """
+    Start a PSI Server and return connection information. The optional
+    GET parameter 'setSize' defines the padded size of the client set,
+    which is only supported by KKRT16.
+    If the server set is larger than the PSI set size, it is split into
+    buckets. Then, the client has to state the number of buckets it
+    partitioned its set into with the GET parameter 'buckets' and
+    optionally a single 'bucket' to perform. Otherwise, one PSI per bucket
+    is executed on the returned port.
+    :return: Dict containing PSI Server access information.
+    {
+        'success': bool,
+        'port': int,
+        'host': str,
+        'tls': bool,
+        'setSize': int,
+        'clientSetSize': int,
+        'buckets': int,
+        'msg': str (On failure only)
+    }
+    """
+    client_set_size = request.args.get('setSize', None, type=int)
+    buckets = request.args.get('buckets', None, type=int)
+    bucket = request.args.get('bucket', None, type=int)
+    needed = get_storageserver_backend().psi_set.buckets()
+    try:
+        if client_set_size is not None and config.PSI_SCHEME == "KKRT16":
+            check_client_set_size(client_set_size)
+        else:
+            client_set_size = config.PSI_SETSIZE
+        if buckets is None:
+            if needed > 1:
+                raise ValueError(f"PSI set is split into {needed} buckets.")
+            buckets = 1
+        check_buckets(buckets)
+        if buckets < needed:
+            raise ValueError(f"PSI set is split into {needed} buckets.")
+        if bucket is not None and not 0 <= bucket < buckets:
+            raise ValueError(f"Invalid PSI bucket: {bucket}")
+    except ValueError as e:
+        return jsonify(
+            {
+                "success": False,
+                "msg": str(e),
+                "buckets": needed
+            })
+    _track_PSI_access(UserType.CLIENT, client_auth.username())
+    session = None
+    if config.PSI_POOL_SIZE > 0:
+        session = get_psi_pool(app.config['DATA_DIR'],
+                               app.config['RANDOMIZE_PORTS']).acquire(
+            clientSetSize=client_set_size, buckets=buckets, bucket=bucket)
+    if session is None:
+        port = _start_psi_task(client_set_size, buckets, bucket)
+    else:
+        port, session_id = session
+        database.add_task(client_auth.username(), UserType.CLIENT,
+                          session_id, TaskType.PSI_POOL)
+        app.logger.debug(f"PSI Sender of pool listening on port {port}.")
     return jsonify({
         'success': True,
         'port': port,
         'host': app.config['PSI_HOST'],
         'tls': app.config['PSI_TLS'],
-        'setSize': config.PSI_SETSIZE
+        'setSize': config.PSI_SETSIZE,
+        'clientSetSize': client_set_size,
+        'buckets': buckets
     })
 
 
@@ -15,6 +15,7 @@ from flask import g, current_app as app, render_template, url_for
 from lib import database
 from lib.base_client import UserType
 from lib.base_server import client_pw, provider_pw
+from lib.psi_pool import PoolSessions
 from lib.storage_server_backend import StorageServer
 from . import celery_app
 
@@ -24,6 +25,7 @@ log: logging.Logger = logging.getLogger(__name__)
 class TaskType:
     """Allows storage server tasks."""
     PSI = "PSI"
+    PSI_POOL = "PSI_POOL"  # Session of the PSI sender pool
     BLOOM_INSERT = "BLOOM_INSERT"
 
 
@@ -45,7 +47,7 @@ def _batch_store_records(record_list: List[List[str]], username: str) -> None:
     ]
     :return: None
     """
-    StorageServer.batch_store_records_db(record_list)
+    get_storageserver_backend().batch_store_records_db(record_list)
     task = insert_bloom.delay(record_list)
     database.add_task(username,
                       UserType.OWNER,
@@ -53,12 +55,15 @@ def _batch_store_records(record_list: List[List[str]], username: str) -> None:
 
 
 @celery_app.task(bind=True)  # pragma no cover
-def execute_psi(self: Task, port: int) -> None:
+def execute_psi(self: Task, port: int, client_set_size: int = None,
+                buckets: int = 1, bucket: int = None) -> None:
     """Execute PSI with celery."""
     log.info(f"Celery offering PSI on Port {port}.")
     self.time_limit = 3600
     self.update_state(state='STARTED')
-    StorageServer.offer_psi(port=port)
+    get_storageserver_backend().offer_psi(
+        port=port, clientSetSize=client_set_size, buckets=buckets,
+        bucket=bucket)
     self.update_state(state='SUCCESS')
 
 
@@ -183,4 +188,5 @@ def kill_task(task_type: str, task_id: str) -> Dict or str:
 Tasks = {
     TaskType.PSI: execute_psi,
     TaskType.BLOOM_INSERT: insert_bloom,
+    TaskType.PSI_POOL: PoolSessions,
 }
@@ -102,10 +102,11 @@ def batch_store_records() -> None:
     Store many records into the database.
     Requires a JSON as HTTP POST data:
     [
-        [Base64(Hash-1)[str], json.dumps(ciphertext-1)[str], 'owner'[str]],
-        [Base64(Hash-2)[str], json.dumps(ciphertext-2)[str], 'owner'[str]],
-        [Base64(Hash-2)[str], json.dumps(ciphertext-3)[str], 'owner'[str]],
+        [Base64(Hash-1)[str], Base64(ciphertext-1)[str], 'owner'[str]],
+        [Base64(Hash-2)[str], Base64(ciphertext-2)[str], 'owner'[str]],
+        [Base64(Hash-2)[str], Base64(ciphertext-3)[str], 'owner'[str]],
     ]
+    Ciphertexts may also use the legacy format json.dumps(ciphertext).
     :return: None
     """
     log.info(f"Batch Store Records")
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""Test of the cache-line-blocked Bloom filter.
+
+Copyright (c) 2020.
+Author: Erik Buchholz
+Maintainer: Erik Buchholz
+E-mail: buchholz@comsys.rwth-aachen.de
+"""
+import math
+import os
+import shutil
+from unittest import TestCase
+from unittest.mock import patch
+
+import numpy as np
+
+from lib import config
+from lib.blocked_bloom import (BlockedBloomFilter, blocked_parameters,
+                               BLOCK_BITS, HEADER_SIZE)
+
+test_dir = config.DATA_DIR + "test/"
+bloom_file = test_dir + "test.bloom"
+
+
+def random_digests(n: int) -> np.ndarray:
+    return np.random.randint(0, 256, (n, 64), dtype=np.uint8)
+
+
+@patch("lib.config.BLOOM_BLOCKED_OVERHEAD", 1.25)
+@patch("lib.config.BLOOM_BLOCKED_MAX_LINES", 8)
+class TestBlockedBloomFilter(TestCase):
+
+    def setUp(self) -> None:
+        """Create test directory."""
+        shutil.rmtree(test_dir, ignore_errors=True)
+        os.makedirs(test_dir)
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        """Remove test directory."""
+        shutil.rmtree(test_dir, ignore_errors=True)
+
+    def test_blocked_parameters(self):
+        prev_lines = 0
+        for error_rate in [10 ** -3, 10 ** -6, 10 ** -20]:
+            lines, k, blocks = blocked_parameters(10 ** 6, error_rate)
+            standard = -10 ** 6 * math.log(error_rate) / math.log(2) ** 2
+            self.assertLessEqual(blocks * BLOCK_BITS, 1.25 * standard)
+            self.assertGreaterEqual(lines, prev_lines)
+            prev_lines = lines
+        self.assertEqual(1, blocked_parameters(10 ** 6, 10 ** -3)[0])
+        self.assertLess(1, prev_lines)
+        # One line per key
+        self.assertEqual(
+            (1, 9), blocked_parameters(100, 10 ** -3, max_lines=1)[:2])
+        for error_rate in [0, 1]:
+            with self.assertRaises(ValueError):
+                blocked_parameters(100, error_rate)
+
+    def test_add_contains(self):
+        b = BlockedBloomFilter(1000, 10 ** -6)
+        digests = random_digests(200)
+        b.add_many(digests[:100])
+        res = b.contains_many(digests)
+        self.assertEqual(bool, res.dtype)
+        self.assertTrue(res[:100].all())
+        self.assertFalse(res[100:].any())
+        self.assertEqual(0, len(b.contains_many(digests[:0])))
+        # 64 byte digests and their 16 byte prefixes are the same key
+        self.assertTrue(b.contains_many(
+            np.ascontiguousarray(digests[:100, :16])).all())
+        self.assertIn(digests[0].tobytes(), b)
+        self.assertIn(digests[0, :16].tobytes(), b)
+        # Other keys
+        b.add("key")
+        b.update([b"bytes", 5])
+        for key in ["key", b"bytes", 5, "5"]:
+            self.assertIn(key, b)
+        self.assertNotIn("other", b)
+
+    def test_false_positive_rate(self):
+        b = BlockedBloomFilter(10000, 0.01)
+        b.add_many(random_digests(10000))
+        fp = b.contains_many(random_digests(100000)).mean()
+        self.assertLess(fp, 0.02)
+        self.assertGreater(fp, 0.005)
+
+    def test_file(self):
+        b = BlockedBloomFilter(1000, 10 ** -6, bloom_file, seed=5)
+        self.assertEqual(HEADER_SIZE + b.num_bits // 8,
+                         os.path.getsize(bloom_file))
+        self.assertTrue(BlockedBloomFilter.is_blocked_file(bloom_file))
+        digests = random_digests(100)
+        b.add_many(digests)
+        b.sync()
+        r = BlockedBloomFilter.open(bloom_file, 'r')
+        self.assertEqual((b.capacity, b.error_rate, b.num_hashes),
+                         (r.capacity, r.error_rate, r.num_hashes))
+        self.assertTrue(r.contains_many(digests).all())
+        with self.assertRaises(ValueError):
+            r.add("key")
+        with self.assertRaises(ValueError):
+            r.clear_all()
+        # Same seed, same filter
+        m = BlockedBloomFilter(1000, 10 ** -6, seed=5)
+        m.add_many(digests)
+        self.assertEqual(b.to_base64(), m.to_base64())
+        c = BlockedBloomFilter.from_base64(test_dir + "copy.bloom",
+                                           b.to_base64())
+        self.assertTrue(c.contains_many(digests).all())
+        # Clearing keeps the seed
+        b.clear_all()
+        self.assertFalse(b.contains_many(digests).any())
+        b.add_many(digests)
+        b.sync()
+        with open(bloom_file, 'rb') as fd1, \
+                open(test_dir + "copy.bloom", 'rb') as fd2:
+            self.assertEqual(fd1.read(), fd2.read())
+
+    def test_word_indices(self):
+        b = BlockedBloomFilter(1000, 10 ** -6, bloom_file)
+        b.sync()
+        before = np.fromfile(bloom_file, dtype='<u8')
+        keys = [f"key{i}" for i in range(50)]
+        words = b.word_indices(keys, 8)
+        b.update(keys)
+        b.sync()
+        changed = np.flatnonzero(np.fromfile(bloom_file, dtype='<u8') !=
+                                 before)
+        self.assertTrue(np.isin(changed, words).all())
+        self.assertLessEqual(len(words), len(keys) * b.num_hashes)
+        self.assertEqual(0, len(b.word_indices([], 8)))
+
+    def test_bad_file(self):
+        with open(bloom_file, 'wb') as fd:
+            fd.write(b'\0' * 128)
+        self.assertFalse(BlockedBloomFilter.is_blocked_file(bloom_file))
+        with self.assertRaises(ValueError):
+            BlockedBloomFilter.open(bloom_file)
+        b = BlockedBloomFilter(100, 0.01, bloom_file)
+        with open(bloom_file, 'r+b') as fd:
+            fd.seek(4)
+            fd.write(b'\x09\x00')
+        with self.assertRaises(ValueError):
+            BlockedBloomFilter.open(bloom_file)
+        self.assertIn("capacity: 100", repr(b))
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+"""Test of the Bloom filter versioning.
+
+Copyright (c) 2020.
+Author: Erik Buchholz
+Maintainer: Erik Buchholz
+E-mail: buchholz@comsys.rwth-aachen.de
+"""
+import multiprocessing
+import os
+import shutil
+import threading
+from unittest import TestCase, skipIf
+from unittest.mock import patch
+
+import numpy as np
+from pybloomfilter import BloomFilter
+
+from lib import config
+from lib import bloom
+from lib.bloom import (BloomChangeLog, apply_delta, read_words,
+                       compress_file, get_decompressor, encode_key,
+                       contains_many, create_bloom_filter,
+                       open_bloom_filter, get_implementation, key_words)
+from lib.blocked_bloom import BlockedBloomFilter
+from lib.helpers import to_base64
+
+test_dir = config.DATA_DIR + "test/"
+bloom_file = test_dir + "test.bloom"
+
+
+def _add_and_commit(n: int) -> None:
+    """Insert keys and commit each one, as a celery worker does."""
+    b = BloomFilter.open(bloom_file)
+    for i in range(20):
+        b.add(f"{n}-{i}")
+        b.sync()
+        BloomChangeLog(bloom_file, history=1000).commit()
+
+
+class TestBloomChangeLog(TestCase):
+
+    def setUp(self) -> None:
+        """Create test directory."""
+        shutil.rmtree(test_dir, ignore_errors=True)
+        os.makedirs(test_dir)
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        """Remove test directory."""
+        shutil.rmtree(test_dir, ignore_errors=True)
+
+    def test_commit(self):
+        log = BloomChangeLog(bloom_file)
+        self.assertEqual(0, log.commit())  # No filter
+        b = BloomFilter(1000, 0.01, bloom_file)
+        self.assertEqual(1, log.commit())
+        self.assertIsNone(log.delta(0))  # Before first version
+        self.assertEqual(1, log.commit())  # Unchanged
+        b.add("a")
+        b.sync()
+        self.assertEqual(2, log.commit())
+        version, words, values = log.delta(1)
+        self.assertEqual(2, version)
+        self.assertLessEqual(len(words), b.num_hashes)
+        self.assertGreater(len(words), 0)
+        # Persistent
+        self.assertEqual(2, BloomChangeLog(bloom_file).version)
+        # New filter with different size
+        BloomFilter(2000, 0.01, bloom_file)
+        self.assertEqual(3, log.commit())
+        self.assertIsNone(log.delta(2))
+        self.assertEqual(0, len(log.delta(3)[1]))
+
+    def test_concurrent_commit(self):
+        b = BloomFilter(10 ** 5, 0.01, bloom_file)
+        log = BloomChangeLog(bloom_file, history=1000)
+        self.assertEqual(1, log.commit())
+        copy_file = test_dir + "copy.bloom"
+        shutil.copyfile(bloom_file, copy_file)
+        processes = [multiprocessing.Process(target=_add_and_commit,
+                                             args=(n,))
+                     for n in range(4)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+            self.assertEqual(0, p.exitcode)
+        # Every commit stored its own delta, none was lost
+        version = log.version
+        self.assertEqual(version, log.commit())
+        self.assertEqual(
+            sorted(f"{v}.npy" for v in range(2, version + 1)),
+            sorted(os.listdir(log.delta_dir)))
+        _, words, values = log.delta(1)
+        apply_delta(copy_file, words, values)
+        self.assertEqual(b.to_base64(),
+                         BloomFilter.open(copy_file).to_base64())
+        for n in range(4):
+            self.assertIn(f"{n}-19", BloomFilter.open(copy_file))
+        self.assertEqual([], [f for f in os.listdir(test_dir)
+                              if f.endswith('.tmp')])
+
+    @patch("lib.config.BLOOM_DIFF_CHUNK", 100)
+    def test_delta(self):
+        log = BloomChangeLog(bloom_file, history=2)
+        b = BloomFilter(1000, 0.01, bloom_file)
+        log.commit()
+        for i in range(3):
+            b.add(str(i))
+            b.sync()
+            log.commit()
+        self.assertEqual(4, log.version)
+        self.assertIsNone(log.delta(1))  # History exceeded
+        shutil.copyfile(bloom_file, test_dir + "v4.bloom")
+        b.add("3")
+        b.sync()
+        version, words, values = log.delta(2)
+        # Uncommitted changes are not part of the delta
+        self.assertEqual(4, version)
+        c = BloomFilter.open(test_dir + "v4.bloom")
+        self.assertEqual(read_words(test_dir + "v4.bloom", words).tolist(),
+                         values.tolist())
+        self.assertIn("2", c)
+        # Large changes require full transfer
+        log = BloomChangeLog(test_dir + "large.bloom")
+        b = BloomFilter(10000, 0.01, test_dir + "large.bloom")
+        log.commit()
+        b.update(str(i) for i in range(10000))
+        b.sync()
+        self.assertEqual(2, log.commit())
+        self.assertIsNone(log.delta(1))
+
+    def test_modify(self):
+        log = BloomChangeLog(bloom_file)
+        b = BlockedBloomFilter(10 ** 5, 0.01, bloom_file)
+        b.sync()
+        self.assertEqual(1, log.commit())
+        v1 = np.fromfile(bloom_file, dtype=np.uint8)
+        # Changes are taken from the words of the keys, no copy is compared
+        with patch.object(log, "_diff") as m:
+            for i in range(3):
+                keys = [f"{i}-{j}" for j in range(10)]
+                with log.modify(key_words(b, keys)):
+                    b.update(keys)
+                    b.sync()
+            # Keys already contained do not change the filter
+            with log.modify(key_words(b, keys)):
+                b.update(keys)
+                b.sync()
+        m.assert_not_called()
+        self.assertEqual(4, log.version)
+        self.assertFalse(os.path.exists(log.shadow_file))
+        self.assertEqual(bloom_file, log.committed_file)
+        # Deltas contain the values of their version
+        copy_file = test_dir + "copy.bloom"
+        v1.tofile(copy_file)
+        _, words, values = log.delta(1)
+        b.add("uncommitted")
+        b.sync()
+        apply_delta(copy_file, words, values)
+        c = BlockedBloomFilter.open(copy_file)
+        self.assertIn("2-9", c)
+        self.assertNotIn("uncommitted", c)
+        self.assertIsNone(key_words(BloomFilter(10, 0.1), ["a"]))
+        # Readers wait for a running modification
+        result = []
+        with log.modify(key_words(b, ["x"])):
+            b.add("x")
+            reader = threading.Thread(
+                target=lambda: result.append(log.delta(1)[0]))
+            reader.start()
+            reader.join(0.2)
+            self.assertTrue(reader.is_alive())
+            b.sync()
+        reader.join()
+        self.assertEqual([5], result)
+
+    def test_apply_delta(self):
+        b = BloomFilter(1000, 0.01, bloom_file)
+        copy_file = test_dir + "copy.bloom"
+        shutil.copyfile(bloom_file, copy_file)
+        self.assertNotEqual(0, os.path.getsize(bloom_file) % 8)
+        b.update(str(i) for i in range(10))
+        b.sync()
+        size = os.path.getsize(bloom_file)
+        # All words including the incomplete last one
+        words = np.arange((size + 7) // 8, dtype='<u8')
+        values = read_words(bloom_file, words)
+        apply_delta(copy_file, words, values)
+        self.assertEqual(size, os.path.getsize(copy_file))
+        c = BloomFilter.open(copy_file)
+        for i in range(10):
+            self.assertIn(str(i), c)
+        self.assertEqual(b.to_base64(), c.to_base64())
+
+
+class TestCompression(TestCase):
+
+    def setUp(self) -> None:
+        """Create test directory."""
+        shutil.rmtree(test_dir, ignore_errors=True)
+        os.makedirs(test_dir)
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        """Remove test directory."""
+        shutil.rmtree(test_dir, ignore_errors=True)
+
+    def roundtrip(self, method: str) -> None:
+        """Compress and decompress a Bloom filter file in chunks."""
+        b = BloomFilter(1000, 0.01, bloom_file)
+        b.update(range(100))
+        b.sync()
+        compress_file(bloom_file, bloom_file + '.c', method, chunk_size=100)
+        with open(bloom_file, 'rb') as fd:
+            data = fd.read()
+        with open(bloom_file + '.c', 'rb') as fd:
+            compressed = fd.read()
+        self.assertLess(len(compressed), len(data))
+        self.assertFalse(os.path.exists(bloom_file + '.c.tmp'))
+        d = get_decompressor(method)
+        res = b''.join(d.decompress(compressed[i:i + 10])
+                       for i in range(0, len(compressed), 10))
+        res += d.flush()
+        self.assertEqual(data, res)
+
+    def test_none(self):
+        with open(bloom_file, 'wb') as fd:
+            fd.write(bytes(range(250)))
+        compress_file(bloom_file, bloom_file + '.c', 'none', chunk_size=100)
+        with open(bloom_file + '.c', 'rb') as fd:
+            self.assertEqual(bytes(range(250)), fd.read())
+
+    def test_zlib(self):
+        self.roundtrip('zlib')
+
+    @skipIf(bloom.zstandard is None, "zstandard not installed")
+    def test_zstd(self):
+        self.roundtrip('zstd')
+
+    def test_errors(self):
+        self.assertIsNone(get_decompressor('none'))
+        with self.assertRaises(ValueError):
+            get_decompressor('lzma')
+        with self.assertRaises(ValueError):
+            compress_file(bloom_file, bloom_file + '.c', 'lzma')
+        with patch("lib.bloom.zstandard", None):
+            with self.assertRaises(ValueError):
+                get_decompressor('zstd')
+
+
+class TestKeyEncoding(TestCase):
+
+    def test_encode_key(self):
+        h = bytes(range(64))
+        self.assertEqual(to_base64(h), encode_key(h, 'base64'))
+        self.assertEqual(h, encode_key(h, 'digest'))
+        self.assertEqual(h[:16], encode_key(h, 'prefix'))
+        with self.assertRaises(ValueError):
+            encode_key(h, 'md5')
+
+    def test_contains_many(self):
+        digests = np.random.randint(0, 256, (50, 64), dtype=np.uint8)
+        digests[:, -1] = 0  # Trailing zero bytes are part of the key
+        for encoding in ['base64', 'digest', 'prefix']:
+            b = BloomFilter(100, 10 ** -6)
+            for h in digests[::3]:
+                b.add(encode_key(h.tobytes(), encoding))
+            res = contains_many(b, digests, encoding)
+            self.assertEqual(bool, res.dtype)
+            self.assertEqual(list(range(0, 50, 3)),
+                             np.flatnonzero(res).tolist())
+            self.assertEqual(0, len(contains_many(b, digests[:0],
+                                                  encoding)))
+        with self.assertRaises(ValueError):
+            contains_many(b, digests, 'md5')
+
+
+class TestImplementation(TestCase):
+
+    def setUp(self) -> None:
+        """Create test directory."""
+        shutil.rmtree(test_dir, ignore_errors=True)
+        os.makedirs(test_dir)
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        """Remove test directory."""
+        shutil.rmtree(test_dir, ignore_errors=True)
+
+    def test_create_open(self):
+        for implementation, cls in [('pybloomfilter', BloomFilter),
+                                    ('blocked', BlockedBloomFilter)]:
+            b = create_bloom_filter(100, 0.01, bloom_file, implementation)
+            self.assertIsInstance(b, cls)
+            self.assertEqual(implementation, get_implementation(b))
+            b.add("key")
+            b.sync()
+            b = open_bloom_filter(bloom_file, 'r')
+            self.assertIsInstance(b, cls)
+            self.assertIn("key", b)
+            with patch("lib.config.BLOOM_IMPLEMENTATION", implementation):
+                b = create_bloom_filter(100, 0.01, bloom_file)
+            self.assertEqual(implementation, get_implementation(b))
+        with self.assertRaises(ValueError):
+            create_bloom_filter(100, 0.01, bloom_file, 'cuckoo')
+
+    def test_contains_many_blocked(self):
+        digests = np.random.randint(0, 256, (50, 64), dtype=np.uint8)
+        for encoding in ['base64', 'digest', 'prefix']:
+            b = BlockedBloomFilter(100, 10 ** -6)
+            b.update(encode_key(h.tobytes(), encoding)
+                     for h in digests[::3])
+            res = contains_many(b, digests, encoding)
+            self.assertEqual(list(range(0, 50, 3)),
+                             np.flatnonzero(res).tolist())
+        with self.assertRaises(ValueError):
+            contains_many(b, digests, 'md5')
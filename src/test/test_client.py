@@ -12,19 +12,25 @@ import logging
 import os
 import shutil
 import tempfile
+import time
+import zlib
 from typing import List
 from unittest import TestCase
 from unittest.mock import patch, Mock, MagicMock
 
+import numpy as np
 import responses
 from pybloomfilter import BloomFilter, b64encode
 from responses import GET, POST
 
 import client
-from lib import config
+from lib import config, planner
 from lib.base_client import UserType
+from lib.bloom import WORD_SIZE, WORD_DTYPE, read_words
+from lib.psi_set import psi_bucket
 from lib.record import Record
-from lib.similarity_metrics import RelativeOffsetIterator
+from lib.similarity_metrics import (RelativeOffsetIterator,
+                                    AbsoluteOffsetIterator)
 
 
 @patch("lib.config.RECORD_LENGTH", 5)
@@ -32,6 +38,7 @@ from lib.similarity_metrics import RelativeOffsetIterator
 @patch("lib.config.BLOOM_ERROR_RATE", 10 ** -5)
 @patch("lib.config.RECORD_ID_LENGTH", 2)
 @patch("lib.config.ROUNDING_VEC", [3, 3])
+@patch("lib.config.BLOOM_CACHE", False)
 class ClientTest(TestCase):
     test_dir = config.DATA_DIR + "test/"
     c = client.Client("userA")
@@ -171,35 +178,135 @@ class ClientTest(TestCase):
         self.assertIn("Missing POST value 'hashes'.", str(cm.exception))
         m.assert_called_once_with(url, json={'hashes': hash_list})
 
+    @staticmethod
+    def bloom_response(path: str, version: int, compression: str,
+                       encoding: str = None) -> Mock:
+        """Return mock response of the bloom file endpoint."""
+        with open(path, 'rb') as fd:
+            data = fd.read()
+        if compression == 'zlib':
+            data = zlib.compress(data)
+        resp = Mock()
+        resp.headers = {'Content-Type': 'application/octet-stream',
+                        'X-Bloom-Version': str(version),
+                        'X-Compression': compression}
+        if encoding is not None:
+            resp.headers['X-Bloom-Encoding'] = encoding
+        resp.iter_content.return_value = [data[i:i + 100]
+                                          for i in range(0, len(data), 100)]
+        return resp
+
     @patch("lib.base_client.BaseClient.get")
     def test_get_bloom_success(self, m):
         url = (f"https://{config.STORAGESERVER_HOSTNAME}:"
                f"{config.STORAGE_API_PORT}/"
-               f"{UserType.CLIENT}/bloom")
-        j = {
-            'success': True,
-            'bloom': self.b_encoded
-        }
-        m.return_value.json.return_value = j
-        res = self.c._get_bloom_filter()
-        res_b = res.to_base64()
-        self.assertEqual(res_b, self.b_encoded.encode())
-        m.assert_called_once_with(url)
+               f"{UserType.CLIENT}/bloom_file?compression=")
+        for compression in ['none', 'zlib']:
+            m.reset_mock()
+            m.return_value = self.bloom_response(
+                self.test_dir + "test.bloom", 3, compression)
+            with patch("lib.config.BLOOM_COMPRESSION", compression):
+                res = self.c._get_bloom_filter()
+            res_b = res.to_base64()
+            self.assertEqual(res_b, self.b_encoded.encode())
+            self.assertEqual("3", self.c._bloom_version)
+            self.assertEqual('base64', self.c._bloom_encoding)
+            m.assert_called_once_with(url + compression, stream=True)
+        m.return_value = self.bloom_response(
+            self.test_dir + "test.bloom", 4, 'none', 'prefix')
+        with patch("lib.config.BLOOM_COMPRESSION", 'none'):
+            self.c._get_bloom_filter()
+        self.assertEqual('prefix', self.c._bloom_encoding)
+
+    @patch("lib.base_client.BaseClient.get")
+    @patch("lib.config.EVAL", False)
+    def test_get_bloom_cached(self, m):
+        base = (f"https://{config.STORAGESERVER_HOSTNAME}:"
+                f"{config.STORAGE_API_PORT}/{UserType.CLIENT}")
+        server_file = self.test_dir + "server.bloom"
+        b = BloomFilter(100, 0.0001, server_file)
+        b.add("a")
+        b.sync()
+        m.return_value = self.bloom_response(server_file, 1, 'zlib',
+                                             'digest')
+        # Class patches are applied last
+        with patch("lib.config.DATA_DIR", self.test_dir), \
+                patch("lib.config.BLOOM_CACHE", True), \
+                patch("lib.config.BLOOM_COMPRESSION", 'zlib'):
+            # No local copy
+            res = self.c._get_bloom_filter()
+            m.assert_called_once_with(
+                f"{base}/bloom_file?compression=zlib", stream=True)
+            self.assertIn("a", res)
+            self.assertEqual("1", self.c._bloom_version)
+            self.assertEqual('digest', self.c._bloom_encoding)
+            self.assertTrue(os.path.exists(self.test_dir +
+                                           config.BLOOM_CACHE_FILE))
+            # Delta
+            b.add("b")
+            b.sync()
+            data = np.fromfile(server_file, dtype=np.uint8)
+            local = np.fromfile(self.test_dir + config.BLOOM_CACHE_FILE,
+                                dtype=np.uint8)
+            # The file does not end on a word boundary, the partial last
+            # word is always sent to cover it.
+            self.assertNotEqual(0, data.size % WORD_SIZE)
+            words = np.union1d(np.flatnonzero(data != local) // WORD_SIZE,
+                               [(data.size - 1) // WORD_SIZE]
+                               ).astype(WORD_DTYPE)
+            m.reset_mock()
+            m.return_value = Mock()
+            m.return_value.json.return_value = {
+                'success': True,
+                'full': False,
+                'version': 2,
+                'words': b64encode(words.tobytes()).decode(),
+                'values': b64encode(
+                    read_words(server_file, words).tobytes()).decode()
+            }
+            self.c._bloom_encoding = None  # Restored from local copy
+            res = self.c._get_bloom_filter()
+            m.assert_called_once_with(f"{base}/bloom_delta?since=1")
+            self.assertIn("b", res)
+            self.assertEqual("2", self.c._bloom_version)
+            self.assertEqual('digest', self.c._bloom_encoding)
+            self.assertEqual(b.to_base64(), res.to_base64())
+            # Outdated
+            m.reset_mock()
+            outdated = Mock()
+            outdated.json.return_value = {'success': True, 'full': True,
+                                          'version': 7}
+            m.side_effect = [outdated,
+                             self.bloom_response(server_file, 7, 'zlib')]
+            res = self.c._get_bloom_filter()
+            self.assertEqual(2, m.call_count)
+            self.assertEqual("7", self.c._bloom_version)
+            self.assertIn("b", res)
+            # Error
+            m.side_effect = None
+            m.return_value.json.return_value = {'success': False,
+                                                'msg': "Bad version"}
+            with self.assertRaises(RuntimeError) as e:
+                self.c._get_bloom_filter()
+            self.assertIn("Bad version", str(e.exception))
 
     @patch("lib.base_client.BaseClient.get")
     def test_get_bloom_fail(self, m):
         url = (f"https://{config.STORAGESERVER_HOSTNAME}:"
                f"{config.STORAGE_API_PORT}/"
-               f"{UserType.CLIENT}/bloom")
+               f"{UserType.CLIENT}/bloom_file?compression=none")
         j = {
             'success': False,
-            'msg': "Failed to retrieve bloom filter: "
+            'msg': "Unknown compression: none"
         }
+        m.return_value.headers = {'Content-Type': 'application/json'}
         m.return_value.json.return_value = j
-        with self.assertRaises(RuntimeError) as cm:
+        with patch("lib.config.BLOOM_COMPRESSION", 'none'), \
+                self.assertRaises(RuntimeError) as cm:
             self.c._get_bloom_filter()
-        self.assertIn("Failed to retrieve bloom filter:", str(cm.exception))
-        m.assert_called_once_with(url)
+        self.assertIn("Failed to retrieve bloom filter: Unknown",
+                      str(cm.exception))
+        m.assert_called_once_with(url, stream=True)
 
     def test_compute_matches_bloom_success(self):
         for v in [True, False]:
@@ -226,6 +333,105 @@ class ClientTest(TestCase):
                     res = self.c.compute_matches_bloom(m)
                     self.assertEqual(res, [])
 
+    @patch("lib.config.MATCHING_POOL_SIZE", 2)
+    @patch("lib.config.HASH_BATCH_SIZE", 1000)
+    def test_compute_matches_bloom_parallel(self):
+        target = [2.0, 2.0, 3.0, 4.0, 5.0]
+        records = [Record([2.0, 2.0, 3.0, 4.0, 5.0], hash_key=self.hash_key),
+                   Record([1.5, 2.0, 3.0, 4.0, 5.0], hash_key=self.hash_key),
+                   Record([2.5, 2.5, 3.0, 4.0, 5.0], hash_key=self.hash_key)]
+        b = BloomFilter(100, 0.0001, self.test_dir + "parallel.bloom")
+        for r in records:
+            b.add(b64encode(r.get_long_hash()).decode())
+        self.c._hash_key = self.hash_key
+        with patch.object(self.c, "_get_bloom_filter", return_value=b):
+            results = []
+            for v in [False, True]:
+                with patch("lib.config.PARALLEL", v):
+                    results.append(self.c.compute_matches_bloom(
+                        AbsoluteOffsetIterator(target, 1, [3, 3], 2)))
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(sorted(r.record for r in records),
+                         sorted(r.record for r in results[1]))
+        self.assertEqual(records[0].get_long_hash(),
+                         results[1][results[1].index(records[0])]
+                         .get_long_hash())
+
+    def test_compute_matches_budget(self):
+        target = [2.0, 2.0, 3.0, 4.0, 5.0]
+        near = Record([2.0, 2.0, 3.0, 4.0, 5.0], hash_key=self.hash_key)
+        far = Record([1.5, 2.0, 3.0, 4.0, 5.0], hash_key=self.hash_key)
+        b = BloomFilter(100, 0.0001, self.test_dir + "budget.bloom")
+        for r in (far, near):
+            b.add(b64encode(r.get_long_hash()).decode())
+        self.c._hash_key = self.hash_key
+
+        def it():
+            """201 * 201 candidates, far is 50 rings away."""
+            return AbsoluteOffsetIterator(target, 1, [3, 3], 2)
+
+        with patch.object(self.c, "_get_bloom_filter", return_value=b):
+            res = self.c.compute_matches_bloom(it(), max_matches=1)
+            self.assertEqual([near], res)
+            self.assertLess(self.c.eval['coverage'], 0.01)
+            res = self.c.compute_matches_bloom(it(), max_candidates=1)
+            self.assertEqual([near], res)
+            self.assertEqual(1, self.c.eval['candidates_examined'])
+            self.assertEqual(1 / 201 ** 2, self.c.eval['coverage'])
+            res = self.c.compute_matches_bloom(it(), max_candidates=101 ** 2)
+            self.assertEqual([near, far], res)
+            self.assertEqual(101 ** 2, self.c.eval['candidates_examined'])
+            res = self.c.compute_matches_bloom(it(), max_candidates=10 ** 6)
+            self.assertEqual([near, far], res)
+            self.assertEqual(1, self.c.eval['coverage'])
+            res = self.c.compute_matches_bloom(
+                it(), deadline=time.monotonic() - 1)
+            self.assertEqual([], res)
+            self.assertEqual(0, self.c.eval['coverage'])
+        self.c._psi_mode = True
+        psi_ind = [near.get_psi_index(), far.get_psi_index()]
+        with patch.object(self.c, "_perform_psi",
+                          return_value=psi_ind) as m:
+            res = self.c.compute_matches_psi(it(), max_candidates=5)
+            self.assertEqual([near], res)
+            self.assertEqual(5, len(m.call_args[0][0]))
+            res = self.c.compute_matches_psi(it(), max_matches=1)
+            self.assertEqual([near], res)
+
+    def test_compute_matches_incremental(self):
+        near = Record([2.0, 2.0, 3.0, 4.0, 5.0], hash_key=self.hash_key)
+        far = Record([2.08, 2.0, 3.0, 4.0, 5.0], hash_key=self.hash_key)
+        b = BloomFilter(100, 0.0001, self.test_dir + "incremental.bloom")
+        for r in (far, near):
+            b.add(b64encode(r.get_long_hash()).decode())
+        self.c._hash_key = self.hash_key
+        self.c._bloom_version = "v1"
+        self.c.activate_incremental_mode()
+
+        def it(x: float):
+            """11 * 11 candidates around (x, 2.0)."""
+            return AbsoluteOffsetIterator([x, 2.0, 3.0, 4.0, 5.0], 0.05,
+                                          [3, 3], 2)
+
+        with patch("lib.config.DATA_DIR", self.test_dir), \
+                patch.object(self.c, "_get_bloom_filter", return_value=b):
+            res = self.c.compute_matches_bloom(it(2.0))
+            self.assertEqual([near], res)
+            self.assertEqual(121, self.c.eval['delta_candidates'])
+            # Only the 5 new columns are checked
+            res = self.c.compute_matches_bloom(it(2.05))
+            self.assertEqual([near, far], res)
+            self.assertEqual(55, self.c.eval['delta_candidates'])
+            res = self.c.compute_matches_bloom(it(2.1))
+            self.assertEqual([far], res)
+            self.assertEqual(55, self.c.eval['delta_candidates'])
+            # Changed Bloom filter
+            self.c._bloom_version = "v2"
+            res = self.c.compute_matches_bloom(it(2.05))
+            self.assertEqual([near, far], res)
+            self.assertEqual(121, self.c.eval['delta_candidates'])
+        self.c._incremental = False
+
     def test_compute_matches_bloom_fail(self):
         self.c._psi_mode = True
         with patch.object(self.c, "_get_bloom_filter",
@@ -251,6 +457,30 @@ class ClientTest(TestCase):
                 [self.records[4].record, self.records[5].record])
             self.assertEqual(res, [])
 
+    def test_compute_matches_psi_ranked(self):
+        self.c._psi_mode = True
+        self.c._hash_key = self.hash_key
+        target = [2.0, 2.0, 3.0, 4.0, 5.0]
+        candidates = list(AbsoluteOffsetIterator(target, 1, [3, 3], 2))
+        expected = [Record(list(candidates[i]), hash_key=self.hash_key)
+                    for i in (3, 17, 40)]
+        psi_ind = [r.get_psi_index() for r in expected] + [12345]
+        with patch.object(self.c, "_perform_psi",
+                          return_value=psi_ind) as m:
+            res = self.c.compute_matches_psi(
+                AbsoluteOffsetIterator(target, 1, [3, 3], 2))
+            self.assertEqual(expected, res)
+            client_set = m.call_args[0][0]
+            self.assertEqual(len(candidates), len(client_set))
+            self.assertEqual(sorted(client_set), client_set)
+            self.assertIn(psi_ind[1], client_set)
+            # Same result with stored vectors
+            res = self.c.compute_matches_psi(candidates, max_matches=2)
+            self.assertEqual(expected[:2], res)
+        with patch.object(self.c, "_perform_psi", return_value=[]):
+            self.assertEqual([], self.c.compute_matches_psi(
+                AbsoluteOffsetIterator(target, 1, [3, 3], 2)))
+
     @patch("lib.config.RECORD_LENGTH", 10)
     @patch("lib.config.RECORD_ID_LENGTH", 10)
     def test_compute_matches_psi_fail(self):
@@ -275,6 +505,7 @@ class ClientTest(TestCase):
     @patch.object(c, "_receive_psi", Mock(return_value=[1, 2, 3]))
     @patch("lib.base_client.BaseClient.get")
     @patch("lib.config.EVAL", False)
+    @patch("lib.config.PSI_CLIENT_MIN_SETSIZE", 4)
     def test__perform_psi(self, m):
         self.assertEqual([], self.c._perform_psi([]))
         url = (
@@ -294,13 +525,24 @@ class ClientTest(TestCase):
                 m.return_value.json.return_value = j
                 res = self.c._perform_psi([1, 2, 3, 4, 5, 6])
                 self.assertEqual([1, 2, 3], res)
-                m.assert_called_once_with(url)
+                m.assert_called_once_with(url, params={'setSize': 8})
+                m.reset_mock()
+                # Padded to the size class returned by the server
+                j['clientSetSize'] = 8
+                self.c._perform_psi([1, 2, 3, 4, 5, 6])
+                args = self.c._receive_psi.call_args
+                self.assertEqual(8, len(args[0][0]))
+                self.assertEqual(100, args[1]['server_set_size'])
+                del j['clientSetSize']
+                self.c._perform_psi([1, 2, 3, 4, 5, 6])
+                self.assertEqual(100, len(
+                    self.c._receive_psi.call_args[0][0]))
                 m.reset_mock()
                 j['success'] = False
                 m.return_value.json.return_value = j
                 with self.assertRaises(RuntimeError) as e:
                     self.c._perform_psi([1, 2, 3, 4, 5, 6])
-                m.assert_called_once_with(url)
+                m.assert_called_once_with(url, params={'setSize': 8})
                 m.reset_mock()
                 self.assertEqual("PSI failed: blub", str(e.exception))
                 j['success'] = True
@@ -308,7 +550,7 @@ class ClientTest(TestCase):
                 m.return_value.json.return_value = j
                 with self.assertRaises(RuntimeError) as e:
                     self.c._perform_psi([1, 2, 3, 4, 5, 6])
-                m.assert_called_once_with(url)
+                m.assert_called_once_with(url, params={'setSize': 8})
                 m.reset_mock()
                 self.assertEqual("Client Set larger than PSI Setsize.",
                                  str(e.exception))
@@ -317,10 +559,49 @@ class ClientTest(TestCase):
                 m.return_value.json.return_value = j
                 with self.assertRaises(RuntimeError) as e:
                     self.c._perform_psi([1, 2, 3, 4, 5, 6])
-                m.assert_called_once_with(url)
+                m.assert_called_once_with(url, params={'setSize': 8})
                 m.reset_mock()
                 self.assertIn("Mismatch", str(e.exception))
 
+    @patch("lib.config.EVAL", False)
+    @patch("lib.config.PSI_CLIENT_MIN_SETSIZE", 4)
+    def test__perform_bucket_psi(self):
+        client_set = list(range(1, 11)) + [3]
+        d = {'success': True, 'tls': config.PSI_TLS, 'host': '127.0.0.1',
+             'port': 1234, 'setSize': 100, 'clientSetSize': 4, 'buckets': 4}
+        rejected = {'success': False, 'msg': 'split', 'buckets': 4}
+        # Every PSI returns the real indices of the client set
+        recv = Mock(side_effect=lambda s, *args, **kwargs: s)
+        for sessions in [1, 2]:
+            with patch("lib.config.PSI_BUCKET_SESSIONS", sessions), \
+                    patch.object(self.c, "_receive_psi", recv), \
+                    patch.object(self.c, "_request_psi",
+                                 side_effect=[rejected] + [d] * 4) as m:
+                res = self.c._perform_psi(client_set)
+            self.assertEqual(list(range(1, 11)), sorted(res))
+            self.assertEqual(4, self.c._psi_buckets)
+            # Buckets are padded to the size class of the largest bucket
+            self.assertEqual(4, recv.call_count)
+            for call in recv.call_args_list:
+                self.assertEqual(4, len(call[0][0]))
+            self.assertEqual({0: 2, 1: 3, 2: 3, 3: 2}, {
+                psi_bucket(call[0][0][0], 4): len(
+                    [i for i in call[0][0]
+                     if i < config.PSI_DUMMY_START_CLIENT])
+                for call in recv.call_args_list})
+            if sessions == 1:
+                m.assert_called_with(4, buckets=4)
+                self.assertEqual(2, m.call_count)
+            else:
+                m.assert_any_call(4, buckets=4, bucket=3)
+                self.assertEqual(5, m.call_count)
+            recv.reset_mock()
+        # Client buckets too large
+        with patch.object(self.c, "_request_psi",
+                          side_effect=[rejected, d]):
+            with self.assertRaises(RuntimeError):
+                self.c._perform_psi(list(range(40)))
+
     @patch("lib.similarity_metrics.AbsoluteOffsetIterator")
     def test_compute_candidates(self, m):
         # Default
@@ -331,6 +612,32 @@ class ClientTest(TestCase):
         self.c.compute_candidates(r, "offset-7.77")
         m.assert_called_with(r, 7.77)
 
+    @patch("lib.planner.load_calibration",
+           Mock(return_value=planner.DEFAULT_CALIBRATION))
+    def test_plan(self):
+        target = [2.0, 2.0, 3.0, 4.0, 5.0]
+        res = self.c.plan(target, "offset-1")
+        self.assertEqual(201 ** 2, res['candidates'])
+        self.assertEqual("offset-1", res['metric'])
+        self.assertIn(res['mode'], ['bloom', 'psi'])
+        # Auto mode rejects queries exceeding the budget before any
+        # server is contacted
+        with patch("lib.config.PLANNER_AUTO_MODE", True), \
+                patch("lib.config.PLANNER_COST_BUDGET", 0), \
+                patch("lib.config.EVAL", False):
+            with self.assertRaises(RuntimeError) as e:
+                self.c.full_retrieve(target)
+            self.assertIn("cost budget", str(e.exception))
+        # In eval mode, the plan is only recorded
+        with patch("lib.config.PLANNER_AUTO_MODE", True), \
+                patch("lib.config.PLANNER_COST_BUDGET", 0), \
+                patch("lib.config.EVAL", True), \
+                patch.object(self.c, "get_hash_key",
+                             side_effect=ConnectionError):
+            with self.assertRaises(ConnectionError):
+                self.c.full_retrieve(target)
+            self.assertIsNone(self.c.eval['planned_mode'])
+
     def test_parser(self):
         # Just syntax errors
         p = client.get_client_parser()
@@ -365,7 +672,6 @@ class ClientTest(TestCase):
         matches = [sr[0], sr[3], sr[5]]
         for m in matches:
             b.add(b64encode(m.get_long_hash()).decode())
-        b_encoded = b.to_base64().decode()
         # Responses
         # -----------------------------------------------------------
         # 1. Hash Key
@@ -391,12 +697,14 @@ class ClientTest(TestCase):
         # 2. Bloom filter
         url = (f"https://{config.STORAGESERVER_HOSTNAME}:"
                f"{config.STORAGE_API_PORT}/"
-               f"{UserType.CLIENT}/bloom")
-        j = {
-            'success': True,
-            'bloom': b_encoded
-        }
-        responses.add(GET, url, status=200, json=j)
+               f"{UserType.CLIENT}/bloom_file?compression=zlib")
+        b.sync()
+        with open(tmp.name, 'rb') as fd:
+            body = zlib.compress(fd.read())
+        responses.add(GET, url, status=200, body=body,
+                      content_type='application/octet-stream',
+                      headers={'X-Bloom-Version': '1',
+                               'X-Compression': 'zlib'})
         # 3. Encryption Keys
         url = f"https://localhost:" \
               f"{config.KEY_API_PORT}/client/key_retrieval?totalOTs=3"
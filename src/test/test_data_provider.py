@@ -9,9 +9,10 @@ E-mail: buchholz@comsys.rwth-aachen.de
 import argparse
 import json
 import logging
+import multiprocessing
 import tempfile
 from unittest import TestCase
-from unittest.mock import patch
+from unittest.mock import Mock, patch
 
 import responses
 
@@ -19,7 +20,7 @@ import data_provider as dp
 from lib import config
 from lib.base_client import UserType
 from lib.helpers import to_base64
-from lib.record import Record
+from lib.record import Record, RecordTable
 
 
 @patch("lib.config.RECORD_LENGTH", 5)
@@ -168,4 +169,66 @@ class DataProviderTest(TestCase):
                 fd.write(b'[1,2,3,5, 6]\n')
                 fd.seek(0)
                 self.d.store_from_file(fd.name)
-            m.assert_called_with(res)
+            m.assert_called_once()
+            table = m.call_args[0][0]
+            self.assertEqual(res, list(table))
+
+    @patch("lib.config.PARALLEL", False)
+    def test_store_from_file_stream(self):
+        vectors = [[i, 2, 3, 4, 5] for i in range(5)]
+        uploaded = []
+        with patch.object(self.d, "get_hash_key", return_value=b"key"), \
+                patch.object(self.d, "_get_enc_keys",
+                             side_effect=lambda x: [b"0" * 16] * len(x)), \
+                patch.object(self.d, "post",
+                             side_effect=lambda url, json: (
+                                 uploaded.append(json),
+                                 Mock(**{'json.return_value':
+                                         {'success': True}}))[1]):
+            with tempfile.NamedTemporaryFile() as fd:
+                for v in vectors:
+                    fd.write(f"{v}\n".encode())
+                fd.flush()
+                self.d.store_from_file(fd.name, chunk_size=2)
+        self.assertEqual([2, 2, 1], [len(u) for u in uploaded])
+        # Ciphertext sizes of all chunks, not only of the last one
+        self.assertEqual([len(c) for u in uploaded for (h, c, o) in u],
+                         self.d.eval['cx_sizes'])
+        self.assertEqual(3, self.d.eval['stream_chunks'])
+        records = [Record(v, hash_key=b"key") for v in vectors]
+        for r, (h, c, o) in zip(records, [u for c in uploaded for u in c]):
+            self.assertEqual(to_base64(r.get_long_hash()), h)
+            self.assertEqual('userA', o)
+            self.assertEqual(r, Record.from_ciphertext(
+                c, b"0" * 16, r.get_long_hash()))
+        # Same eval keys as store_records, in order of the steps
+        keys = ['start_time', 'parsed_list_time', 'hash_key_time',
+                'hash_set_time', 'ot_index_time', 'key_retrieve_time',
+                'set_key_time', 'encryption_time', 'send_time']
+        times = [self.d.eval[k] for k in keys]
+        self.assertEqual(sorted(times), times)
+
+    @patch("lib.config.PARALLEL", True)
+    @patch("lib.config.CRYPTO_CHUNK_SIZE", 1)
+    def test_store_stream_parallel(self):
+        vectors = [[i, 2, 3, 4, 5] for i in range(4)]
+        uploaded = []
+        pool = multiprocessing.Pool(2)
+        # One pool for the whole stream, created before the upload thread
+        try:
+            with patch.object(self.d, "get_hash_key", return_value=b"key"), \
+                    patch.object(self.d, "_get_enc_keys",
+                                 side_effect=lambda x: [b"0" * 16] * len(x)), \
+                    patch.object(self.d, "_batch_store_records_on_server",
+                                 side_effect=uploaded.append), \
+                    patch("data_provider.mp.Pool", return_value=pool) as m:
+                self.d.store_stream(RecordTable(vectors[i:i + 2])
+                                    for i in range(0, 4, 2))
+        finally:
+            pool.terminate()
+            pool.join()
+        m.assert_called_once()
+        records = [Record(v, hash_key=b"key") for v in vectors]
+        for r, (h, c, o) in zip(records, [u for c in uploaded for u in c]):
+            self.assertEqual(r, Record.from_ciphertext(
+                c, b"0" * 16, r.get_long_hash()))
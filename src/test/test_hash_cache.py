@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""Test of the persistent candidate hash cache.
+
+Copyright (c) 2020.
+Author: Erik Buchholz
+Maintainer: Erik Buchholz
+E-mail: buchholz@comsys.rwth-aachen.de
+"""
+import os
+import pickle
+import shutil
+import sqlite3
+from unittest import TestCase
+from unittest.mock import patch
+
+from lib import config
+from lib.hash_cache import HashCache
+from lib.record import RecordBatch
+
+test_dir = config.DATA_DIR + "test/"
+cache_file = test_dir + "hash_cache.sqlite"
+
+
+class TestHashCache(TestCase):
+
+    def setUp(self) -> None:
+        """Create test directory."""
+        shutil.rmtree(test_dir, ignore_errors=True)
+        os.makedirs(test_dir)
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        """Remove test directory."""
+        shutil.rmtree(test_dir, ignore_errors=True)
+
+    def test_lookup_store(self):
+        c = HashCache(b"key", cache_file)
+        self.assertEqual([None, None], c.lookup([b"a", b"b"]))
+        self.assertEqual((0, 2), (c.hits, c.misses))
+        c.store([(b"a", b"hash-a")])
+        self.assertEqual([b"hash-a", None], c.lookup([b"a", b"b"]))
+        self.assertEqual((1, 3), (c.hits, c.misses))
+        self.assertEqual(1, len(c))
+        # Persistent
+        c = HashCache(b"key", cache_file)
+        self.assertEqual([b"hash-a"], c.lookup([b"a"]))
+        c.clear()
+        self.assertEqual(0, len(c))
+
+    def test_many(self):
+        c = HashCache(b"key", cache_file)
+        ids = [str(i).encode() for i in range(2000)]
+        c.store((i, i + b"-hash") for i in ids)
+        self.assertEqual([i + b"-hash" for i in ids], c.lookup(ids))
+
+    def test_key_change(self):
+        c = HashCache(b"key", cache_file)
+        c.store([(b"a", b"hash-a")])
+        c = HashCache(b"other key", cache_file)
+        self.assertEqual(0, len(c))
+        self.assertEqual([None], c.lookup([b"a"]))
+
+    def test_concurrent_keys(self):
+        # A process with an old key keeps running after the key changed
+        old = HashCache(b"key", cache_file)
+        new = HashCache(b"other key", cache_file)
+        old.store([(b"a", b"old-a"), (b"b", b"old-b")])
+        new.store([(b"a", b"new-a")])
+        self.assertEqual([b"new-a", None], new.lookup([b"a", b"b"]))
+        self.assertEqual([b"old-a", b"old-b"], old.lookup([b"a", b"b"]))
+        self.assertEqual((1, 2), (len(new), len(old)))
+        new.clear()
+        self.assertEqual(2, len(old))
+
+    def test_unbound_table(self):
+        conn = sqlite3.connect(cache_file)
+        with conn:
+            conn.execute("CREATE TABLE hashes (identifier BLOB PRIMARY KEY, "
+                         "hash BLOB, last_used INTEGER)")
+            conn.execute("INSERT INTO hashes VALUES (?, ?, 0)",
+                         (b"a", b"hash-a"))
+        conn.close()
+        c = HashCache(b"key", cache_file)
+        self.assertEqual([None], c.lookup([b"a"]))
+        c.store([(b"a", b"hash-a")])
+        self.assertEqual([b"hash-a"], c.lookup([b"a"]))
+
+    def test_lru(self):
+        c = HashCache(b"key", cache_file, max_entries=2)
+        c.store([(b"a", b"1"), (b"b", b"2")])
+        c.lookup([b"a"])  # b is least recently used now
+        c.store([(b"c", b"3")])
+        self.assertEqual(2, len(c))
+        self.assertEqual([b"1", None, b"3"], c.lookup([b"a", b"b", b"c"]))
+
+    def test_pickle(self):
+        c = HashCache(b"key", cache_file)
+        c.store([(b"a", b"hash-a")])
+        c2 = pickle.loads(pickle.dumps(c))
+        self.assertEqual([b"hash-a"], c2.lookup([b"a"]))
+
+    @patch("lib.config.RECORD_LENGTH", 5)
+    @patch("lib.config.RECORD_ID_LENGTH", 3)
+    @patch("lib.config.ROUNDING_VEC", [3, 3, 3])
+    def test_record_batch(self):
+        vectors = [[i, i + 1, i + 2, 0, 0] for i in range(100)]
+        expected = RecordBatch(vectors, b"key").get_long_hashes()
+        c = HashCache(b"key", cache_file)
+        b = RecordBatch(vectors, b"key", cache=c)
+        self.assertEqual(expected.tolist(), b.get_long_hashes().tolist())
+        self.assertEqual((0, 100), (c.hits, c.misses))
+        b = RecordBatch(vectors, b"key", cache=c)
+        self.assertEqual(expected.tolist(), b.get_long_hashes().tolist())
+        self.assertEqual((100, 100), (c.hits, c.misses))
+        # Cache of old key is dropped on key change
+        b.set_hash_key(b"other")
+        self.assertIsNone(b.cache)
@@ -6,6 +6,7 @@ Author: Erik Buchholz
 Maintainer: Erik Buchholz
 E-mail: buchholz@comsys.rwth-aachen.de
 """
+import json
 import os
 import shutil
 import socket
@@ -13,6 +14,8 @@ import ssl
 from unittest import TestCase
 import multiprocessing as mp
 
+import numpy as np
+
 import lib.config as config
 import lib.helpers as helpers
 
@@ -37,6 +40,42 @@ class HelpersTest(TestCase):
         self.assertEqual(l1, helpers.parse_list(l1_s))
         self.assertEqual(l2, helpers.parse_list(l2_s))
 
+    def test_parse_lists(self):
+        lines = ["[1,2,3,4,5]", "\n", "[1,2.4123,3.45, 4.884231,5]\n",
+                 "[1e-05, -0.1, 1.7976931348623157e+308, 0.1, 123456.789]\n"]
+        res = helpers.parse_lists(lines)
+        self.assertEqual((3, 5), res.shape)
+        expected = [helpers.parse_list(line) for line in lines
+                    if line.strip()]
+        self.assertEqual(expected, res.tolist())
+        self.assertEqual((0, 0), helpers.parse_lists([]).shape)
+        with self.assertRaises(ValueError):
+            helpers.parse_lists(["[1,2,3]", "[1,2]"])
+        with self.assertRaises(ValueError):
+            helpers.parse_lists(["[1,2,3]", "[1,a,3]"])
+
+    def test_load_save_records(self):
+        testdir = config.DATA_DIR + '/test/'
+        os.makedirs(testdir, exist_ok=True)
+        records = [[1.1, 2.2, 3.3], [4.4, 5.5, 6.6]]
+        for name in ["records.txt", "records.npy"]:
+            helpers.save_records(testdir + name, records)
+            res = helpers.load_records(testdir + name)
+            self.assertEqual(records, res.tolist())
+        self.assertTrue(helpers.is_binary_record_file(testdir + name))
+        self.assertIsInstance(res, np.memmap)
+        with open(testdir + "records.txt") as fd:
+            self.assertEqual(str(records[0]), fd.readline().strip())
+        shutil.rmtree(testdir, ignore_errors=True)
+
+    def test_json_length(self):
+        for rows in [
+            [],
+            [("hash", "ciphertext", "owner")],
+            [["a", '{"nonce": "a\\b"}', "\u00e4"], ("", "\t", "c")]
+        ]:
+            self.assertEqual(len(json.dumps(rows)), helpers.json_length(rows))
+
     def test_port_free(self):
         self.assertTrue(helpers.port_free(60000))
 
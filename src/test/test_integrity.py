@@ -23,7 +23,8 @@ import data_provider
 import key_server
 import storage_server
 from lib import config
-from lib.helpers import to_base64
+from lib.bloom import encode_key
+from lib.helpers import to_base64, from_base64
 from lib.key_server_backend import KeyServer
 from lib.record import Record
 from lib.storage_server_backend import StorageServer
@@ -258,7 +259,7 @@ class ClientIntegrityTest(TestCase):
             )
         # Decrypt
         result = [
-            Record.from_ciphertext(json.loads(r), self.enc_keys[0])
+            Record.from_ciphertext(r, self.enc_keys[0], from_base64(h))
             for h, r in res
         ]
         self.assertEqual([], result)
@@ -275,7 +276,8 @@ class ClientIntegrityTest(TestCase):
             for r in self.sr:
                 # check that records are in bloom filter
                 b = str_backend.bloom
-                self.assertIn(to_base64(r.get_long_hash()), b)
+                self.assertIn(encode_key(r.get_long_hash(),
+                                         str_backend.get_bloom_encoding()), b)
             # Check records in db
             res = str_backend.batch_get_records(
                 [to_base64(r.get_long_hash()) for r in self.sr],
@@ -283,7 +285,7 @@ class ClientIntegrityTest(TestCase):
             )
         # Decrypt
         result = [
-            Record.from_ciphertext(json.loads(r), self.enc_keys[0])
+            Record.from_ciphertext(r, self.enc_keys[0], from_base64(h))
             for h, r in res
         ]
         for m in self.sr:
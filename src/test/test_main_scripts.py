@@ -8,6 +8,7 @@ E-mail: buchholz@comsys.rwth-aachen.de
 """
 import os
 import tempfile
+import numpy as np
 import random_record_generator
 import setuptools
 from unittest import TestCase, mock, skip
@@ -25,6 +26,10 @@ class TestMain(TestCase):
         f = tempfile.NamedTemporaryFile(delete=False)
         random_record_generator.main(["1", "-o", f"{f.name}"])
         os.remove(f.name)
+        f = tempfile.NamedTemporaryFile(delete=False, suffix=".npy")
+        random_record_generator.main(["2", "-o", f"{f.name}", "-l", "5"])
+        self.assertEqual((2, 5), np.load(f.name).shape)
+        os.remove(f.name)
 
     def test_setup(self):
         import warnings
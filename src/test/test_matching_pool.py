@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""Test of the persistent Bloom matching pool.
+
+Copyright (c) 2020.
+Author: Erik Buchholz
+Maintainer: Erik Buchholz
+E-mail: buchholz@comsys.rwth-aachen.de
+"""
+import os
+import shutil
+from unittest import TestCase
+from unittest.mock import patch
+
+from pybloomfilter import BloomFilter
+
+from lib import config
+from lib.helpers import to_base64
+from lib.matching_pool import MatchingPool, get_matching_pool
+from lib.record import Record
+from lib.similarity_metrics import AbsoluteOffsetIterator
+
+test_dir = config.DATA_DIR + "test/"
+bloom_file = test_dir + "pool.bloom"
+hash_key = b'0' * 16
+
+
+@patch("lib.config.RECORD_LENGTH", 3)
+@patch("lib.config.RECORD_ID_LENGTH", 2)
+@patch("lib.config.ROUNDING_VEC", [3, 3])
+@patch("lib.config.HASH_BATCH_SIZE", 7)
+class TestMatchingPool(TestCase):
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        """Start pool."""
+        shutil.rmtree(test_dir, ignore_errors=True)
+        os.makedirs(test_dir)
+        cls.pool = MatchingPool(3)
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        """Stop pool and remove test directory."""
+        cls.pool.close()
+        shutil.rmtree(test_dir, ignore_errors=True)
+
+    @staticmethod
+    def add(b: BloomFilter, vec: list) -> Record:
+        """Add record to the filter as the storage server does."""
+        r = Record(vec, hash_key=hash_key)
+        b.add(to_base64(r.get_long_hash()))
+        b.sync()
+        return r
+
+    def test_match(self):
+        it = AbsoluteOffsetIterator([1.0, 1.0, 5.0], 0.01, [3, 3], 2)
+        self.assertEqual(12 * 12, it.size)
+        b = BloomFilter(100, 0.0001, bloom_file)
+        b.add("other")
+        expected = [self.add(b, [1.0, 0.99, 5.0]),
+                    self.add(b, [1.01, 1.0, 5.0])]
+        self.add(b, [2.0, 1.0, 5.0])  # No candidate
+        vectors, hashes, hits, misses = self.pool.match(
+            it, bloom_file, 1, hash_key)
+        self.assertEqual([r.record for r in expected], vectors.tolist())
+        self.assertEqual([r.get_long_hash() for r in expected],
+                         [h.tobytes() for h in hashes])
+        self.assertEqual((0, 0), (hits, misses))
+        # Workers reopen the filter for a new version
+        expected.append(self.add(b, [1.01, 1.01, 5.0]))
+        vectors, _, _, _ = self.pool.match(it, bloom_file, 2, hash_key)
+        self.assertEqual(sorted(r.record for r in expected),
+                         sorted(vectors.tolist()))
+        # Sub range
+        vectors, _, _, _ = self.pool.match(it[:5], bloom_file, 2, hash_key)
+        self.assertEqual((0, 3), vectors.shape)
+
+    def test_error(self):
+        pool = MatchingPool(2)
+        it = AbsoluteOffsetIterator([1.0, 1.0, 5.0], 0.01, [3, 3], 2)
+        broken = test_dir + "broken.bloom"
+        with open(broken, 'wb') as fd:
+            fd.write(b'no bloom filter')
+        try:
+            with self.assertRaises(RuntimeError):
+                pool.match(it, broken, 1, hash_key)
+            self.assertFalse(pool.alive)
+        finally:
+            pool.close()
+
+    def test_get_matching_pool(self):
+        with patch("lib.config.MATCHING_POOL_SIZE", 2):
+            pool = get_matching_pool()
+            self.assertEqual(2, len(pool))
+            self.assertIs(pool, get_matching_pool())
+            pool.close()
+            new = get_matching_pool()
+            self.assertIsNot(pool, new)
+            new.close()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""Test of the query cost planner.
+
+Copyright (c) 2020.
+Author: Erik Buchholz
+Maintainer: Erik Buchholz
+E-mail: buchholz@comsys.rwth-aachen.de
+"""
+import json
+import math
+import os
+import shutil
+from unittest import TestCase
+from unittest.mock import patch
+
+from lib import config, planner
+
+test_dir = config.DATA_DIR + "test/"
+calibration_file = test_dir + "calibration.json"
+
+
+class TestPlanner(TestCase):
+
+    def setUp(self) -> None:
+        """Create test directory."""
+        shutil.rmtree(test_dir, ignore_errors=True)
+        os.makedirs(test_dir)
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        """Remove test directory."""
+        shutil.rmtree(test_dir, ignore_errors=True)
+
+    @patch("lib.config.RECORD_LENGTH", 5)
+    @patch("lib.config.RECORD_ID_LENGTH", 2)
+    @patch("lib.config.ROUNDING_VEC", [3, 3])
+    def test_calibrate(self):
+        res = planner.calibrate(100)
+        self.assertGreater(res['hash_rate'], 0)
+
+    @patch("lib.config.RECORD_LENGTH", 5)
+    @patch("lib.config.RECORD_ID_LENGTH", 2)
+    @patch("lib.config.ROUNDING_VEC", [3, 3])
+    def test_load_calibration(self):
+        # No file, no benchmark
+        self.assertEqual(planner.DEFAULT_CALIBRATION,
+                         planner.load_calibration(calibration_file, False))
+        self.assertFalse(os.path.exists(calibration_file))
+        # Benchmark is stored
+        with patch("lib.planner.calibrate",
+                   return_value={'hash_rate': 5}) as m:
+            res = planner.load_calibration(calibration_file)
+            self.assertEqual(5, res['hash_rate'])
+            m.assert_called_once()
+            res = planner.load_calibration(calibration_file)
+            self.assertEqual(5, res['hash_rate'])
+            m.assert_called_once()
+        # Manual values override defaults
+        with open(calibration_file, 'w') as fd:
+            json.dump({'bandwidth': 1}, fd)
+        res = planner.load_calibration(calibration_file)
+        self.assertEqual(1, res['bandwidth'])
+        self.assertEqual(planner.DEFAULT_CALIBRATION['hash_rate'],
+                         res['hash_rate'])
+
+    def test_bloom_size(self):
+        # 10 ** 6 elements with 1 % false positives: 1.14 MiB
+        binary = planner.bloom_size(10 ** 6, 0.01, 'none')
+        self.assertEqual(1198133, binary)
+        # A full filter is not compressible, a sparse one is
+        full = planner.bloom_size(10 ** 6, 0.01, 'zlib')
+        self.assertLessEqual(full, binary)
+        self.assertGreater(full, 0.99 * binary)
+        sparse = planner.bloom_size(10 ** 6, 0.01, 'zlib', 10 ** 5)
+        self.assertLess(sparse, full / 2)
+        self.assertEqual(math.ceil(binary / 1000),
+                         planner.bloom_size(10 ** 6, 0.01, 'zlib', 0))
+        # Updates of a cached filter: 6 words per record
+        self.assertEqual(1000 * 6 * 16 * 4 // 3,
+                         planner.bloom_delta_size(1000, 10 ** 6, 0.01))
+        with patch("lib.config.BLOOM_COMPRESSION", 'none'):
+            self.assertEqual(binary,
+                             planner.bloom_delta_size(10 ** 5, 10 ** 6, 0.01))
+
+    @patch("lib.config.PSI_SETSIZE", 1000)
+    @patch("lib.config.OT_SETSIZE", 100)
+    @patch("lib.config.OT_MAX_NUM", 10)
+    @patch("lib.config.BLOOM_CAPACITY", 10 ** 6)
+    @patch("lib.config.BLOOM_ERROR_RATE", 0.01)
+    def test_plan_query(self):
+        cal = planner.DEFAULT_CALIBRATION.copy()
+        cal['hash_rate'] = 1000
+        cal['bandwidth'] = 10 ** 6
+        plan = planner.plan_query(500, cal, expected_matches=5, budget=100)
+        self.assertEqual(500, plan['candidates'])
+        self.assertEqual(0.5, plan['hash_time'])
+        self.assertEqual(planner.bloom_size(), plan['bloom_bytes'])
+        self.assertEqual(5, plan['bloom_false_positives'])
+        self.assertEqual(10, plan['ot_count'])
+        self.assertEqual(10 * 100 * 16, plan['ot_bytes'])
+        self.assertEqual(1, plan['psi_sessions'])
+        self.assertEqual(2 * 1000 * 300, plan['psi_bytes'])
+        # The binary filter of 1.14 MiB is retrieved faster than the PSI
+        self.assertLess(plan['bloom_cost'], plan['psi_cost'])
+        self.assertEqual('bloom', plan['mode'])
+        with patch("lib.config.BLOOM_ERROR_RATE", 10 ** -6):
+            large = planner.plan_query(500, cal, expected_matches=5,
+                                       budget=100)
+        self.assertLess(large['psi_cost'], large['bloom_cost'])
+        self.assertEqual('psi', large['mode'])
+        # Only the changes of a cached filter are retrieved
+        cached = planner.plan_query(500, cal, expected_matches=5,
+                                    budget=100, bloom_cached=True)
+        self.assertEqual(planner.bloom_delta_size(), cached['bloom_bytes'])
+        self.assertLess(cached['bloom_cost'], plan['bloom_cost'])
+        # Client set padded to its size class only
+        with patch("lib.config.PSI_CLIENT_MIN_SETSIZE", 4):
+            small = planner.plan_query(500, cal, expected_matches=5,
+                                       budget=100)
+        self.assertEqual((1000 + 512) * 300, small['psi_bytes'])
+        self.assertLess(small['psi_cost'], plan['psi_cost'])
+        # Server set split into buckets
+        with patch("lib.config.PSI_CLIENT_MIN_SETSIZE", 4):
+            sharded = planner.plan_query(500, cal, expected_matches=5,
+                                         budget=100, psi_buckets=4)
+        self.assertEqual((4 * 1000 + 4 * 128) * 300, sharded['psi_bytes'])
+        self.assertGreater(sharded['psi_cost'], small['psi_cost'])
+        with patch("lib.config.PSI_BUCKET_SESSIONS", 4), \
+                patch("lib.config.PSI_CLIENT_MIN_SETSIZE", 4):
+            parallel = planner.plan_query(500, cal, expected_matches=5,
+                                          budget=100, psi_buckets=4)
+        self.assertLess(parallel['psi_cost'], sharded['psi_cost'])
+        # PSI needs more than one session
+        plan = planner.plan_query(1500, cal, expected_matches=5, budget=100)
+        self.assertEqual(2, plan['psi_sessions'])
+        self.assertEqual('bloom', plan['mode'])
+        # Too expensive
+        plan = planner.plan_query(10 ** 6, cal, budget=100)
+        self.assertIsNone(plan['mode'])
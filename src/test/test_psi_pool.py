@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""Test of the pre-initialized PSI sender pool.
+
+Copyright (c) 2020.
+Author: Erik Buchholz
+Maintainer: Erik Buchholz
+E-mail: buchholz@comsys.rwth-aachen.de
+"""
+import json
+import os
+import shutil
+import time
+from unittest import TestCase
+from unittest.mock import patch
+
+from lib import config, psi_pool
+from lib.psi_pool import PSISenderPool, get_psi_pool, PoolSessions
+from lib.psi_set import PSIServerSet
+from lib.record import ints_to_wide_indices
+from lib.storage_server_backend import StorageServer
+
+test_dir = config.DATA_DIR + "test/"
+
+
+def offer_psi(self, **kwargs):
+    """Record the arguments of the PSI instead of performing it."""
+    time.sleep(5 if kwargs.get('bucket') == 98 else 0.5)
+    with open(test_dir + f"psi_{kwargs['port']}.json", 'a') as fd:
+        fd.write(json.dumps(kwargs) + '\n')
+    if kwargs.get('bucket') == 99:
+        raise RuntimeError("PSI failed.")
+
+
+def wait_idle(pool: PSISenderPool, n: int) -> None:
+    """Wait until n senders are idle."""
+    for _ in range(100):
+        with pool._lock:
+            pool._update()
+        if pool.stats()['idle'] == n:
+            return
+        time.sleep(0.05)
+    raise TimeoutError("Senders did not become idle.")
+
+
+@patch("lib.config.PSI_SETSIZE", 10)
+@patch.object(StorageServer, "offer_psi", offer_psi)
+class TestPSISenderPool(TestCase):
+
+    def setUp(self) -> None:
+        """Create test directory and PSI set."""
+        shutil.rmtree(test_dir, ignore_errors=True)
+        os.makedirs(test_dir)
+        PSIServerSet(test_dir + config.PSI_SET_FILE).rebuild(
+            ints_to_wide_indices([1, 2, 3]))
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        """Remove test directory."""
+        shutil.rmtree(test_dir, ignore_errors=True)
+
+    def test_acquire(self):
+        pool = PSISenderPool(test_dir, 2)
+        try:
+            self.assertEqual(2, len(pool))
+            self.assertEqual(2, len(set(pool.ports)))
+            wait_idle(pool, 2)
+            sessions = [pool.acquire(clientSetSize=8, buckets=1,
+                                     bucket=None) for _ in range(2)]
+            ports = [port for port, _ in sessions]
+            self.assertEqual(sorted(pool.ports), sorted(ports))
+            self.assertEqual(('STARTED', None), pool.state(sessions[0][1]))
+            # All senders busy
+            self.assertIsNone(pool.acquire(clientSetSize=8))
+            wait_idle(pool, 2)
+            for _, session_id in sessions:
+                self.assertEqual(('SUCCESS', None), pool.state(session_id))
+            self.assertEqual(('PENDING', None), pool.state("unknown"))
+            stats = pool.stats()
+            self.assertEqual(2, stats['sessions'])
+            self.assertEqual(1, stats['fallbacks'])
+            self.assertEqual(0, stats['failures'])
+            for port in ports:
+                with open(test_dir + f"psi_{port}.json") as fd:
+                    self.assertEqual(
+                        {'port': port, 'clientSetSize': 8, 'buckets': 1,
+                         'bucket': None},
+                        json.loads(fd.read()))
+            # Failed sessions are counted
+            _, session_id = pool.acquire(bucket=99)
+            wait_idle(pool, 2)
+            self.assertEqual(1, pool.stats()['failures'])
+            self.assertEqual(('FAILURE', "RuntimeError: PSI failed."),
+                             pool.state(session_id))
+            # Dead senders are replaced
+            pool._workers[0][0].terminate()
+            pool._workers[0][0].join()
+            wait_idle(pool, 2)
+            self.assertEqual(2, len(pool))
+        finally:
+            pool.close()
+        self.assertEqual(0, len(pool))
+
+    def test_kill(self):
+        pool = PSISenderPool(test_dir, 1)
+        try:
+            wait_idle(pool, 1)
+            port, session_id = pool.acquire(bucket=98)
+            self.assertFalse(pool.kill("unknown"))
+            self.assertTrue(pool.kill(session_id))
+            self.assertFalse(pool.kill(session_id))
+            self.assertEqual('REVOKED', pool.state(session_id)[0])
+            self.assertEqual(0, pool.stats()['failures'])
+            # The sender is restarted without finishing the session
+            wait_idle(pool, 1)
+            self.assertFalse(os.path.exists(test_dir + f"psi_{port}.json"))
+            # Sessions running too long are killed
+            _, session_id = pool.acquire(bucket=98)
+            with patch("lib.config.PSI_POOL_SESSION_TIMEOUT", 0.2):
+                time.sleep(0.3)
+                self.assertEqual(
+                    ('FAILURE', "Session timed out."), pool.state(session_id))
+            self.assertEqual(1, pool.stats()['failures'])
+            wait_idle(pool, 1)
+            self.assertFalse(os.path.exists(test_dir + f"psi_{port}.json"))
+        finally:
+            pool.close()
+
+    @patch("lib.config.PSI_POOL_SIZE", 1)
+    def test_get_psi_pool(self):
+        pool = get_psi_pool(test_dir)
+        try:
+            self.assertEqual(1, len(pool))
+            self.assertIs(pool, get_psi_pool(test_dir))
+            # Sessions are accessed like celery tasks
+            wait_idle(pool, 1)
+            _, session_id = pool.acquire(bucket=98)
+            task = PoolSessions.AsyncResult(session_id)
+            self.assertEqual(session_id, task.id)
+            self.assertEqual('STARTED', task.state)
+            task.revoke(terminate=True, signal='SIGKILL')
+            self.assertEqual('REVOKED',
+                             PoolSessions.AsyncResult(session_id).state)
+        finally:
+            pool.close()
+            psi_pool._pool = None
+        # No pool in this process
+        self.assertEqual('PENDING', PoolSessions.AsyncResult("a").state)
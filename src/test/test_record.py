@@ -6,11 +6,22 @@ Author: Erik Buchholz
 Maintainer: Erik Buchholz
 E-mail: buchholz@comsys.rwth-aachen.de
 """
+import json
+import random
+import tempfile
 from unittest import TestCase
 from unittest.mock import patch
 
-from lib.helpers import from_base64
-from lib.record import Record, hash_to_index, round_s, get_power
+import numpy as np
+
+from lib.helpers import from_base64, to_base64
+from lib.record import (Record, RecordBatch, hash_to_index, round_s,
+                        get_power, hashes_to_indices, round_array,
+                        round_record, round_records, pack_ciphertext,
+                        unpack_ciphertext, json_to_binary_ciphertext,
+                        batch_get_upload_format, batch_from_ciphertext,
+                        RecordTable, hashes_to_wide_indices,
+                        wide_indices_to_ints, ints_to_wide_indices)
 
 rounding = 3
 id_len = 3
@@ -133,6 +144,60 @@ class TestRecord(TestCase):
     def test_from_ciphertext(self):
         r = Record.from_ciphertext(self.ciphertext, self.encryption_key)
         self.assertEqual(r.record, self.record)
+        # Stored string forms
+        r = Record.from_ciphertext(json.dumps(self.ciphertext),
+                                   self.encryption_key)
+        self.assertEqual(r.record, self.record)
+        binary = json_to_binary_ciphertext(json.dumps(self.ciphertext))
+        with self.assertRaises(ValueError):
+            # Long hash required
+            Record.from_ciphertext(binary, self.encryption_key)
+        for c in [binary, from_base64(binary)]:
+            r = Record.from_ciphertext(c, self.encryption_key, self.longhash)
+            self.assertEqual(r.record, self.record)
+        with self.assertRaises(ValueError):
+            # Wrong hash
+            Record.from_ciphertext(binary, self.encryption_key, b"0" * 64)
+
+    def test_get_encrypted_bytes(self):
+        self.r._hash_key = self.hash_key
+        nonce = from_base64(self.ciphertext['nonce'])
+        res = self.r.get_encrypted_bytes(self.encryption_key, nonce=nonce)
+        self.assertEqual(
+            json_to_binary_ciphertext(json.dumps(self.ciphertext)),
+            to_base64(res))
+        # Smaller than the JSON representation
+        self.assertLess(len(to_base64(res)), len(json.dumps(self.ciphertext)))
+        with self.assertRaises(ValueError):
+            self.r.get_encrypted_bytes(self.encryption_key, nonce=b'0')
+
+    def test_pack_ciphertext(self):
+        c = pack_ciphertext(b"n" * 16, 2, b"c" * 16, b"m" * 16)
+        self.assertEqual((b"n" * 16, 2, b"c" * 16, b"m" * 16),
+                         unpack_ciphertext(c))
+        with self.assertRaises(ValueError):
+            unpack_ciphertext(c[:20])
+        with self.assertRaises(ValueError):
+            # Bad version
+            unpack_ciphertext(b"\x00" + c[1:])
+        with self.assertRaises(ValueError):
+            # Bad length
+            unpack_ciphertext(c[:-17] + c[-16:])
+
+    def test_get_upload_format(self):
+        self.r._hash_key = self.hash_key
+        self.r.owner = self.owner
+        self.r.set_encryption_key(self.encryption_key)
+        with patch("lib.config.BINARY_CIPHERTEXT", True):
+            h, c, o = self.r.get_upload_format()
+        self.assertEqual(to_base64(self.longhash), h)
+        self.assertEqual(self.owner, o)
+        r = Record.from_ciphertext(c, self.encryption_key, self.longhash)
+        self.assertEqual(self.record, r.record)
+        with patch("lib.config.BINARY_CIPHERTEXT", False):
+            h, c, o = self.r.get_upload_format()
+        r = Record.from_ciphertext(json.loads(c), self.encryption_key)
+        self.assertEqual(self.record, r.record)
 
     def test_str(self):
         self.assertEqual(
@@ -230,3 +295,252 @@ class TestRecord(TestCase):
     def test_get_power(self):
         with self.assertRaises(ValueError):
             get_power(0)
+
+    def test_round_array(self):
+        with self.assertRaises(ValueError):
+            round_array([1.0], -1)
+        random.seed(42)
+        values = [random.choice([-1, 1]) * 10 ** random.uniform(-25, 25)
+                  for _ in range(5000)]
+        for k in range(-25, 25):
+            # Powers of ten and their direct neighbours
+            p = 10 ** k if k < 0 else float(10 ** k)
+            values.extend([p, -p, np.nextafter(p, 0), np.nextafter(p, 2 * p)])
+        # Ties and values close to ties
+        values.extend([i / 8 for i in range(1, 500)])
+        values.extend([i * 0.005 for i in range(1, 500)])
+        values.extend([0.0, -0.0, 2.675, 0.00111999, 1e-299, 1e30])
+        values = np.array(values)
+        for rnd in range(0, 18):
+            expected = np.array([round_s(float(v), rnd) for v in values])
+            # Compare bit patterns to also capture signed zeros
+            self.assertEqual(
+                expected.view(np.uint64).tolist(),
+                round_array(values, rnd).view(np.uint64).tolist()
+            )
+
+    @patch("lib.config.RECORD_ID_LENGTH", id_len)
+    def test_round_records(self):
+        random.seed(42)
+        vectors = [[random.uniform(-1000, 1000) for _ in range(5)]
+                   for _ in range(100)]
+        rnd_vec = [0, 3, 7]
+        self.assertEqual(
+            [round_record(v, rnd_vec, id_len) for v in vectors],
+            round_records(np.array(vectors), rnd_vec, id_len).tolist()
+        )
+
+
+@patch("lib.config.RECORD_ID_LENGTH", id_len)
+@patch("lib.config.RECORD_LENGTH", 5)
+@patch("lib.config.ROUNDING_VEC", [rounding for _ in range(id_len)])
+class TestRecordBatch(TestCase):
+    hash_key = b"abcde"
+
+    @patch("lib.config.RECORD_LENGTH", 5)
+    @patch("lib.config.RECORD_ID_LENGTH", id_len)
+    @patch("lib.config.ROUNDING_VEC", [rounding for _ in range(id_len)])
+    def setUp(self) -> None:
+        """Create random vectors and the corresponding records."""
+        random.seed(42)
+        self.vectors = [
+            [random.uniform(-1000, 1000) for _ in range(5)]
+            for _ in range(50)
+        ]
+        self.vectors.append([1.1, 22.22, 333.333, 4444.4444, 55555.55555])
+        self.vectors.append([0, 1, 2, 3, 4])
+        self.records = [Record(v, hash_key=self.hash_key)
+                        for v in self.vectors]
+
+    def test_init(self):
+        b = RecordBatch(self.vectors, self.hash_key)
+        self.assertEqual(len(self.vectors), len(b))
+        self.assertEqual((len(self.vectors), 5), b.vectors.shape)
+        self.assertEqual(0, len(RecordBatch([], self.hash_key)))
+        with self.assertRaises(TypeError):
+            RecordBatch([["test", 1, 2, 3, 4]])
+        with self.assertRaises(ValueError):
+            # Bad record length
+            RecordBatch([[1, 2, 3]])
+
+    def test_get_long_hashes(self):
+        with self.assertRaises(ValueError):
+            RecordBatch(self.vectors).get_long_hashes()
+        b = RecordBatch(self.vectors, self.hash_key)
+        hashes = b.get_long_hashes()
+        self.assertEqual((len(self.vectors), 64), hashes.shape)
+        for i, r in enumerate(self.records):
+            self.assertEqual(r.get_long_hash(), hashes[i].tobytes())
+            self.assertEqual(r.get_long_hash(), b.get_long_hash(i))
+
+    def test_identifiers(self):
+        b = RecordBatch(self.vectors, self.hash_key)
+        self.assertEqual([r._get_identifier() for r in self.records],
+                         b.get_identifiers())
+
+    @patch("lib.config.PSI_INDEX_LEN", 127)
+    def test_indices(self):
+        b = RecordBatch(np.array(self.vectors), self.hash_key)
+        self.assertEqual([r.get_psi_index() for r in self.records],
+                         b.get_psi_indices())
+        self.assertEqual(b.get_psi_indices(),
+                         wide_indices_to_ints(b.get_wide_psi_indices()))
+        self.assertEqual([r.get_ot_index() for r in self.records],
+                         b.get_ot_indices().tolist())
+
+    def test_set_hash_key(self):
+        b = RecordBatch(self.vectors, b"other")
+        first = b.get_long_hash(0)
+        b.set_hash_key(self.hash_key)
+        self.assertNotEqual(first, b.get_long_hash(0))
+        self.assertEqual(self.records[0].get_long_hash(), b.get_long_hash(0))
+
+    def test_get_record(self):
+        b = RecordBatch(self.vectors, self.hash_key)
+        for i, r in enumerate(self.records):
+            res = b.get_record(i)
+            self.assertEqual(r, res)
+            self.assertEqual(r.get_long_hash(), res.get_long_hash())
+
+    @patch("lib.config.CRYPTO_CHUNK_SIZE", 7)
+    def test_batch_crypto(self):
+        keys = [b"0123456789abcdef", b"fedcba9876543210", b"abcdefghijklmnop"]
+        for r in self.records:
+            r.owner = "owner"
+            r.set_encryption_key(random.choice(keys))
+        for parallel in [True, False]:
+            for binary in [True, False]:
+                with patch("lib.config.PARALLEL", parallel), \
+                        patch("lib.config.BINARY_CIPHERTEXT", binary):
+                    res = batch_get_upload_format(self.records)
+                self.assertEqual(len(self.records), len(res))
+                for r, (h, c, o) in zip(self.records, res):
+                    self.assertEqual(r.get_long_hash(), from_base64(h))
+                    self.assertEqual("owner", o)
+                    self.assertEqual(r, Record.from_ciphertext(
+                        c, r._encryption_key, r.get_long_hash()))
+                with patch("lib.config.PARALLEL", parallel):
+                    dec = batch_from_ciphertext(
+                        [(h, c) for h, c, _ in res],
+                        [r._encryption_key for r in self.records])
+                self.assertEqual([r.record for r in self.records],
+                                 [list(r.record) for r in dec])
+        with self.assertRaises(ValueError):
+            batch_from_ciphertext([(h, c) for h, c, _ in res], keys[:1])
+        self.records[0]._encryption_key = None
+        with self.assertRaises(ValueError):
+            batch_get_upload_format(self.records)
+
+    def test_hashes_to_indices(self):
+        hashes = np.frombuffer(
+            bytes.fromhex("ffffffffffffffff") + bytes.fromhex(
+                "c4dff7abcdef0000"), dtype=np.uint8).reshape(2, 8)
+        for bits in [11, 21, 32, 64]:
+            self.assertEqual(
+                [hash_to_index(h.tobytes(), bits) for h in hashes],
+                hashes_to_indices(hashes, bits).tolist()
+            )
+        with self.assertRaises(ValueError):
+            hashes_to_indices(hashes, 65)
+
+    def test_hashes_to_wide_indices(self):
+        hashes = np.random.randint(0, 256, (20, 64), dtype=np.uint8)
+        for bits in [32, 64, 65, 127, 128]:
+            ints = [hash_to_index(h.tobytes(), bits) for h in hashes]
+            wide = hashes_to_wide_indices(hashes, bits)
+            self.assertEqual(ints, wide_indices_to_ints(wide))
+            self.assertEqual(ints, wide_indices_to_ints(
+                ints_to_wide_indices(ints)))
+            # Arrays sort like the ints
+            self.assertEqual(sorted(ints),
+                             wide_indices_to_ints(np.sort(wide)))
+        with self.assertRaises(ValueError):
+            hashes_to_wide_indices(hashes, 129)
+
+
+@patch("lib.config.RECORD_ID_LENGTH", id_len)
+@patch("lib.config.RECORD_LENGTH", 5)
+@patch("lib.config.ROUNDING_VEC", [rounding for _ in range(id_len)])
+class TestRecordTable(TestCase):
+    hash_key = b"abcde"
+    vectors = [[1.1, 22.22, 333.333, 4444.4444, 55555.55555],
+               [0, 1, 2, 3, 4],
+               [-5.5, 4, 3, 2, 1]]
+
+    @patch("lib.config.RECORD_LENGTH", 5)
+    @patch("lib.config.RECORD_ID_LENGTH", id_len)
+    @patch("lib.config.ROUNDING_VEC", [rounding for _ in range(id_len)])
+    def setUp(self) -> None:
+        """Create table and the corresponding records."""
+        self.table = RecordTable(self.vectors, self.hash_key, owner="owner")
+        self.records = [Record(v, hash_key=self.hash_key, owner="owner")
+                        for v in self.vectors]
+
+    def test_from_file(self):
+        with tempfile.NamedTemporaryFile() as fd:
+            for v in self.vectors:
+                fd.write(f"{v}\n".encode())
+            fd.write(b"\n")
+            fd.flush()
+            with patch("lib.config.HASH_BATCH_SIZE", 2):
+                t = RecordTable.from_file(fd.name)
+        self.assertEqual(self.vectors, t.vectors.tolist())
+        self.assertEqual(np.float64, t.vectors.dtype)
+        with tempfile.NamedTemporaryFile() as fd:
+            self.assertEqual(0, len(RecordTable.from_file(fd.name)))
+        with tempfile.NamedTemporaryFile(suffix=".npy") as fd:
+            np.save(fd.name, np.array(self.vectors))
+            t = RecordTable.from_file(fd.name)
+            self.assertEqual(self.vectors, t.vectors.tolist())
+            self.assertEqual(
+                [[self.vectors[:2]], [self.vectors[2:]]],
+                [[c.vectors.tolist()] for c in
+                 RecordTable.iter_file(fd.name, 2)])
+
+    def test_iter_file(self):
+        with tempfile.NamedTemporaryFile() as fd:
+            for v in self.vectors:
+                fd.write(f"{v}\n".encode())
+            fd.flush()
+            chunks = list(RecordTable.iter_file(fd.name, 2, owner="o"))
+        self.assertEqual([2, 1], [len(c) for c in chunks])
+        self.assertEqual("o", chunks[0].owner)
+        self.assertEqual(self.vectors,
+                         [v for c in chunks for v in c.vectors.tolist()])
+
+    def test_views(self):
+        self.assertEqual(self.records, list(self.table))
+        self.assertEqual(self.records[-1], self.table[-1])
+        self.assertTrue(self.records[0] == self.table[0])
+        self.assertTrue(self.table[0] != self.table[1])
+        with self.assertRaises(IndexError):
+            _ = self.table[3]
+        with self.assertRaises(AttributeError):
+            # No per-row attribute dict
+            self.table[0].foo = 1
+        for r, v in zip(self.records, self.table):
+            self.assertEqual(r.get_long_hash(), v.get_long_hash())
+            self.assertEqual(r.get_psi_index(), v.get_psi_index())
+            self.assertEqual(r.get_ot_index(), v.get_ot_index())
+            self.assertEqual(str(r), str(v))
+        self.table.owner = None
+        with self.assertRaises(RuntimeError):
+            self.table[0].get_owner()
+
+    def test_get_upload_format(self):
+        with self.assertRaises(ValueError):
+            self.table.get_upload_format()
+        keys = [b"0123456789abcdef", b"fedcba9876543210", b"0123456789abcdef"]
+        with self.assertRaises(ValueError):
+            self.table.set_encryption_keys(keys[:2])
+        self.table.set_encryption_keys(keys)
+        res = self.table.get_upload_format()
+        for r, k, (h, c, o) in zip(self.records, keys, res):
+            self.assertEqual(r.get_long_hash(), from_base64(h))
+            self.assertEqual("owner", o)
+            self.assertEqual(r, Record.from_ciphertext(
+                c, k, r.get_long_hash()))
+        h, c, o = self.table[1].get_upload_format()
+        self.assertEqual(self.records[1], Record.from_ciphertext(
+            c, keys[1], self.records[1].get_long_hash()))
+        self.assertEqual(keys[2], self.table.get_encryption_key(2))
@@ -7,6 +7,7 @@ Maintainer: Erik Buchholz
 E-mail: buchholz@comsys.rwth-aachen.de
 """
 import copy
+import pickle
 import unittest
 from unittest import TestCase
 from unittest.mock import patch
@@ -36,6 +37,18 @@ class SimilarityMetricsTest(unittest.TestCase):
         self.assertEqual(sm.RelativeOffsetIterator, func)
         self.assertEqual(
             (0.5,), args)
+        func, args = sm.map_metric("l2-5")
+        self.assertEqual(sm.L2BallIterator, func)
+        self.assertEqual((5,), args)
+        func, args = sm.map_metric("l2-2.5")
+        self.assertEqual(sm.L2BallIterator, func)
+        self.assertEqual((2.5,), args)
+        func, args = sm.map_metric("maxdev-3-10")
+        self.assertEqual(sm.MaxDeviationIterator, func)
+        self.assertEqual((3, 10), args)
+        func, args = sm.map_metric("maxdev-3-0.5")
+        self.assertEqual(sm.MaxDeviationIterator, func)
+        self.assertEqual((3, 0.5), args)
         func, args = sm.map_metric("wzl1")
         self.assertEqual(sm.VariableOffsetIterator, func)
         offsets = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1000, 0, 0]
@@ -94,30 +107,115 @@ class SimilarityMetricsTest(unittest.TestCase):
         it = sm.RelativeOffsetIterator(r, 2, rounding_vec=[3, 3],
                                        record_id_length=2)
         its = it.split(5)
-        self.assertGreaterEqual(len(its), 5)
+        self.assertEqual(5, len(its))
         l2 = []
         for it in its:
             l2.extend([str(i) for i in it])
-        self.assertEqual(sorted(l1), sorted(l2))
+        self.assertEqual(l1, l2)
         it = sm.RelativeOffsetIterator(r, 2, rounding_vec=[3, 3],
                                        record_id_length=2)
         its = it.split(5)
-        for i in its:
-            length = len(list(i))
-            self.assertIn(length, [9, 18])
-        # split on second
+        # 81 candidates
+        self.assertEqual([17, 16, 16, 16, 16], [len(list(i)) for i in its])
+        self.assertEqual([17, 16, 16, 16, 16], [len(i) for i in its])
+        # More parts than elements
         it = sm.AbsoluteOffsetIterator(r, 0.5, rounding_vec=[2, 2],
                                        record_id_length=2)
         it2 = copy.deepcopy(it)
         l1 = [i for i in it2]
-        its = it.split(5)
-        self.assertEqual(4,
-                         len(its))
+        its = it.split(len(l1) + 3)
+        self.assertEqual(len(l1), len(its))
         l2 = []
         for it in its:
             l2.extend([i for i in it])
         self.assertEqual(l1,
                          l2)
+        # Pickle
+        it = sm.RelativeOffsetIterator(r, 2, rounding_vec=[3, 3],
+                                       record_id_length=2)
+        l1 = list(copy.deepcopy(it))
+        its = [pickle.loads(pickle.dumps(i)) for i in it.split(3)]
+        self.assertEqual(l1, [c for i in its for c in i])
+
+    def test_random_access(self):
+        r = [2.0, 2.0, 3.0, 4.0]
+        it = sm.RelativeOffsetIterator(r, 5, rounding_vec=[3, 3],
+                                       record_id_length=2)
+        expected = list(copy.deepcopy(it))
+        self.assertEqual(expected, [it[i] for i in range(len(it))])
+        self.assertEqual(expected, [it.unrank(i) for i in range(len(it))])
+        self.assertEqual(expected[-1], it[-1])
+        with self.assertRaises(IndexError):
+            it[len(it)]
+        s = it[100:200]
+        self.assertEqual(100, len(s))
+        self.assertEqual(expected[100:200], list(s))
+        # Relative to the slice
+        s = it[100:200]
+        self.assertEqual(expected[110], s[10])
+        self.assertEqual(expected[110:120], list(s[10:20]))
+        self.assertEqual([], list(it[300:100]))
+        with self.assertRaises(ValueError):
+            it[::2]
+        # Original unaffected
+        self.assertEqual(expected, list(it))
+
+    def test_blocks(self):
+        r = [2.0, 2.0, 3.0, 4.0]
+        it = sm.RelativeOffsetIterator(r, 5, rounding_vec=[3, 3],
+                                       record_id_length=2)
+        expected = list(copy.deepcopy(it))
+        blocks = list(it.iter_blocks(100))
+        self.assertEqual([100, 100, 100, 100, 41], [len(b) for b in blocks])
+        self.assertEqual((100, 4), blocks[0].shape)
+        self.assertEqual(expected,
+                         [tuple(row) for b in blocks for row in b.tolist()])
+        self.assertEqual((0, 4), it.next_block(10).shape)
+        # Mixed with next
+        it = sm.RelativeOffsetIterator(r, 5, rounding_vec=[3, 3],
+                                       record_id_length=2)
+        self.assertEqual(expected[0], next(it))
+        self.assertEqual(expected[1:21],
+                         [tuple(row) for row in it.next_block(20).tolist()])
+        self.assertEqual(expected[21], next(it))
+        # Slice
+        b = it[400:500].next_block(100)
+        self.assertEqual(expected[400:],
+                         [tuple(row) for row in b.tolist()])
+        # Ranks beyond 64 bit
+        r = [float(i) for i in range(1, 21)]
+        it = sm.RelativeOffsetIterator(r, 5, [3 for _ in range(20)], 20)
+        self.assertGreater(it.size, 2 ** 64)
+        self.assertEqual(it.size, sm.comp_offset_num(it))
+        part = it[-1000:]
+        b = part.next_block(1000)
+        self.assertEqual([it[-1000 + i] for i in range(1000)],
+                         [tuple(row) for row in b.tolist()])
+
+    def test_rings(self):
+        r = [2.0, 2.0, 3.0, 4.0]
+        it = sm.AbsoluteOffsetIterator(r, 0.05, rounding_vec=[3, 3],
+                                       record_id_length=2)
+        expected = list(copy.deepcopy(it))
+        blocks = list(it.iter_rings(4))
+        self.assertTrue(all(len(b) <= 4 for b in blocks))
+        res = [tuple(row) for b in blocks for row in b.tolist()]
+        self.assertEqual(sorted(expected), sorted(res))
+        self.assertEqual((2.0, 2.0, 3.0, 4.0), res[0])
+        # Rings: Maximal distance in grid steps is non-decreasing
+        dist = [round(max(abs(c[0] - 2), abs(c[1] - 2)) * 100) for c in res]
+        self.assertEqual(sorted(dist), dist)
+        self.assertEqual([0] + 8 * [1], dist[:9])
+        # Target at the border of the range
+        it = sm.VariableOffsetIterator(r, [5, 5], True, [3, 3], 2)
+        res = [tuple(row) for b in it.iter_rings() for row in b.tolist()]
+        self.assertEqual(sorted(list(copy.deepcopy(it))), sorted(res))
+        self.assertEqual((2.0, 2.0, 3.0, 4.0), res[0])
+        next(it)
+        with self.assertRaises(RuntimeError):
+            list(it.iter_rings())
+        with self.assertRaises(RuntimeError):
+            list(it[1:].iter_rings())
 
     def test_repr(self):
         r = [100.0, 1.0, 3.0, 4.0]
@@ -138,6 +236,34 @@ class SimilarityMetricsTest(unittest.TestCase):
             res
         )
 
+    @patch("lib.config.RECORD_LENGTH", 4)
+    @patch("lib.config.RECORD_ID_LENGTH", 2)
+    @patch("lib.config.ROUNDING_VEC", [3, 3])
+    def test_record_iterator_batches(self):
+        r = [100.0, 1.0, 3.0, 4.0]
+        m = sm.RelativeOffsetIterator(r, 5, rounding_vec=[3, 3],
+                                      record_id_length=2)
+        expected = [Record(v, hash_key=b"key") for v in copy.deepcopy(m)]
+        it = sm.RecordIterator(m, b"key")
+        batches = list(it.iter_batches(1000))
+        self.assertEqual([1000, 1000, 1000, 136],
+                         [len(b) for b in batches])
+        res = [b.get_long_hash(i) for b in batches for i in range(len(b))]
+        self.assertEqual([r.get_long_hash() for r in expected], res)
+        self.assertEqual([], list(it.iter_batches(1000)))
+        # Best-first order is only defined for offset and grid metrics
+        it = sm.RecordIterator(copy.deepcopy(expected), b"key")
+        self.assertFalse(it.supports_best_first)
+        with self.assertRaises(ValueError):
+            list(it.iter_batches(1000, best_first=True))
+        it = sm.RecordIterator(sm.L2BallIterator(r, 5, None, [3, 3], 2),
+                               b"key")
+        self.assertTrue(it.supports_best_first)
+        batches = list(it.iter_batches(10, best_first=True))
+        self.assertTrue(all(len(b) <= 10 for b in batches))
+        self.assertEqual(Record(r, hash_key=b"key").get_long_hash(),
+                         batches[0].get_long_hash(0))
+
     @patch("lib.config.RECORD_LENGTH", 4)
     def test_record_iterator_len(self):
         r = [100.0, 1.0, 3.0, 4.0]
@@ -206,6 +332,27 @@ class SimilarityMetricsTest(unittest.TestCase):
             len(it)
         )
 
+    def test_axes(self):
+        # Power hop: increment changes from 0.01 to 0.1 at 10
+        r = [9.98, 100.0, 3.0]
+        it = sm.AbsoluteOffsetIterator(r, 0.3, rounding_vec=[3, 3],
+                                       record_id_length=2)
+        self.assertEqual([9.68, 9.69] + [round(9.7 + i * 0.01, 2)
+                                         for i in range(30)] + [10.0, 10.1,
+                                                                10.2, 10.3],
+                         it.axes[0])
+        self.assertEqual([99.7, 99.8, 99.9, 100.0], it.axes[1])
+        self.assertEqual(36 * 4, len(it))
+        res = list(it)
+        self.assertEqual(len(it), len(res))
+        self.assertEqual((9.68, 99.7, 3.0), res[0])
+        self.assertEqual((9.68, 99.8, 3.0), res[1])
+        self.assertEqual((10.3, 100.0, 3.0), res[-1])
+        # Only the target if the rounded range is too small
+        it = sm.RelativeOffsetIterator([99.0], 1, rounding_vec=[1],
+                                       record_id_length=1)
+        self.assertEqual([(99.0,)], list(it))
+
     def test_compute_increment(self):
         self.assertEqual(
             0.1,
@@ -344,3 +491,145 @@ class TestVariableOffsetIterator(TestCase):
                 },
                 set(it)
             )
+
+
+class TestGridRegionIterator(TestCase):
+    target = [2.0, 3.0, 5.0, 7.0, 1.0]
+    box = list(sm.RelativeOffsetIterator(target, 2, [3, 3, 3], 3))
+
+    def test_l2(self):
+        it = sm.L2BallIterator(self.target, 2, None, [3, 3, 3], 3)
+        expected = {
+            c for c in self.box
+            if sum(((c[i] - self.target[i]) / (self.target[i] * 0.02)) ** 2
+                   for i in range(3)) <= 1 + 1e-9  # Float imprecision
+        }
+        res = list(copy.deepcopy(it))
+        self.assertEqual(len(expected), len(res))
+        self.assertEqual(expected, set(res))
+        self.assertEqual(len(res), len(it))
+        self.assertEqual((2.0, 3.0, 5.0, 7.0, 1.0), res[0])
+        # Weighted: Deviation of the first position is halved
+        it = sm.L2BallIterator(self.target, 2, [2, 1, 1], [3, 3, 3], 3)
+        res = set(it)
+        self.assertTrue(res < expected)
+        self.assertIn((2.02, 3.0, 5.0, 7.0, 1.0), res)
+        self.assertNotIn((2.03, 3.0, 5.0, 7.0, 1.0), res)
+        with self.assertRaises(ValueError):
+            sm.L2BallIterator(self.target, 2, [1, 1], [3, 3, 3], 3)
+
+    def test_maxdev(self):
+        for k in range(4):
+            it = sm.MaxDeviationIterator(self.target, k, 2, [3, 3, 3], 3)
+            expected = {
+                c for c in self.box
+                if sum(c[i] != self.target[i] for i in range(3)) <= k
+            }
+            self.assertEqual(len(expected), len(it))
+            self.assertEqual(expected, set(it))
+        self.assertEqual(set(self.box), expected)
+        # Large: 3 of 21 positions may deviate by 10 %
+        target = [float(i) for i in range(1, 22)]
+        it = sm.MaxDeviationIterator(target, 3, 10, [3 for _ in target], 21)
+        box = sm.RelativeOffsetIterator(target, 10, [3 for _ in target], 21)
+        self.assertLess(it.size * 10 ** 20, box.size)
+
+    def test_rings(self):
+        for it in (sm.L2BallIterator(self.target, 2, [2, 1, 1], [3, 3, 3], 3),
+                   sm.MaxDeviationIterator(self.target, 2, 2, [3, 3, 3], 3)):
+            expected = list(copy.deepcopy(it))
+            blocks = list(it.iter_rings(4))
+            self.assertTrue(all(len(b) <= 4 for b in blocks))
+            res = [tuple(row) for b in blocks for row in b.tolist()]
+            self.assertEqual(sorted(expected), sorted(res))
+            self.assertEqual(tuple(self.target), res[0])
+            # Rings: Maximal distance in grid steps is non-decreasing
+            dist = [max(round(abs(c[i] - self.target[i]) * 100)
+                        for i in range(3)) for c in res]
+            self.assertEqual(sorted(dist), dist)
+            # Blocks never span two rings
+            for b in blocks:
+                self.assertEqual(1, len({max(
+                    round(abs(row[i] - self.target[i]) * 100)
+                    for i in range(3)) for row in b.tolist()}))
+            next(it)
+            with self.assertRaises(RuntimeError):
+                list(it.iter_rings())
+            with self.assertRaises(RuntimeError):
+                list(it[1:].iter_rings())
+
+    def test_random_access(self):
+        it = sm.L2BallIterator(self.target, 2, None, [3, 3, 3], 3)
+        expected = list(copy.deepcopy(it))
+        self.assertEqual(expected, [it[i] for i in range(len(it))])
+        self.assertEqual(expected[-1], it[-1])
+        with self.assertRaises(IndexError):
+            it[len(it)]
+        self.assertEqual(expected[100:200], list(it[100:200]))
+        self.assertEqual(expected[110:120], list(it[100:200][10:20]))
+        its = it.split(7)
+        self.assertEqual(7, len(its))
+        self.assertLessEqual(max(len(i) for i in its) -
+                             min(len(i) for i in its), 1)
+        self.assertEqual(expected, [c for i in its for c in i])
+        with self.assertRaises(RuntimeError):
+            its[0].split(2)
+        its = [pickle.loads(pickle.dumps(i)) for i in it.split(3)]
+        self.assertEqual(expected, [c for i in its for c in i])
+
+
+class TestOffsetDeltaIterator(TestCase):
+    old = sm.AbsoluteOffsetIterator([2.0, 3.0, 5.0, 7.0, 1.0], 0.05,
+                                    [3, 3, 3], 3)
+    new = sm.AbsoluteOffsetIterator([2.02, 3.0, 5.03, 7.0, 1.0], 0.05,
+                                    [3, 3, 3], 3)
+
+    def test_delta(self):
+        old = set(copy.deepcopy(self.old))
+        expected = set(copy.deepcopy(self.new)) - old
+        it = sm.OffsetDeltaIterator(self.new, self.old)
+        self.assertEqual(len(expected), it.size)
+        res = list(it)
+        self.assertEqual(len(expected), len(res))
+        self.assertEqual(expected, set(res))
+        # Blocks
+        it = sm.OffsetDeltaIterator(self.new, self.old)
+        blocks = list(it.iter_blocks(100))
+        self.assertEqual(res, [tuple(c) for b in blocks for c in b.tolist()])
+        # Identical and disjoint hypercubes
+        self.assertEqual([], list(sm.OffsetDeltaIterator(self.old,
+                                                         self.old)))
+        far = sm.AbsoluteOffsetIterator([3.0, 3.0, 5.0, 7.0, 1.0], 0.05,
+                                        [3, 3, 3], 3)
+        self.assertEqual(set(copy.deepcopy(far)),
+                         set(sm.OffsetDeltaIterator(far, self.old)))
+        with self.assertRaises(ValueError):
+            sm.OffsetDeltaIterator(
+                self.new, sm.AbsoluteOffsetIterator([2.0, 3.0], 0.05,
+                                                    [3, 3], 2))
+
+    def test_random_access(self):
+        it = sm.OffsetDeltaIterator(self.new, self.old)
+        expected = list(copy.deepcopy(it))
+        self.assertEqual(expected, [it[i] for i in range(len(it))])
+        self.assertEqual(expected[-1], it[-1])
+        with self.assertRaises(IndexError):
+            it[len(it)]
+        self.assertEqual(expected[100:300], list(it[100:300]))
+        its = it.split(4)
+        self.assertEqual([135, 135, 135, 134], [len(i) for i in its])
+        self.assertEqual(expected, [c for i in its for c in i])
+        next(it)
+        with self.assertRaises(RuntimeError):
+            it.split(2)
+        its = [pickle.loads(pickle.dumps(i)) for i in
+               sm.OffsetDeltaIterator(self.new, self.old).split(3)]
+        self.assertEqual(expected, [c for i in its for c in i])
+
+    def test_contains(self):
+        self.assertTrue(self.old.contains([2.0, 3.0, 5.0, 7.0, 1.0]))
+        self.assertTrue(self.old.contains([2.05, 2.95, 5.0]))
+        self.assertFalse(self.old.contains([2.06, 3.0, 5.0]))
+        self.assertTrue(self.new.contains([2.06, 3.0, 5.0]))
+        # Independent of the rank range
+        self.assertTrue(self.old[:1].contains([2.05, 3.05, 5.05]))
@@ -14,13 +14,14 @@ from datetime import datetime, timedelta
 from unittest import TestCase, skip
 from unittest.mock import patch, Mock
 
+import numpy as np
 from flask import g, current_app
 
 import storage_server
 from lib import config
 from lib.base_client import UserType
 from lib.database import Task
-from lib.helpers import generate_auth_header
+from lib.helpers import generate_auth_header, from_base64
 from storage_server import connector, client
 from storage_server.connector import TaskType
 
@@ -130,24 +131,25 @@ class StorageAppTest(TestCase):
             connector.get_storageserver_backend()
             self.assertTrue('storageserver' in g)
 
-    @patch.object(connector, "StorageServer")
+    @patch.object(connector, "get_storageserver_backend")
     @patch.object(connector, "insert_bloom")
     @patch.object(connector, "database")
     def test__batch_store_records(self, d, i, m):
         connector._batch_store_records([["test"]], self.user)
-        m.batch_store_records_db.assert_called_once_with(
+        m.return_value.batch_store_records_db.assert_called_once_with(
             [["test"]]
         )
         i.delay.assert_called_once_with([["test"]])
         d.add_task.assert_called_once()
 
     @skip("Slow b/c of celery and trivial.")
-    @patch("storage_server.connector.StorageServer")
+    @patch("storage_server.connector.get_storageserver_backend")
     def test_execute_psi(self, m):  # pragma no cover
         port = 50000
         with self.app.test_request_context('/'):
             connector.execute_psi.apply(args=(port,))
-        m.offer_psi.assert_called_once_with(port=port)
+        m.return_value.offer_psi.assert_called_once_with(
+            port=port, clientSetSize=None, buckets=1, bucket=None)
 
     @patch.object(connector.Tasks['PSI'], "AsyncResult")
     @patch("storage_server.connector.render_template", Mock())
@@ -250,6 +252,8 @@ class StorageAppTest(TestCase):
     def test_client_verify_token(self, m):
         # Mock bloom filter
         m.return_value.get_bloom_filter.return_value.decode.return_value = 1
+        m.return_value.get_bloom_version.return_value = 3
+        m.return_value.get_bloom_encoding.return_value = 'prefix'
 
         # No authentication info provided
         res = self.client.get('/client/bloom')
@@ -308,6 +312,8 @@ class StorageAppTest(TestCase):
     def test_client_get_bloom(self, m):
         # Mock bloom filter
         m.return_value.get_bloom_filter.return_value.decode.return_value = 1
+        m.return_value.get_bloom_version.return_value = 3
+        m.return_value.get_bloom_encoding.return_value = 'prefix'
 
         # Test authentication
         auth_head = self.auth_header_wrong_pw
@@ -320,8 +326,96 @@ class StorageAppTest(TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual({
             'success': True,
-            'bloom': 1
+            'bloom': 1,
+            'version': 3,
+            'encoding': 'prefix'
         }, res.json)
+        self.assertEqual('"3"', res.headers['ETag'])
+        # Conditional GET
+        res = self.client.get('/client/bloom',
+                              headers=auth_head + [('If-None-Match', '"3"')])
+        self.assertEqual(304, res.status_code)
+        self.assertEqual(b'', res.data)
+        res = self.client.get('/client/bloom',
+                              headers=auth_head + [('If-None-Match', '"2"')])
+        self.assertEqual(200, res.status_code)
+
+    @patch("storage_server.client.verify_token", mock_verify_token)
+    @patch("storage_server.client.get_storageserver_backend")
+    @patch("storage_server.client._track_bloom_access", Mock())
+    def test_client_get_bloom_file(self, m):
+        os.makedirs(test_dir, exist_ok=True)
+        path = test_dir + "bloom.zlib"
+        data = bytes(range(256)) * 4
+        with open(path, 'wb') as fd:
+            fd.write(data)
+        m.return_value.get_bloom_file.return_value = (path, 3)
+        m.return_value.get_bloom_encoding.return_value = 'prefix'
+        # Test authentication
+        res = self.client.get('/client/bloom_file',
+                              headers=self.auth_header_wrong_pw)
+        self.assertEqual(res.status_code, 401)
+        auth_head = self.auth_header
+        res = self.client.get('/client/bloom_file?compression=zlib',
+                              headers=auth_head)
+        m.return_value.get_bloom_file.assert_called_once_with('zlib')
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(data, res.data)
+        self.assertEqual('application/octet-stream', res.content_type)
+        self.assertEqual('3', res.headers['X-Bloom-Version'])
+        self.assertEqual('zlib', res.headers['X-Compression'])
+        self.assertEqual('prefix', res.headers['X-Bloom-Encoding'])
+        self.assertEqual('"3-zlib"', res.headers['ETag'])
+        # Resume interrupted download
+        res = self.client.get('/client/bloom_file?compression=zlib',
+                              headers=auth_head + [('Range', 'bytes=1000-')])
+        self.assertEqual(206, res.status_code)
+        self.assertEqual(data[1000:], res.data)
+        # Conditional GET
+        res = self.client.get('/client/bloom_file?compression=zlib',
+                              headers=auth_head + [('If-None-Match',
+                                                    '"3-zlib"')])
+        self.assertEqual(304, res.status_code)
+        # Error
+        m.return_value.get_bloom_file.side_effect = ValueError(
+            "Unknown compression: lzma")
+        res = self.client.get('/client/bloom_file?compression=lzma',
+                              headers=auth_head)
+        self.assertEqual({'success': False,
+                          'msg': "Unknown compression: lzma"}, res.json)
+
+    @patch("storage_server.client.verify_token", mock_verify_token)
+    @patch("storage_server.client.get_storageserver_backend")
+    @patch("storage_server.client._track_bloom_access", Mock())
+    def test_client_get_bloom_delta(self, m):
+        m.return_value.get_bloom_version.return_value = 3
+        m.return_value.get_bloom_encoding.return_value = 'digest'
+        m.return_value.get_bloom_delta.return_value = (
+            3, np.array([1, 5], dtype='<u8'), np.array([7, 8], dtype='<u8'))
+        auth_head = self.auth_header
+        res = self.client.get('/client/bloom_delta?since=2',
+                              headers=auth_head)
+        m.return_value.get_bloom_delta.assert_called_once_with(2)
+        self.assertEqual(True, res.json['success'])
+        self.assertEqual(False, res.json['full'])
+        self.assertEqual(3, res.json['version'])
+        self.assertEqual('digest', res.json['encoding'])
+        self.assertEqual(
+            [1, 5], np.frombuffer(from_base64(res.json['words']),
+                                  dtype='<u8').tolist())
+        self.assertEqual(
+            [7, 8], np.frombuffer(from_base64(res.json['values']),
+                                  dtype='<u8').tolist())
+        # Full transfer required
+        m.return_value.get_bloom_delta.return_value = None
+        res = self.client.get('/client/bloom_delta?since=0',
+                              headers=auth_head)
+        self.assertEqual({'success': True, 'full': True, 'version': 3},
+                         res.json)
+        # Missing version
+        res = self.client.get('/client/bloom_delta', headers=auth_head)
+        self.assertEqual(False, res.json['success'])
+        self.assertIn("No version", res.json['msg'])
 
     @patch("storage_server.client.verify_token", mock_verify_token)
     @patch("storage_server.client.StorageServer")
@@ -432,6 +526,74 @@ class StorageAppTest(TestCase):
             auth_head = self.auth_header
             res = self.client.get('/client/psi', headers=auth_head)
             self.assertEqual(res.status_code, 200)
+            self.assertEqual(config.PSI_SETSIZE, res.json['clientSetSize'])
+            m.delay.assert_called_once_with(res.json['port'],
+                                            config.PSI_SETSIZE, 1, None)
+            self.assertEqual(1, res.json['buckets'])
+            m.reset_mock()
+            # Size class of the client set
+            size = config.PSI_CLIENT_MIN_SETSIZE
+            res = self.client.get(f'/client/psi?setSize={size}',
+                                  headers=auth_head)
+            self.assertEqual(size, res.json['clientSetSize'])
+            m.delay.assert_called_once_with(res.json['port'], size, 1, None)
+            m.reset_mock()
+            res = self.client.get(f'/client/psi?setSize={size + 1}',
+                                  headers=auth_head)
+            self.assertFalse(res.json['success'])
+            self.assertIn("Invalid client set size", res.json['msg'])
+            m.delay.assert_not_called()
+            # Other schemes require equal set sizes
+            with patch("lib.config.PSI_SCHEME", "RR17"):
+                res = self.client.get(f'/client/psi?setSize={size}',
+                                      headers=auth_head)
+            self.assertEqual(config.PSI_SETSIZE, res.json['clientSetSize'])
+            m.reset_mock()
+            # Server set split into buckets
+            with patch("lib.psi_set.PSIServerSet.buckets", return_value=4):
+                res = self.client.get(f'/client/psi?setSize={size}',
+                                      headers=auth_head)
+                self.assertFalse(res.json['success'])
+                self.assertEqual(4, res.json['buckets'])
+                for buckets, bucket in [(2, None), (6, None), (4, 4)]:
+                    res = self.client.get(
+                        f'/client/psi?setSize={size}&buckets={buckets}' +
+                        ('' if bucket is None else f'&bucket={bucket}'),
+                        headers=auth_head)
+                    self.assertFalse(res.json['success'])
+                m.delay.assert_not_called()
+                res = self.client.get(
+                    f'/client/psi?setSize={size}&buckets=8',
+                    headers=auth_head)
+                self.assertEqual(8, res.json['buckets'])
+                m.delay.assert_called_once_with(res.json['port'], size, 8,
+                                                None)
+                m.reset_mock()
+                res = self.client.get(
+                    f'/client/psi?setSize={size}&buckets=4&bucket=3',
+                    headers=auth_head)
+                m.delay.assert_called_once_with(res.json['port'], size, 4, 3)
+            m.reset_mock()
+            # Pre-initialized senders, celery if none is idle
+            with patch("lib.config.PSI_POOL_SIZE", 2), \
+                    patch("storage_server.client.get_psi_pool") as pool, \
+                    patch("lib.database.add_task") as add_task:
+                pool.return_value.acquire.return_value = (4242, "session")
+                res = self.client.get(f'/client/psi?setSize={size}',
+                                      headers=auth_head)
+                self.assertEqual(4242, res.json['port'])
+                pool.return_value.acquire.assert_called_once_with(
+                    clientSetSize=size, buckets=1, bucket=None)
+                m.delay.assert_not_called()
+                # The session can be listed and killed like a task
+                add_task.assert_called_once_with(
+                    correct_user, UserType.CLIENT, "session",
+                    TaskType.PSI_POOL)
+                pool.return_value.acquire.return_value = None
+                res = self.client.get(f'/client/psi?setSize={size}',
+                                      headers=auth_head)
+                m.delay.assert_called_once_with(res.json['port'], size, 1,
+                                                None)
 
     @patch("storage_server.client.get_user", Mock(return_value="user"))
     @patch("storage_server.client.BloomAccess", return_value="test")
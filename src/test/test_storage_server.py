@@ -6,9 +6,12 @@ Author: Erik Buchholz
 Maintainer: Erik Buchholz
 E-mail: buchholz@comsys.rwth-aachen.de
 """
+import json
 import logging
 import os
 import shutil
+import threading
+import zlib
 from unittest import TestCase, mock
 from unittest.mock import Mock, patch
 
@@ -18,7 +21,11 @@ from pybloomfilter import BloomFilter
 import lib.config as config
 import lib.helpers as helpers
 import lib.storage_server_backend as server
-from lib.record import Record
+from lib.blocked_bloom import BlockedBloomFilter
+from lib.bloom import encode_key
+from lib.psi_set import (PSIServerSet, client_set_size,
+                         check_client_set_size, psi_bucket, check_buckets)
+from lib.record import Record, hash_to_index, ints_to_wide_indices
 
 l1 = [
     ('a', 'ciphertext1', 'owner'),
@@ -77,6 +84,7 @@ class StorageServerTest(TestCase):
         self.assertTrue(os.path.exists(test_dir))
 
     @patch("lib.storage_server_backend.StoredRecord")
+    @patch("lib.config.BLOOM_KEY_ENCODING", 'base64')
     def test_initialize_bloom_filter(self, m):
         m.query.all.return_value = []
         s = server.StorageServer(test_dir)
@@ -95,6 +103,68 @@ class StorageServerTest(TestCase):
         for e in l3:
             self.assertNotIn(e, b)
 
+    @patch("lib.storage_server_backend.StoredRecord")
+    def test_bloom_implementation(self, m):
+        hashes = [bytes([i]) * 64 for i in range(4)]
+        mock_records = []
+        for h in hashes[:2]:
+            mo = Mock()
+            mo.hash = helpers.to_base64(h)
+            mock_records.append(mo)
+        m.query.all.return_value = mock_records
+        s = server.StorageServer(test_dir)
+        self.assertIsInstance(s.bloom, BloomFilter)
+        with patch("lib.config.BLOOM_IMPLEMENTATION", 'blocked'):
+            s._initialize_bloom_filter()
+            self.assertIsInstance(s.bloom, BlockedBloomFilter)
+            with open(self.bloom_path, 'rb') as fd:
+                content = fd.read()
+            # Reinitialization keeps the filter's seed
+            s._initialize_bloom_filter()
+            with open(self.bloom_path, 'rb') as fd:
+                self.assertEqual(content, fd.read())
+        s.batch_store_records_bloom(
+            [(helpers.to_base64(hashes[2]), 'record', 'owner')])
+        encoding = s.get_bloom_encoding()
+        for h in hashes[:3]:
+            self.assertIn(encode_key(h, encoding), s.bloom)
+        self.assertNotIn(encode_key(hashes[3], encoding), s.bloom)
+        # Reloaded from file
+        s._bloom = None
+        self.assertIsInstance(s.bloom, BlockedBloomFilter)
+        # Switching back creates a new filter
+        s._initialize_bloom_filter()
+        self.assertIsInstance(s.bloom, BloomFilter)
+        self.assertIn(encode_key(hashes[0], encoding), s.bloom)
+
+    @patch("lib.storage_server_backend.StoredRecord")
+    def test_bloom_key_encoding(self, m):
+        hashes = [bytes([i]) * 64 for i in range(6)]
+        mock_records = []
+        for h in hashes[:3]:
+            mo = Mock()
+            mo.hash = helpers.to_base64(h)
+            mock_records.append(mo)
+        m.query.all.return_value = mock_records
+        s = server.StorageServer(test_dir)
+        for encoding in ['digest', 'prefix', 'base64']:
+            with patch("lib.config.BLOOM_KEY_ENCODING", encoding):
+                s._initialize_bloom_filter()
+            self.assertEqual(encoding, s.get_bloom_encoding())
+            # Inserts use the encoding of the filter
+            s.batch_store_records_bloom(
+                [(helpers.to_base64(hashes[3]), 'record', 'owner')])
+            for h in hashes[:4]:
+                self.assertIn(encode_key(h, encoding), s.bloom)
+            for h in hashes[4:]:
+                self.assertNotIn(encode_key(h, encoding), s.bloom)
+        # Encoding is versioned with the filter
+        self.assertEqual(6, s.get_bloom_version())
+        with patch("lib.config.BLOOM_KEY_ENCODING", 'md5'), \
+                self.assertRaises(ValueError):
+            s._initialize_bloom_filter()
+
+    @patch.object(server.StorageServer, "_add_to_psi_set", Mock())
     def test_store_record(self):
         s = server.StorageServer(test_dir)
         BloomFilter(20, 0.1, self.bloom_path)  # create bloom filter
@@ -107,10 +177,17 @@ class StorageServerTest(TestCase):
         db.session.add.assert_called_once()
 
     def test_batch_store_records_db(self):
-        with patch("lib.storage_server_backend.db") as db:
-            server.StorageServer.batch_store_records_db(l1)
+        s = server.StorageServer(test_dir)
+        records = [(helpers.to_base64(bytes([i]) * 64), c, o)
+                   for i, (h, c, o) in enumerate(l1)]
+        with patch("lib.storage_server_backend.db") as db, \
+                patch("lib.storage_server_backend.StoredRecord") as m:
+            m.query.all.return_value = []
+            s.batch_store_records_db(records)
         # check db
         self.assertEqual(len(l2), db.session.add.call_count)
+        # check PSI set
+        self.assertEqual(len(l2), s.psi_set.count)
 
     def test_batch_store_records_bloom(self):
         s = server.StorageServer(test_dir)
@@ -143,7 +220,8 @@ class StorageServerTest(TestCase):
     def test_batch_get_record(self):
         server.db.init_app(mock_app)
         with mock_app.test_request_context(), \
-             patch.object(server.StorageServer, "bloom", new_callable=Mock()):
+             patch.object(server.StorageServer, "bloom", new_callable=Mock()), \
+             patch.object(server.StorageServer, "_add_to_psi_set", Mock()):
             server.db.create_all()
             s = server.StorageServer(test_dir)
             s.batch_store_records_db(l1)
@@ -154,6 +232,29 @@ class StorageServerTest(TestCase):
             res
         )
 
+    def test_convert_ciphertexts(self):
+        r = Record([1, 2, 3, 4, 5])
+        r.set_hash_key(b"hash-key")
+        key = b"0123456789abcdef"
+        c_json = json.dumps(r.get_encrypted_record(key))
+        c_bin = helpers.to_base64(r.get_encrypted_bytes(key))
+        h = helpers.to_base64(r.get_long_hash())
+        server.db.init_app(mock_app)
+        with mock_app.test_request_context():
+            server.db.create_all()
+            server.StorageServer(test_dir).batch_store_records_db(
+                [(h, c_json, 'owner'), (h, c_bin, 'owner2')])
+            self.assertEqual(1, server.StorageServer.convert_ciphertexts())
+            self.assertEqual(0, server.StorageServer.convert_ciphertexts())
+            res = server.StoredRecord.query.all()
+        self.assertEqual(2, len(res))
+        for rec in res:
+            self.assertNotIn('{', rec.ciphertext)
+            self.assertEqual(
+                r,
+                Record.from_ciphertext(rec.ciphertext, key,
+                                       r.get_long_hash()))
+
     def test_get_bloom_filter(self):
         s = server.StorageServer(test_dir)
         b = BloomFilter(20, 0.01, self.bloom_path)  # create bloom filter
@@ -165,26 +266,221 @@ class StorageServerTest(TestCase):
         for e in l3:
             self.assertNotIn(e, b)
 
+    @patch("lib.storage_server_backend.StoredRecord")
+    @patch("lib.config.BLOOM_KEY_ENCODING", 'base64')
+    def test_bloom_version(self, m):
+        mock_records = []
+        for l in l2:
+            mo = Mock()
+            mo.hash = l
+            mock_records.append(mo)
+        m.query.all.return_value = mock_records
+        s = server.StorageServer(test_dir)
+        s._initialize_bloom_filter()
+        self.assertEqual(1, s.get_bloom_version())
+        seeds = s.bloom.hash_seeds
+        # Rebuild with same records keeps the version
+        s._initialize_bloom_filter()
+        self.assertEqual(1, s.get_bloom_version())
+        self.assertEqual(seeds, s.bloom.hash_seeds)
+        s.batch_store_records_bloom([(e, 'record', 'owner') for e in l3])
+        self.assertEqual(2, s.get_bloom_version())
+        version, words, values = s.get_bloom_delta(1)
+        self.assertEqual(2, version)
+        self.assertGreater(len(words), 0)
+        self.assertIsNone(s.get_bloom_delta(5))
+
+    def test_get_bloom_file(self):
+        s = server.StorageServer(test_dir)
+        b = BloomFilter(20, 0.01, self.bloom_path)
+        b.update(l2)
+        b.sync()
+        path, version = s.get_bloom_file()
+        self.assertEqual(1, version)
+        self.assertEqual(f"{test_dir}{config.BLOOM_FILE}.1.none", path)
+        with open(path, 'rb') as fd, open(self.bloom_path, 'rb') as fd2:
+            v1 = fd2.read()
+            self.assertEqual(v1, fd.read())
+        path, version = s.get_bloom_file('zlib')
+        self.assertEqual(f"{test_dir}{config.BLOOM_FILE}.1.zlib", path)
+        mtime = os.path.getmtime(path)
+        self.assertEqual((path, 1), s.get_bloom_file('zlib'))
+        self.assertEqual(mtime, os.path.getmtime(path))  # Reused
+        # New version replaces old file
+        b.update(l3)
+        b.sync()
+        s.bloom_log.commit()
+        new_path, version = s.get_bloom_file('zlib')
+        self.assertEqual(2, version)
+        with open(new_path, 'rb') as fd, open(self.bloom_path, 'rb') as fd2:
+            self.assertEqual(fd2.read(), zlib.decompress(fd.read()))
+        # The previous version is kept unchanged for running transfers
+        self.assertTrue(os.path.exists(path))
+        none_path, _ = s.get_bloom_file()
+        with open(f"{test_dir}{config.BLOOM_FILE}.1.none", 'rb') as fd:
+            self.assertEqual(v1, fd.read())
+        with open(none_path, 'rb') as fd, \
+                open(self.bloom_path, 'rb') as fd2:
+            self.assertEqual(fd2.read(), fd.read())
+        b.add("other")
+        b.sync()
+        s.bloom_log.commit()
+        s.get_bloom_file('zlib')
+        self.assertFalse(os.path.exists(path))
+        self.assertTrue(os.path.exists(new_path))
+        with self.assertRaises(ValueError):
+            s.get_bloom_file('lzma')
+        # Concurrent requests and commits
+        errors = []
+
+        def request():
+            try:
+                for _ in range(20):
+                    p, v = server.StorageServer(test_dir).get_bloom_file(
+                        'zlib')
+                    os.path.getsize(p)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=request) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for i in range(20):
+            b.add(f"key{i}")
+            b.sync()
+            s.bloom_log.commit()
+        for t in threads:
+            t.join()
+        self.assertEqual([], errors)
+        self.assertEqual([], [f for f in os.listdir(test_dir)
+                              if f.endswith('.tmp')])
+
+    @patch("lib.config.PSI_SETSIZE", 22)
     def test_offer_psi(self):
         port = 5555
-        s = server.StorageServer()
-        set = list(range(20))
+        s = server.StorageServer(test_dir)
+        hashes = [bytes([i]) * 64 for i in range(30)]
         m = Mock()
-        with mock.patch("lib.storage_server_backend.PyPSISender",
-                        return_value=m):
-            with mock.patch.object(server.StorageServer,
-                                   "get_all_record_psi_hashes",
-                                   return_value=set):
-                s.offer_psi(22, port)
+        with patch("lib.storage_server_backend.PyPSISender",
+                   return_value=m), \
+                patch("lib.storage_server_backend.StoredRecord") as sr:
+            sr.query.all.return_value = [
+                Mock(hash=helpers.to_base64(h)) for h in hashes[:20]]
+            s.offer_psi(22, port)
             self.assertEqual(config.PSI_SCHEME, m.execute.call_args[0][0])
-            self.assertEqual(set, m.execute.call_args[0][1])
-            set = list(range(100))
-            mock.patch.object(s, "get_all_record_psi_hashes", return_value=set)
+            self.assertEqual(22, m.recvSetSize)
+            correct = [hash_to_index(h, config.PSI_INDEX_LEN)
+                       for h in hashes[:20]]
+            correct += [config.PSI_DUMMY_START_SERVER + i
+                        for i in range(20, 22)]
+            self.assertEqual(correct, m.execute.call_args[0][1])
+            s.offer_psi(22, port, clientSetSize=4)
+            self.assertEqual(4, m.recvSetSize)
+            self.assertEqual(correct, m.execute.call_args[0][1])
             with self.assertRaises(RuntimeError):
-                with mock.patch.object(server.StorageServer,
-                                       "get_all_record_psi_hashes",
-                                       return_value=set):
-                    s.offer_psi(22, port=port)
+                s.psi_set.add(server.get_psi_indices(
+                    [helpers.to_base64(h) for h in hashes[20:]]))
+                s.offer_psi(22, port=port)
+
+    @patch("lib.config.PSI_SETSIZE", 5)
+    def test_psi_set(self):
+        hashes = [helpers.to_base64(bytes([i]) * 64) for i in range(8)]
+        ints = [server.get_psi_index(h) for h in hashes]
+        s = server.StorageServer(test_dir)
+        with patch("lib.storage_server_backend.StoredRecord") as sr:
+            # Built from DB on first use, duplicates are removed
+            sr.query.all.return_value = [Mock(hash=h) for h in
+                                         hashes[:2] + hashes[:1]]
+            psi_set = s.psi_set
+        self.assertEqual(2, psi_set.count)
+        dummy = config.PSI_DUMMY_START_SERVER
+        self.assertEqual(ints[:2] + [dummy + i for i in range(2, 5)],
+                         psi_set.load())
+        # New records replace dummies, also in the loaded copy
+        self.assertEqual(2, psi_set.add(server.get_psi_indices(
+            hashes[1:4] + hashes[3:4])))
+        self.assertEqual(ints[:4] + [dummy + 4], psi_set.load())
+        self.assertEqual(ints[:4] + [dummy + i for i in range(4, 7)],
+                         psi_set.load(7))
+        self.assertEqual(0, psi_set.add(server.get_psi_indices(hashes[:4])))
+        # Growing beyond the set size
+        self.assertEqual(3, psi_set.add(server.get_psi_indices(hashes[4:7])))
+        self.assertEqual(7, psi_set.count)
+        self.assertEqual(ints[:7], psi_set.load(7))
+        with self.assertRaises(RuntimeError):
+            psi_set.load()
+        # Rebuild
+        psi_set.rebuild(server.get_psi_indices(hashes[5:]))
+        self.assertEqual(ints[5:] + [dummy + i for i in range(3, 5)],
+                         psi_set.load())
+        self.assertEqual(0, len(server.get_psi_indices([])))
+        # Indices with equal low words
+        existing = ints_to_wide_indices([1 << 64 | 5, 2 << 64 | 5, 7])
+        new = ints_to_wide_indices([2 << 64 | 5, 4 << 64 | 5, 7, 9, 5,
+                                    1 << 64 | 5])
+        self.assertEqual([True, False, True, False, False, True],
+                         PSIServerSet._contained(existing, new).tolist())
+
+    @patch("lib.config.PSI_SETSIZE", 10)
+    def test_psi_set_buckets(self):
+        hashes = [helpers.to_base64(bytes([i]) * 64) for i in range(100)]
+        ints = [server.get_psi_index(h) for h in hashes]
+        s = server.StorageServer(test_dir)
+        with patch("lib.storage_server_backend.StoredRecord") as sr:
+            sr.query.all.return_value = [Mock(hash=h) for h in hashes[:10]]
+            psi_set = s.psi_set
+        self.assertEqual(1, psi_set.buckets())
+        self.assertEqual(len(ints[:10]), len(psi_set.load_bucket(0, 1)))
+        # Growing beyond the set size splits the set
+        psi_set.add(server.get_psi_indices(hashes[10:]))
+        buckets = psi_set.buckets()
+        self.assertGreaterEqual(buckets, 16)
+        self.assertEqual(buckets, psi_set.buckets())  # Cached
+        self.assertLess(psi_set.buckets(50), buckets)
+        dummy = config.PSI_DUMMY_START_SERVER
+        found = []
+        for b in range(buckets):
+            res = psi_set.load_bucket(b, buckets)
+            self.assertEqual(10, len(res))
+            real = [i for i in res if i < dummy]
+            self.assertTrue(all(psi_bucket(i, buckets) == b for i in real))
+            self.assertEqual(len(res), len(set(res)))
+            found += real
+        self.assertEqual(sorted(ints), sorted(found))
+        with self.assertRaises(RuntimeError):
+            psi_set.load_bucket(0, buckets // 4)
+        for bucket, n in [(0, 3), (4, 4)]:
+            with self.assertRaises(ValueError):
+                psi_set.load_bucket(bucket, n)
+        for n in [0, 3]:
+            with self.assertRaises(ValueError):
+                check_buckets(n)
+        check_buckets(1)
+        # Offer all buckets one after another
+        m = Mock()
+        with patch("lib.storage_server_backend.PyPSISender",
+                   return_value=m):
+            s.offer_psi(10, 5555, buckets=buckets)
+            self.assertEqual(buckets, m.execute.call_count)
+            self.assertEqual(psi_set.load_bucket(buckets - 1, buckets),
+                             m.execute.call_args[0][1])
+            m.reset_mock()
+            s.offer_psi(10, 5555, buckets=buckets, bucket=1)
+            m.execute.assert_called_once()
+            self.assertEqual(psi_set.load_bucket(1, buckets),
+                             m.execute.call_args[0][1])
+
+    @patch("lib.config.PSI_SETSIZE", 1000)
+    @patch("lib.config.PSI_CLIENT_MIN_SETSIZE", 16)
+    def test_client_set_size(self):
+        for n, size in [(0, 16), (16, 16), (17, 32), (512, 512),
+                        (513, 1000), (5000, 1000)]:
+            self.assertEqual(size, client_set_size(n))
+        for size in [16, 256, 1000]:
+            check_client_set_size(size)
+        for size in [0, 17, 1024]:
+            with self.assertRaises(ValueError):
+                check_client_set_size(size)
 
     def test_get_all_record_psi_hashes(self):
         records = []
@@ -9,6 +9,7 @@ E-mail: buchholz@comsys.rwth-aachen.de
 import json
 
 from lib.config import WORKING_DIR
+from lib.helpers import save_records
 
 with open(f"{WORKING_DIR}/data/ikv_data_unconverted.json", "r") as f:
     d = json.load(f)
@@ -46,5 +47,5 @@ with open(f"{WORKING_DIR}/data/lego_converted.json", "w") as f:
 
 print("Generated vectors: ", len(lists_only))
 print("Record Length: ", len(lists_only[0]))
-with open(f"{WORKING_DIR}/data/ikv_data.txt", "w") as fd:
-    fd.writelines([f"{str(r)}\n" for r in lists_only])
+save_records(f"{WORKING_DIR}/data/ikv_data.txt", lists_only)
+save_records(f"{WORKING_DIR}/data/ikv_data.npy", lists_only)
@@ -9,6 +9,7 @@ E-mail: buchholz@comsys.rwth-aachen.de
 import json
 
 from lib.config import WORKING_DIR
+from lib.helpers import save_records
 
 # Mappings from Names to Ints--------------------------------------------------
 steuerung = {
@@ -57,5 +58,5 @@ rounding_vec = [3 if i not in string_fields else 0 for i in range(len(values))]
 print("Generated vectors: ", len(result))
 print("Rounding vector = ", rounding_vec)
 print("Record Length: ", len(result[0]))
-with open(f"{WORKING_DIR}/data/wzl_data.txt", "w") as fd:
-    fd.writelines([f"{str(r)}\n" for r in result])
+save_records(f"{WORKING_DIR}/data/wzl_data.txt", result)
+save_records(f"{WORKING_DIR}/data/wzl_data.npy", result)